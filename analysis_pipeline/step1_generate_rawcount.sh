@@ -2,31 +2,30 @@
 
 source step0_preparation.sh
 
+# number of worker processes used by mageck-ibar-count
+NPROC_STEP1=8
+
+samples=()
 for label in ${LABELS_STEP1[*]}; do
     fq1=${label}.fastq
     fq1gz=${fq1}.gz
     fq2=${label}.fastq
     fq2gz=${fq2}.gz
 
-    ####################
+    samples+=(-s ${label} ${DIR_STEP0_FASTQ}/${fq1gz} ${DIR_STEP0_FASTQ}/${fq2gz})
+done
 
-    echo "$(date) unzip ${fq1gz}"
-    gunzip ${DIR_STEP0_FASTQ}/${fq1gz}
-    echo "$(date) unzip ${fq2gz}"
-    gunzip ${DIR_STEP0_FASTQ}/${fq2gz}
+####################
 
-    count_sgrna_with_barcode -a "ACCG([ATGC]{20})GTTT[ATGC]{1,35}TGGA([ATCG]{4,6})AACA" \
-        -p "ACCG([ATGC]{20})GTTT" \
-        -b "TGGA([ATCG]{6})AACA" \
-        -f ${DIR_STEP0_FASTQ}/${fq1} -r ${DIR_STEP0_FASTQ}/${fq2} \
-        > ${DIR_STEP1_RAWCOUNT}/${label}.rawcount
+echo "$(date) count ${LABELS_STEP1[*]}"
 
-    echo "$(date) zip ${fq1}"
-    gzip ${DIR_STEP0_FASTQ}/${fq1}
-    echo "$(date) zip ${fq2}"
-    gzip ${DIR_STEP0_FASTQ}/${fq2}
+mageck-ibar-count -j ${NPROC_STEP1} \
+    --guide-left ACCG --guide-right GTTT --guide-length 20 \
+    --barcode-left TGGA --barcode-right AACA --barcode-range 4 6 \
+    --mate-barcode-length 6 \
+    --outdir ${DIR_STEP1_RAWCOUNT} \
+    ${samples[*]}
 
-done
 ####################
 # echo "END"
 ####################
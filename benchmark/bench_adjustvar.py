@@ -0,0 +1,118 @@
+#! /usr/bin/env python3
+
+# ------------------
+# Library
+# ------------------
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+
+from mibar.dfcalculate import df_adjustvar
+
+# ------------------
+# ArgumentParser
+# ------------------
+
+parser = argparse.ArgumentParser(
+    description='Micro benchmark of the guide level variance adjustment on libraries of increasing size.'
+)
+
+parser.add_argument(
+    '-g', '--guides',
+    action='store',
+    type=int,
+    nargs='+',
+    default=[1000, 10000, 100000],
+    help='Numbers of guides of the synthetic libraries, default is 1000 10000 100000.'
+)
+parser.add_argument(
+    '--barcodes',
+    action='store',
+    type=int,
+    default=4,
+    help='Number of barcodes of each guide, default is 4.'
+)
+parser.add_argument(
+    '--seed',
+    action='store',
+    type=int,
+    default=123456,
+    help='Seed of the random number generator.'
+)
+
+args = vars(parser.parse_args())
+
+# ------------------
+# Function
+# ------------------
+
+def synthetic(guides, barcodes, rng):
+    # guide, control variance and direction of a synthetic library
+    rows = guides * barcodes
+    guide = pd.Series(
+        np.repeat(['sg{0:d}'.format(i) for i in range(guides)], barcodes)
+    ).astype('category')
+    data = pd.DataFrame(
+        {
+            'guide': guide,
+            'controlvar': rng.gamma(2.0, 50.0, rows),
+            'direction': rng.choice([-1, 0, 1], rows, p=[0.2, 0.6, 0.2])
+        }
+    )
+    return data.sample(frac=1, random_state=0).reset_index(drop=True)
+
+
+def groupbyapply(data):
+    # the former adjustment by groupby apply and label look up
+    agg_guide_var = data[
+        ['guide', 'controlvar']
+    ].groupby('guide', observed=True).mean()
+    agg_guide_samedirection = data[['guide', 'direction']].groupby(
+        'guide', observed=True
+    ).apply(
+        lambda x: max(x['direction']) * min(x['direction'])
+    )
+    agg_guide = pd.DataFrame(
+        {
+            'controlvar': agg_guide_var['controlvar'],
+            'samedirection': agg_guide_samedirection[agg_guide_var.index] != -1
+        }
+    )
+    adjust_var = agg_guide.loc[
+        data['guide'], 'controlvar'
+    ].mul(
+        (1 - agg_guide.loc[data['guide'], 'samedirection']),
+        axis=0
+    )
+    adjust_var.index = data['guide'].index
+    return adjust_var
+
+
+def timeit(func, *funcargs):
+    start = time.perf_counter()
+    result = func(*funcargs)
+    return (result, time.perf_counter() - start)
+
+# ------------------
+# Benchmark
+# ------------------
+
+rng = np.random.default_rng(args['seed'])
+
+print('guides\trows\tgroupby.apply (s)\tgrouped reduction (s)\tspeed up\tidentical')
+for guides in args['guides']:
+    data = synthetic(guides, args['barcodes'], rng)
+    old, oldtime = timeit(groupbyapply, data)
+    new, newtime = timeit(df_adjustvar, data, 'guide', 'controlvar', 'direction')
+    print(
+        '{0:d}\t{1:d}\t{2:.3f}\t{3:.3f}\t{4:.1f}x\t{5}'.format(
+            guides, data.shape[0], oldtime, newtime, oldtime / newtime,
+            np.array_equal(old.to_numpy(), new.to_numpy())
+        )
+    )
+
+# ------------------
+# EOF
+# ------------------
@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+
+# ------------------
+# Library
+# ------------------
+
+import argparse
+import time
+import numpy as np
+
+from mibar.rra import rra_betacdf
+from mibar.rra import rra_betatable
+
+# ------------------
+# ArgumentParser
+# ------------------
+
+parser = argparse.ArgumentParser(
+    description='Benchmark of the beta cdf of RRA lo-values by the incomplete beta function and by the cached table.'
+)
+
+parser.add_argument(
+    '-n', '--number',
+    action='store',
+    type=int,
+    default=1000000,
+    help='Number of percentiles of each group size, default is 1000000.'
+)
+parser.add_argument(
+    '--sizes',
+    nargs='+',
+    action='store',
+    type=int,
+    default=[4, 10, 30, 60],
+    help='Group sizes, default is 4 10 30 60.'
+)
+parser.add_argument(
+    '--percentile',
+    action='store',
+    type=float,
+    default=0.1,
+    help='Maximum percentile, default is 0.1.'
+)
+parser.add_argument(
+    '--seed',
+    action='store',
+    type=int,
+    default=123456,
+    help='Seed of the random number generator.'
+)
+
+args = vars(parser.parse_args())
+
+# ------------------
+# Function
+# ------------------
+
+def timeit(func, *funcargs):
+    start = time.perf_counter()
+    result = func(*funcargs)
+    return (result, time.perf_counter() - start)
+
+# ------------------
+# Benchmark
+# ------------------
+
+rng = np.random.default_rng(args['seed'])
+table, tabletime = timeit(rra_betatable, max(args['sizes']))
+print(
+    'percentiles: {0:d}, table of {1:.1f} MB built in {2:.3f} s'.format(
+        args['number'], table.nbytes / 1024 ** 2, tabletime
+    )
+)
+for size in args['sizes']:
+    rank = rng.integers(1, size + 1, args['number'])
+    x = rng.random(args['number']) * args['percentile']
+    exact, exacttime = timeit(rra_betacdf, rank, size, x, False)
+    result, resulttime = timeit(rra_betacdf, rank, size, x, True)
+    nonzero = exact > 0
+    print(
+        'size {0:d}: betainc {1:.3f} s, table {2:.3f} s, max relative difference {3:.2e}'.format(
+            size, exacttime, resulttime,
+            np.abs(result[nonzero] / exact[nonzero] - 1.0).max()
+        )
+    )
+
+# ------------------
+# EOF
+# ------------------
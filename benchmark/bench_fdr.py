@@ -0,0 +1,133 @@
+#! /usr/bin/env python3
+
+# ------------------
+# Library
+# ------------------
+
+import argparse
+import time
+import numpy as np
+
+from mibar.fdr import fdr_adjust
+
+# ------------------
+# ArgumentParser
+# ------------------
+
+parser = argparse.ArgumentParser(
+    description='Benchmark and validation of the FDR adjustment against the former array_fdr.'
+)
+
+parser.add_argument(
+    '-n', '--rows',
+    action='store',
+    type=int,
+    default=1000000,
+    help='Number of p values, default is 1000000.'
+)
+parser.add_argument(
+    '--seed',
+    action='store',
+    type=int,
+    default=123456,
+    help='Seed of the random number generator.'
+)
+
+args = vars(parser.parse_args())
+
+# ------------------
+# Function
+# ------------------
+
+def array_fdr_loop(pvalues, method='Benjamini-Hochberg'):
+    # the former dfcalculate.array_fdr
+    pvalues = np.array(pvalues)
+    n = float(pvalues.shape[0])
+    new_pvalues = np.zeros(int(n))
+    if method == "Bonferroni":
+        new_pvalues = n * pvalues
+    elif method == "Bonferroni-Holm":
+        values = [ (pvalue, i) for i, pvalue in enumerate(pvalues) ]
+        values.sort()
+        for rank, vals in enumerate(values):
+            pvalue, i = vals
+            new_pvalues[i] = (n-rank) * pvalue
+    elif method == "Benjamini-Hochberg":
+        values = [ (pvalue, i) for i, pvalue in enumerate(pvalues) ]
+        values.sort()
+        values.reverse()
+        new_values = []
+        for i, vals in enumerate(values):
+            rank = n - i
+            pvalue, index = vals
+            new_values.append((n/rank) * pvalue)
+        for i in range(0, int(n)-1):
+            if new_values[i] < new_values[i+1]:
+                new_values[i+1] = new_values[i]
+        for i, vals in enumerate(values):
+            pvalue, index = vals
+            new_pvalues[index] = new_values[i]
+    return new_pvalues
+
+
+def timeit(func, *funcargs):
+    start = time.perf_counter()
+    result = func(*funcargs)
+    return (result, time.perf_counter() - start)
+
+# ------------------
+# Benchmark
+# ------------------
+
+rng = np.random.default_rng(args['seed'])
+# uniform p values with some signals and ties
+pvalues = np.concatenate(
+    [
+        rng.random(args['rows'] - args['rows'] // 10),
+        rng.beta(0.1, 10, args['rows'] // 10)
+    ]
+)
+pvalues[rng.integers(0, pvalues.size, pvalues.size // 100)] = 1.0
+pvalues = np.round(pvalues, 8)
+rng.shuffle(pvalues)
+
+print('p values: {0:d}'.format(pvalues.size))
+for method in ['Benjamini-Hochberg', 'Bonferroni', 'Bonferroni-Holm']:
+    new, newtime = timeit(fdr_adjust, pvalues, method)
+    old, oldtime = timeit(array_fdr_loop, pvalues, method)
+    print(
+        '{0:s}: loop {1:.3f} s, vectorized {2:.3f} s, identical: {3}'.format(
+            method, oldtime, newtime, np.array_equal(old, new)
+        )
+    )
+
+# float32 and NaN p values
+new32 = fdr_adjust(pvalues.astype(np.float32))
+print(
+    'float32: dtype {0}, max difference to float64 {1:.2e}'.format(
+        new32.dtype,
+        np.abs(new32 - fdr_adjust(pvalues)).max()
+    )
+)
+withnan = pvalues.copy()
+nanindex = rng.integers(0, pvalues.size, pvalues.size // 100)
+withnan[nanindex] = np.nan
+newnan = fdr_adjust(withnan)
+valid = ~np.isnan(withnan)
+print(
+    'NaN: NaN kept {0}, others same as without NaN {1}'.format(
+        np.isnan(newnan[nanindex]).all(),
+        np.array_equal(newnan[valid], fdr_adjust(withnan[valid]))
+    )
+)
+storey, storeytime = timeit(fdr_adjust, pvalues, 'Storey')
+bh = fdr_adjust(pvalues)
+print(
+    'Storey: vectorized {0:.3f} s, q value / BH {1:.3f}'.format(
+        storeytime, (storey[bh > 0] / bh[bh > 0]).max()
+    )
+)
+
+# ------------------
+# EOF
+# ------------------
@@ -0,0 +1,112 @@
+#! /usr/bin/env python3
+
+# ------------------
+# Library
+# ------------------
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+
+from mibar import kernels
+
+# ------------------
+# ArgumentParser
+# ------------------
+
+parser = argparse.ArgumentParser(
+    description='Benchmark of the row wise kernels against the pandas calculations on a synthetic count table.'
+)
+
+parser.add_argument(
+    '-n', '--rows',
+    action='store',
+    type=int,
+    default=5000000,
+    help='Number of barcode rows of the synthetic count table, default is 5000000.'
+)
+parser.add_argument(
+    '--seed',
+    action='store',
+    type=int,
+    default=123456,
+    help='Seed of the random number generator.'
+)
+
+args = vars(parser.parse_args())
+
+# ------------------
+# Function
+# ------------------
+
+def synthetic(rows, seed):
+    # normalized counts of 2 controls and 2 treatments
+    rng = np.random.default_rng(seed)
+    mean = rng.lognormal(5, 1, size=rows)
+    return pd.DataFrame(
+        {
+            x: rng.negative_binomial(20, 20 / (20 + mean)) * 1.1
+            for x in ['c1', 'c2', 't1', 't2']
+        }
+    )
+
+
+def pandas_kernels(data):
+    # the former pandas calculations
+    label = ['c1', 'c2']
+    gm = np.exp(np.log(data[label] + 1).sum(axis=1) / len(label)) - 1
+    allgm = np.exp(np.log(data + 1.0).sum(axis=1) / data.shape[1]) - 1.0
+    allgm[allgm <= 0] = 1
+    ratio = data.div(allgm, axis=0)
+    var = data[label].var(axis=1)
+    estvar = gm.map(lambda x: x ** 1.8) * 2 ** 0.5 + gm
+    w = gm[gm < var]
+    sums = [w.sum(), w.mul(w).sum()]
+    return [gm.to_numpy(), ratio.to_numpy(), var.to_numpy(), estvar.to_numpy(), np.array(sums)]
+
+
+def mibar_kernels(data):
+    # the same calculations by the kernels
+    values = data[['c1', 'c2']].to_numpy()
+    gm = kernels.geomean(values)
+    ratio = kernels.medianratio(data.to_numpy())
+    var = kernels.rowvar(values)
+    estvar = kernels.estvar(gm, 1.8, 0.5)
+    w = gm[gm < var]
+    sums = kernels.leastsquare(w, w, w)
+    return [gm, ratio, var, estvar, np.array([sums[0], sums[1]])]
+
+
+def timeit(func, data):
+    start = time.perf_counter()
+    result = func(data)
+    return (result, time.perf_counter() - start)
+
+# ------------------
+# Benchmark
+# ------------------
+
+data = synthetic(args['rows'], args['seed'])
+oldresult, oldtime = timeit(pandas_kernels, data)
+print('rows: {0:d}'.format(args['rows']))
+print('pandas: {0:.3f} s'.format(oldtime))
+backends = ['numpy'] if kernels.numba is None else ['numpy', 'numba']
+for backend in backends:
+    kernels.set_backend(backend)
+    # the numba kernels are compiled at the first call
+    timeit(mibar_kernels, data.iloc[:10])
+    newresult, newtime = timeit(mibar_kernels, data)
+    difference = max(
+        np.max(np.abs(x - y) / np.maximum(np.abs(x), 1e-300))
+        for x, y in zip(oldresult, newresult)
+    )
+    print(
+        '{0:s}: {1:.3f} s, speed up {2:.1f}x, max relative difference {3:.2e}'.format(
+            backend, newtime, oldtime / newtime, difference
+        )
+    )
+
+# ------------------
+# EOF
+# ------------------
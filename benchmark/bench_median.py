@@ -0,0 +1,117 @@
+#! /usr/bin/env python3
+
+# ------------------
+# Library
+# ------------------
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+
+from mibar.dfcalculate import df_median_ratio_normfactor
+from mibar.dfcalculate import QuantileSketch
+
+# ------------------
+# ArgumentParser
+# ------------------
+
+parser = argparse.ArgumentParser(
+    description='Benchmark of the median ratio normalization factors by sorting, exact selection and quantile sketch.'
+)
+
+parser.add_argument(
+    '-n', '--rows',
+    action='store',
+    type=int,
+    default=2000000,
+    help='Number of rows of the synthetic count table, default is 2000000.'
+)
+parser.add_argument(
+    '-s', '--samples',
+    action='store',
+    type=int,
+    default=8,
+    help='Number of samples of the synthetic count table, default is 8.'
+)
+parser.add_argument(
+    '--chunks',
+    action='store',
+    type=int,
+    default=10,
+    help='Number of chunks of merged sketches, default is 10.'
+)
+parser.add_argument(
+    '--seed',
+    action='store',
+    type=int,
+    default=123456,
+    help='Seed of the random number generator.'
+)
+
+args = vars(parser.parse_args())
+
+# ------------------
+# Function
+# ------------------
+
+def synthetic(rows, samples, rng):
+    # negative binomial counts of samples with different depths
+    depth = rng.uniform(0.5, 2.0, samples)
+    data = pd.DataFrame(
+        rng.negative_binomial(5, 0.02, size=(rows, samples)) * depth,
+        columns=['S{0:d}'.format(i) for i in range(samples)]
+    )
+    return data
+
+
+def mergedsketch(data, label, chunks):
+    # median ratios of sketches of chunks merged together
+    datgm = np.exp(np.log(data[label] + 1.0).sum(axis=1) / len(label)) - 1.0
+    datgm[datgm <= 0] = 1
+    ratio = data[label].div(datgm, axis=0)
+    median = list()
+    for x in label:
+        sketches = [
+            QuantileSketch().add(part)
+            for part in np.array_split(ratio[x].to_numpy(), chunks)
+        ]
+        for sketch in sketches[1:]:
+            sketches[0].merge(sketch)
+        median.append(sketches[0].median())
+    return 1 / pd.Series(median, index=label)
+
+
+def timeit(func, *funcargs):
+    start = time.perf_counter()
+    result = func(*funcargs)
+    return (result, time.perf_counter() - start)
+
+# ------------------
+# Benchmark
+# ------------------
+
+rng = np.random.default_rng(args['seed'])
+data = synthetic(args['rows'], args['samples'], rng)
+label = list(data.columns)
+
+print('rows: {0:d}, samples: {1:d}'.format(args['rows'], args['samples']))
+exact, exacttime = timeit(df_median_ratio_normfactor, data, label, 'median')
+print('median: {0:.3f} s'.format(exacttime))
+for method in ['median-partition', 'median-sketch']:
+    result, resulttime = timeit(df_median_ratio_normfactor, data, label, method)
+    print(
+        '{0:s}: {1:.3f} s, max relative difference {2:.2e}'.format(
+            method, resulttime, (result / exact - 1).abs().max()
+        )
+    )
+merged, mergedtime = timeit(mergedsketch, data, label, args['chunks'])
+print(
+    'merged sketch of {0:d} chunks: {1:.3f} s, max relative difference {2:.2e}'.format(
+        args['chunks'], mergedtime, (merged / exact - 1).abs().max()
+    )
+)
+
+# ------------------
+# EOF
+# ------------------
@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+
+# ------------------
+# Library
+# ------------------
+
+import argparse
+import time
+import numpy as np
+from scipy.special import betainc
+
+from mibar.rra import rra_problovalue
+
+# ------------------
+# ArgumentParser
+# ------------------
+
+parser = argparse.ArgumentParser(
+    description='Benchmark of the probability weighted lo-value, checked against the enumeration of all subsets for small groups.'
+)
+
+parser.add_argument(
+    '-g', '--groups',
+    action='store',
+    type=int,
+    default=1000,
+    help='Number of groups of each size, default is 1000.'
+)
+parser.add_argument(
+    '--sizes',
+    nargs='+',
+    action='store',
+    type=int,
+    default=[4, 8, 12, 20, 40],
+    help='Group sizes, default is 4 8 12 20 40.'
+)
+parser.add_argument(
+    '--enumerate',
+    action='store',
+    type=int,
+    default=12,
+    help='Largest group size checked by the enumeration of all subsets, default is 12.'
+)
+parser.add_argument(
+    '--percentile',
+    action='store',
+    type=float,
+    default=0.1,
+    help='Maximum percentile, default is 0.1.'
+)
+parser.add_argument(
+    '--seed',
+    action='store',
+    type=int,
+    default=123456,
+    help='Seed of the random number generator.'
+)
+
+args = vars(parser.parse_args())
+
+# ------------------
+# Function
+# ------------------
+
+def timeit(func, *funcargs):
+    start = time.perf_counter()
+    result = func(*funcargs)
+    return (result, time.perf_counter() - start)
+
+# ------------------
+
+def enumeration(percentiles, probs, percentile):
+    # expected lo-value over all the subsets of each group
+    order = np.argsort(percentiles, axis=1)
+    x = np.take_along_axis(percentiles, order, axis=1)
+    p = np.take_along_axis(probs, order, axis=1)
+    result = np.zeros(x.shape[0])
+    for pid in range(1 << x.shape[1]):
+        mask = (pid >> np.arange(x.shape[1])) & 1 == 1
+        weight = np.prod(np.where(mask, p, 1 - p), axis=1)
+        n = mask.sum()
+        if n == 0:
+            result += weight
+            continue
+        k = np.arange(1, n + 1)
+        xs = x[:, mask]
+        beta = betainc(k, n - k + 1.0, xs)
+        limit = np.maximum((xs <= percentile).sum(axis=1), 1)
+        beta[k[np.newaxis, :] > limit[:, np.newaxis]] = 1.0
+        result += weight * np.minimum(beta.min(axis=1), 1.0)
+    return result
+
+# ------------------
+# Benchmark
+# ------------------
+
+rng = np.random.default_rng(args['seed'])
+print('groups: {0:d}'.format(args['groups']))
+for size in args['sizes']:
+    # percentiles of groups with a few top ranked items
+    x = rng.random((args['groups'], size)) ** 2
+    p = rng.uniform(0.3, 1.0, (args['groups'], size))
+    result, resulttime = timeit(rra_problovalue, x, p, args['percentile'])
+    line = 'size {0:d}: {1:.3f} s'.format(size, resulttime)
+    if size <= args['enumerate']:
+        exact, exacttime = timeit(enumeration, x, p, args['percentile'])
+        line += ', enumeration {0:.3f} s, max relative error {1:.2e}'.format(
+            exacttime, (np.abs(result - exact) / exact).max()
+        )
+    print(line)
+
+# ------------------
+# EOF
+# ------------------
@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+
+# ------------------
+# Library
+# ------------------
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from mibar.dfcalculate import array_direction
+from mibar.dfcalculate import array_normtest
+
+# ------------------
+# ArgumentParser
+# ------------------
+
+parser = argparse.ArgumentParser(
+    description='Benchmark of the statistics stage of analysis on a synthetic screen.'
+)
+
+parser.add_argument(
+    '-n', '--rows',
+    action='store',
+    type=int,
+    default=1000000,
+    help='Number of barcode rows of the synthetic screen, default is 1000000.'
+)
+parser.add_argument(
+    '--seed',
+    action='store',
+    type=int,
+    default=123456,
+    help='Seed of the random number generator.'
+)
+
+args = vars(parser.parse_args())
+
+# ------------------
+# Function
+# ------------------
+
+def synthetic(rows, seed):
+    # log fold change and z score of a synthetic screen
+    rng = np.random.default_rng(seed)
+    controlmean = rng.negative_binomial(5, 0.02, size=rows) + 1.0
+    treatmean = rng.negative_binomial(5, 0.02, size=rows) + 1.0
+    adjvar = controlmean + 0.05 * controlmean ** 2
+    data = pd.DataFrame(
+        {
+            'lfc': np.log2(treatmean + 1.0) - np.log2(controlmean + 1.0),
+            'treat_zscore': (treatmean - controlmean) / np.sqrt(adjvar)
+        }
+    )
+    return data
+
+
+def rowwise(data):
+    # the statistics stage with per row python calls
+    result = pd.DataFrame(index=data.index)
+    result['lfc_bin'] = data['lfc'].map(
+        lambda x: 1 if x > -0.1 else 0
+    ) + data['lfc'].map(
+        lambda x: -1 if x < 0.1 else 0
+    )
+    result['p.low'] = data['treat_zscore'].map(norm.cdf)
+    result['p.high'] = data['treat_zscore'].map(norm.sf)
+    result['p.twoside'] = result[['p.low', 'p.high']].apply(
+        lambda x: 2 * x['p.low'] if x['p.low'] < x['p.high'] else 2 * x['p.high'],
+        axis=1
+    )
+    return result
+
+
+def vectorized(data):
+    # the statistics stage with whole array ufuncs
+    result = pd.DataFrame(index=data.index)
+    result['lfc_bin'] = array_direction(data['lfc'].to_numpy())
+    plow, phigh, ptwoside = array_normtest(data['treat_zscore'].to_numpy())
+    result['p.low'] = plow
+    result['p.high'] = phigh
+    result['p.twoside'] = ptwoside
+    return result
+
+
+def timeit(func, data):
+    start = time.perf_counter()
+    result = func(data)
+    return (result, time.perf_counter() - start)
+
+# ------------------
+# Benchmark
+# ------------------
+
+data = synthetic(args['rows'], args['seed'])
+
+newresult, newtime = timeit(vectorized, data)
+oldresult, oldtime = timeit(rowwise, data)
+
+print('rows: {0:d}'.format(args['rows']))
+print('row wise: {0:.3f} s'.format(oldtime))
+print('vectorized: {0:.3f} s'.format(newtime))
+print('speed up: {0:.1f}x'.format(oldtime / newtime))
+print('identical: {0}'.format(oldresult.equals(newresult)))
+
+# ------------------
+# EOF
+# ------------------
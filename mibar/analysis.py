@@ -7,79 +7,89 @@ import pandas as pd
 import numpy as np
 import logging
 import os
-from scipy.stats import norm
+from concurrent.futures import ProcessPoolExecutor
 
 from .decorator import helpstring
 from .decorator import AppendHelp
+from . import kernels
 from .dfcalculate import df_geomean
 from .dfcalculate import df_normalization
 from .dfcalculate import df_leastsquare
 from .dfcalculate import df_modelmeanvar
 from .dfcalculate import df_estvar
+from .dfcalculate import df_rowvar
+from .dfcalculate import df_adjustvar
 from .dfcalculate import array_fdr
+from .dfcalculate import array_direction
+from .dfcalculate import array_normtest
 from .programio import read_rra
+from .programio import round_rra
+from .programio import write_rra
+from .programio import write_table
+from .programio import tableext
+from .rra import rra
 from .sysrun import robustrank
+from .sysrun import robustrank_extension
+from .sysrun import has_rra_extension
+from .sysrun import peak_rss
+from .report import timedstage
 
 # ------------------
 # Function
 # ------------------
 
-_helpdoc = dict()
+def asfloat(values, floattype):
+    # values as 1d array of floattype, without copy if already floattype
+    return np.asarray(values).astype(floattype, copy=False).reshape(-1)
 
-_helpdoc['analysis'] = helpstring(
-    describe='',
-    parameterdicts={
-        'inputdata': 'pd.DataFrame, data to process.',
-        'outprefix': 'string, output data name prefix.',
-        'controlids': 'list, column names of control data',
-        'treatids': 'list, column names of treatment data',
-        'hasbarcode': 'bool, whether the screening using barcode',
-        'normthreshold': 'numeric, threshold used in scoring, the normalized data less than the score will be punished.',
-        'test': 'string, test method, "norm" for normal test.',
-        'rrapath': 'string, path of RobustRankAggregation program.'
-    },
-    returns='No specific returns.',
-    examplecodelists=[
-        "analysis(",
-        "    inputdata,",
-        "    outprefix=outprefix,",
-        "    controlids=['control1', 'control2'],",
-        "    treatids=['treat1', 'treat2'],",
-        "    hasbarcode=True,",
-        "    normthreshold=10,",
-        "    test='norm',",
-        "    rrapath='RRA'",
-        ")"
-    ]
-)
+# ------------------
 
-@AppendHelp(_helpdoc['analysis'], join='')
-def analysis(inputdata,
-             outprefix,
-             controlids,
-             treatids,
-             hasbarcode=True,
-             normthreshold=10,
-             gene_test_threshold=0.25,
-             test='norm',
-             tworra=False,
-             rrapath='RRA'):
-    '''
-    Pipeline function in testing of the CRISPR/Cas9 screening data.
-    '''
-    # setting logging level
+def rankinput(sgrna, symbol, p, prob=None):
+    # input of rankaggregate, the constant pool, chosen and prob columns
+    # are stored as one byte per row, prob is the given probabilities
+    # of the weighted RRA if any
+    n = len(p)
+    if prob is None:
+        prob = np.ones(n, dtype=np.int8)
+    return pd.DataFrame(
+        {
+            'sgrna': sgrna,
+            'symbol': symbol,
+            'pool': pd.Categorical.from_codes(
+                np.zeros(n, dtype=np.int8), categories=['list']
+            ),
+            'p': p,
+            'prob': prob,
+            'chosen': np.ones(n, dtype=np.int8)
+        }
+    )
 
-    # output file names
+# ------------------
+
+def saverra(result, outfile, outformat='tsv'):
+    # write the RRA result, in the format of RRA output file for tsv
+    if outformat == 'tsv':
+        write_rra(result, outfile)
+    else:
+        write_table(
+            result.rename(columns={'beta': 'lo_value'}), outfile, outformat
+        )
+
+# ------------------
+
+def outputfiles(outprefix, hasbarcode, tworra, outformat='tsv'):
+    # output file names of analysis
+    ext = tableext(outformat)
     files = {
-        'barcodeout': outprefix + '.barcode.txt',
-        'sgrnaout': outprefix + '.sgrna.txt',
-        'geneout': outprefix + '.gene.txt',
-        'plowout': outprefix + '.plow.txt',
-        'phighout': outprefix + '.phigh.txt',
-        'sgrnalow': outprefix + '.sgrna.low.txt',
-        'sgrnahigh': outprefix + '.sgrna.high.txt',
-        'genelow': outprefix + '.gene.low.txt',
-        'genehigh': outprefix + '.gene.high.txt'
+        'barcodeout': outprefix + '.barcode' + ext,
+        'sgrnaout': outprefix + '.sgrna' + ext,
+        'geneout': outprefix + '.gene' + ext,
+        'plowout': outprefix + '.plow' + ext,
+        'phighout': outprefix + '.phigh' + ext,
+        'sgrnalow': outprefix + '.sgrna.low' + ext,
+        'sgrnahigh': outprefix + '.sgrna.high' + ext,
+        'genelow': outprefix + '.gene.low' + ext,
+        'genehigh': outprefix + '.gene.high' + ext
     }
     files['firstlevel'] = files['sgrnaout']
     if hasbarcode or tworra:
@@ -97,66 +107,269 @@ def analysis(inputdata,
         files['rra2_low_out'] = files['genelow']
         files['rra2_high_in'] = files['sgrnahigh']
         files['rra2_high_out'] = files['genehigh']
+    return files
 
-    # make the column names
-    infocolnm = ['gene', 'guide', 'gid', 'barcode', 'bid']
+# ------------------
 
-    # make the labels for all consider counts columns in calculation
-    conlabels = controlids + treatids
-    if (len(controlids) > 1):
-        conlabels = controlids
+_helpdoc = dict()
 
-    # normalization
-    logging.info('Normalizing data.')
+_helpdoc['rankaggregate'] = helpstring(
+    describe='',
+    parameterdicts={
+        'pdata': 'pd.DataFrame, items to rank, columns: sgrna, symbol, pool, p, prob, chosen.',
+        'infile': 'string, file path to save the ranked items.',
+        'outfile': 'string, file path to save the RRA result.',
+        'percentile': 'numeric, RRA only consider the items with percentile smaller than this parameter.',
+        'rrapath': 'string, path of RobustRankAggregation program, used by "binary" backend.',
+        'backend': 'string, "python" for the in process RRA, "binary" for the RRA program, "extension" for the RRA program core in process.',
+        'cachedir': 'string, directory to cache the permutation null of "python" backend, default is None.',
+        'outformat': 'string, format of infile and outfile, tsv, parquet or feather, default is tsv.',
+        'threads': 'int, number of threads of the RRA program permutation, used by "binary" and "extension" backends, default is 1.',
+        'betatable': 'bool, interpolate the beta cdf in a cached table, used by "python" backend, see rra_betacdf, default is False.'
+    },
+    returns='pd.DataFrame, columns: group_id, items_in_group, beta, p, FDR, goodsgrna.',
+    examplecodelists=[
+        "rralow = rankaggregate(",
+        "    plowout,",
+        "    infile='out.plow.txt',",
+        "    outfile='out.gene.low.txt',",
+        "    percentile=0.1",
+        ")"
+    ]
+)
+
+@AppendHelp(_helpdoc['rankaggregate'], join='')
+@timedstage('rankaggregate')
+def rankaggregate(pdata,
+                  infile,
+                  outfile,
+                  percentile,
+                  rrapath='RRA',
+                  backend='python',
+                  cachedir=None,
+                  outformat='tsv',
+                  threads=1,
+                  betatable=False):
+    '''
+    Robust Rank Aggregation of the items in pdata by the p column.
+    The RRA program only reads and writes tab separated text, with other
+    output formats it runs on temporary text files.
+    The "extension" backend runs the RRA program core on the sorted items
+    in process, and falls back to the RRA program if it is not built.
+    Its lo-value, p and FDR are rounded as the RRA program writes them,
+    so that the second round of two-rra mode gets the same input.
+    '''
+    pcolnm = ['sgrna', 'symbol', 'pool', 'p', 'prob', 'chosen']
+    pinput = pdata[pcolnm].sort_values('p')
+    write_table(pinput, infile, outformat)
+    if backend == 'extension' and not has_rra_extension():
+        logging.warning('RRA extension module is not built, the RRA program is used.')
+        backend = 'binary'
+    if backend == 'extension':
+        result = robustrank_extension(
+            pinput['symbol'],
+            pinput['p'],
+            percentile,
+            probs=pinput['prob'],
+            chosen=pinput['chosen'],
+            threads=threads
+        )
+        result = round_rra(result)
+        saverra(result, outfile, outformat)
+    elif backend == 'binary':
+        rrainfile = infile
+        rraoutfile = outfile
+        if outformat != 'tsv':
+            rrainfile = infile + '.rra.txt'
+            rraoutfile = outfile + '.rra.txt'
+            write_table(pinput, rrainfile)
+        robustrank(
+            rrapath,
+            infile=rrainfile,
+            outfile=rraoutfile,
+            percentile=percentile,
+            threads=threads
+        )
+        result = read_rra(rraoutfile)
+        if outformat != 'tsv':
+            os.remove(rrainfile)
+            os.remove(rraoutfile)
+            saverra(result, outfile, outformat)
+    elif backend == 'python':
+        result = rra(
+            pdata['symbol'],
+            pdata['p'],
+            percentile=percentile,
+            cachedir=cachedir,
+            probs=pdata['prob'],
+            betatable=betatable
+        )
+        saverra(result, outfile, outformat)
+    else:
+        logging.error('RRA backend should be python, binary or extension.')
+        raise ValueError('Wrong RRA backend.')
+    return result
 
-    datanorm = pd.concat(
+# ------------------
+
+_helpdoc['rankaggregate_jobs'] = helpstring(
+    describe='',
+    parameterdicts={
+        'jobs': 'list, keyword arguments of each rankaggregate call.',
+        'workers': 'int, number of processes, default is 1 means running the jobs one by one.'
+    },
+    returns='list, pd.DataFrame results of the jobs, in the same order as jobs.',
+    examplecodelists=[
+        "rralow, rrahigh = rankaggregate_jobs(",
+        "    [lowkwargs, highkwargs],",
+        "    workers=2",
+        ")"
+    ]
+)
+
+@AppendHelp(_helpdoc['rankaggregate_jobs'], join='')
+def rankaggregate_jobs(jobs, workers=1):
+    '''
+    Run independent Robust Rank Aggregation jobs,
+    such as the lower and higher direction, in a process pool.
+    '''
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(
+                max_workers=min(workers, len(jobs)),
+                initializer=kernels.init_worker,
+                initargs=(kernels.get_backend(),)) as executor:
+            futures = [executor.submit(rankaggregate, **job) for job in jobs]
+            return [future.result() for future in futures]
+    return [rankaggregate(**job) for job in jobs]
+
+# ------------------
+
+_helpdoc['rankaggregate_second'] = helpstring(
+    describe='',
+    parameterdicts={
+        'rralow': 'pd.DataFrame, RRA result of guides in lower direction.',
+        'rrahigh': 'pd.DataFrame, RRA result of guides in higher direction.',
+        'files': 'dict, output file names made by outputfiles.',
+        'gene_test_threshold': 'numeric, FDR threshold of guides used in gene test.',
+        'rrakwargs': 'dict, keyword arguments of rankaggregate: rrapath, backend, cachedir, outformat, threads, betatable.',
+        'workers': 'int, number of processes, default is 1.'
+    },
+    returns='pd.DataFrame, merged gene level RRA results of both directions.',
+    examplecodelists=[
+        "mresult = rankaggregate_second(",
+        "    rralow, rrahigh, files, 0.25, {'backend': 'python'}",
+        ")"
+    ]
+)
+
+@AppendHelp(_helpdoc['rankaggregate_second'], join='')
+def rankaggregate_second(rralow, rrahigh, files, gene_test_threshold, rrakwargs, workers=1):
+    '''
+    Second round of Robust Rank Aggregation in two-rra mode,
+    ranking the guides (gene.guide) by their lo-value into genes.
+    '''
+    # low
+    plowout2 = rankinput(
+        rralow['group_id'],
+        rralow['group_id'].astype(str).str.split('.').str[0],
+        rralow['beta']
+    )
+    rra2percentilelow = (
+        rralow['FDR'] < gene_test_threshold
+    ).sum() / rralow['FDR'].size
+    # high
+    phighout2 = rankinput(
+        rrahigh['group_id'],
+        rrahigh['group_id'].astype(str).str.split('.').str[0],
+        rrahigh['beta']
+    )
+    rra2percentilehigh = (
+        rrahigh['FDR'] < gene_test_threshold
+    ).sum() / rrahigh['FDR'].size
+    rralow2, rrahigh2 = rankaggregate_jobs(
         [
-            inputdata[infocolnm],
-            df_normalization(inputdata, controlids + treatids, 'median')
+            dict(
+                pdata=plowout2,
+                infile=files['rra2_low_in'],
+                outfile=files['rra2_low_out'],
+                percentile=rra2percentilelow,
+                **rrakwargs
+            ),
+            dict(
+                pdata=phighout2,
+                infile=files['rra2_high_in'],
+                outfile=files['rra2_high_out'],
+                percentile=rra2percentilehigh,
+                **rrakwargs
+            )
         ],
-        axis=1
+        workers=workers
+    )
+    return pd.merge(
+        rralow2, rrahigh2, how='inner',
+        on=['group_id'], suffixes=['.low', '.high']
     )
 
-    datanorm.columns = infocolnm + controlids + treatids
+# ------------------
 
-    data = datanorm
+def rowcontrolstats(data, controlids, conlabels, k, b, floattype='float64'):
+    # controlmean, controlvar and, if k is not None, estvar of each row
+    stats = pd.DataFrame(index=data.index)
+    stats['controlmean'] = asfloat(df_geomean(data, controlids), floattype)
+    stats['controlvar'] = asfloat(df_rowvar(data, conlabels), floattype)
+    if k is not None:
+        stats['estvar'] = asfloat(df_estvar(stats, 'controlmean', k, b), floattype)
+    return stats
 
-    # linear regression
-    logging.info('Estimating parameters of mean and var of controls.')
+# ------------------
 
-    k, b = df_modelmeanvar(
-        data,
-        conlabels
-    )
+_helpdoc['rowmeanvar'] = helpstring(
+    describe='',
+    parameterdicts={
+        'data': 'pd.DataFrame, normalized data, the calculated columns are added in place.',
+        'controlids': 'list, column names of control data.',
+        'treatids': 'list, column names of treatment data.',
+        'conlabels': 'list, column names used to calculate the control variance.',
+        'k': 'numeric, k in Var = Mean + 2 ^ b * Mean ^ k, None means estvar is not calculated.',
+        'b': 'numeric, b in Var = Mean + 2 ^ b * Mean ^ k.',
+        'normthreshold': 'numeric, normalized counts larger than the threshold are considered large.',
+        'floattype': 'string, float64 or float32 for the calculated columns.',
+        'controlstats': 'pd.DataFrame, controlmean, controlvar and estvar already calculated for the controls, default is None.'
+    },
+    returns='pd.DataFrame, data with columns: controlmean, treatmean, controlvar, estvar, lfc, lfc_bin, large, direction.',
+    examplecodelists=[
+        "rowmeanvar(data, ['c1', 'c2'], ['t1', 't2'], ['c1', 'c2'], k, b)"
+    ]
+)
 
-    logging.info(
-        'Estimated: Var = Mean + {0:.2f} * Mean ^ {1:.2f}.'.format(
-            2 ** b, k
+@AppendHelp(_helpdoc['rowmeanvar'], join='')
+def rowmeanvar(data, controlids, treatids, conlabels, k, b,
+               normthreshold=10, floattype='float64', controlstats=None):
+    '''
+    Row wise means, variance, log2 fold change and direction
+    of the normalized data.
+    Each row is calculated separately, so the data can be a chunk.
+    The control statistics shared by comparisons with the same controls
+    can be given by controlstats, made by rowcontrolstats.
+    '''
+    if controlstats is None:
+        controlstats = rowcontrolstats(
+            data, controlids, conlabels, k, b, floattype=floattype
         )
-    )
-    # calculate mean and var
-    logging.info('Calculating means and variance of data.')
-
-    data['controlmean'] = df_geomean(data, controlids)
-    data['treatmean'] = df_geomean(data, treatids)
-    data['controlvar'] = data[conlabels].var(axis=1)
-    data['estvar'] = df_estvar(data, 'controlmean', k, b)
+    data['controlmean'] = controlstats['controlmean'].to_numpy()
+    data['treatmean'] = asfloat(df_geomean(data, treatids), floattype)
+    data['controlvar'] = controlstats['controlvar'].to_numpy()
+    if 'estvar' in controlstats.columns:
+        data['estvar'] = controlstats['estvar'].to_numpy()
 
     # log fold change
-    logging.info('Calculating guide log2 fold change.')
-
-    data['lfc'] = np.log2(
-        data['treatmean'] + 1.0
-    ) - np.log2(
-        data['controlmean'] + 1.0
-    )
+    lfc = np.log2(data['treatmean'].to_numpy() + 1.0)
+    lfc -= np.log2(data['controlmean'].to_numpy() + 1.0)
+    data['lfc'] = asfloat(lfc, floattype)
+    del lfc
 
     # lfc direction
-    data['lfc_bin'] = data['lfc'].map(
-        lambda x: 1 if x > -0.1 else 0
-    ) + data['lfc'].map(
-        lambda x: -1 if x < 0.1 else 0
-    )
+    data['lfc_bin'] = array_direction(data['lfc'].to_numpy())
 
     # large norm data
     data['large'] = (
@@ -167,134 +380,231 @@ def analysis(inputdata,
     data['direction'] = data['lfc_bin'].mul(
         data['large'], axis=0
     )
+    return data
 
-    if tworra:
-        hasbarcode = False
+# ------------------
 
-    # calculate adjusted variance
-    if hasbarcode:
-        logging.info('Adjusting variance of data in guide level.')
-        # aggregate variance
-        agg_guide_var = data[
-            ['guide', 'controlvar']
-        ].groupby('guide').mean()
-
-        agg_guide_samedirection = data[['guide', 'direction']].groupby(
-            'guide'
-        ).apply(
-            lambda x: max(x['direction']) * min(x['direction'])
+_helpdoc['rowzscore'] = helpstring(
+    describe='',
+    parameterdicts={
+        'data': 'pd.DataFrame, data with columns made by rowmeanvar, the calculated columns are added in place.',
+        'adjust_var': 'array like, variance added to estvar of each row, default is None means no adjustment.',
+        'test': 'string, test method, "norm" for normal test.',
+        'floattype': 'string, float64 or float32 for the calculated columns.'
+    },
+    returns='pd.DataFrame, data with columns: adjvar, treat_zscore, p.low, p.high, p.twoside.',
+    examplecodelists=[
+        "rowzscore(data, df_adjustvar(data, 'guide', 'controlvar', 'direction'))"
+    ]
+)
+
+@AppendHelp(_helpdoc['rowzscore'], join='')
+def rowzscore(data, adjust_var=None, test='norm', floattype='float64'):
+    '''
+    Row wise adjusted variance, z score of treatment mean and p values.
+    '''
+    if adjust_var is None:
+        data['adjvar'] = data['estvar']
+    else:
+        data['adjvar'] = asfloat(
+            data['estvar'].to_numpy() + np.asarray(adjust_var), floattype
         )
 
-        agg_guide_guidecount = data['guide'].value_counts()
+    theta = data['treatmean'].to_numpy() - data['controlmean'].to_numpy()
+    theta /= np.sqrt(data['adjvar'].to_numpy())
+    data['treat_zscore'] = asfloat(theta, floattype)
+    del theta
 
-        agg_guide = pd.DataFrame(
-            {
-                'controlvar': agg_guide_var['controlvar'],
-                'guidecount': agg_guide_guidecount[agg_guide_var.index],
-                'samedirection': agg_guide_samedirection[agg_guide_var.index] != -1
-            }
-        )
+    if test == 'norm':
+        plow, phigh, ptwoside = array_normtest(data['treat_zscore'].to_numpy())
+        data['p.low'] = asfloat(plow, floattype)
+        data['p.high'] = asfloat(phigh, floattype)
+        data['p.twoside'] = asfloat(ptwoside, floattype)
+    return data
 
-        # adjvar
-        adjust_var = agg_guide.loc[
-            data['guide'], 'controlvar'
-        ].mul(
-            (1 - agg_guide.loc[data['guide'], 'samedirection']),
-            axis=0
+# ------------------
+
+_helpdoc['stage_normalize'] = helpstring(
+    describe='',
+    parameterdicts={
+        'inputdata': 'pd.DataFrame, data read by readdata.',
+        'countids': 'list, column names of counts to normalize.',
+        'normmethod': 'string, median ratio normalization method, see df_normalization, default is "median".',
+        'floattype': 'string, float64 or float32 for the normalized columns, default is float64.'
+    },
+    returns='pd.DataFrame, columns: gene, guide, gid, barcode, bid, prob if read, and the normalized counts.',
+    examplecodelists=[
+        "data = stage_normalize(inputdata, ['c1', 'c2', 't1', 't2'])"
+    ]
+)
+
+@AppendHelp(_helpdoc['stage_normalize'], join='')
+@timedstage('normalize')
+def stage_normalize(inputdata, countids, normmethod='median', floattype='float64'):
+    '''
+    Normalization stage of analysis.
+    '''
+    logging.info('Normalizing data.')
+    # info columns are shared with inputdata, normalized counts are
+    # added column by column instead of concatenating frames
+    infocolnm = ['gene', 'guide', 'gid', 'barcode', 'bid']
+    if 'prob' in inputdata.columns:
+        infocolnm.append('prob')
+    data = inputdata[infocolnm].copy()
+    datanorm = df_normalization(inputdata, countids, normmethod)
+    for x in countids:
+        data[x] = datanorm[x].to_numpy(dtype=floattype)
+    del datanorm
+    return data
+
+# ------------------
+
+_helpdoc['stage_model'] = helpstring(
+    describe='',
+    parameterdicts={
+        'data': 'pd.DataFrame, normalized data.',
+        'conlabels': 'list, column names used to fit the mean variance model.'
+    },
+    returns='tuple, (k, b) of the Var = Mean + 2 ^ b * Mean ^ k.',
+    examplecodelists=[
+        "k, b = stage_model(data, ['c1', 'c2'])"
+    ]
+)
+
+@AppendHelp(_helpdoc['stage_model'], join='')
+@timedstage('model')
+def stage_model(data, conlabels):
+    '''
+    Mean variance model stage of analysis.
+    '''
+    logging.info('Estimating parameters of mean and var of controls.')
+    k, b = df_modelmeanvar(data, conlabels)
+    logging.info(
+        'Estimated: Var = Mean + {0:.2f} * Mean ^ {1:.2f}.'.format(
+            2 ** b, k
         )
-        adjust_var.index = data['guide'].index
-        data['adjvar'] = data['estvar'] + adjust_var
-    else:
-        data['adjvar'] = data['estvar']
+    )
+    return (k, b)
+
+# ------------------
+
+_helpdoc['stage_score'] = helpstring(
+    describe='',
+    parameterdicts={
+        'data': 'pd.DataFrame, normalized data, the calculated columns are added in place.',
+        'controlids': 'list, column names of control data.',
+        'treatids': 'list, column names of treatment data.',
+        'conlabels': 'list, column names used to calculate the control variance.',
+        'k': 'numeric, k in Var = Mean + 2 ^ b * Mean ^ k.',
+        'b': 'numeric, b in Var = Mean + 2 ^ b * Mean ^ k.',
+        'hasbarcode': 'bool, whether the variance is adjusted in guide level.',
+        'normthreshold': 'numeric, normalized counts larger than the threshold are considered large.',
+        'test': 'string, test method, "norm" for normal test.',
+        'floattype': 'string, float64 or float32 for the calculated columns.',
+        'controlstats': 'pd.DataFrame, controlmean, controlvar and estvar already calculated for the controls, default is None.'
+    },
+    returns='pd.DataFrame, data with the columns of rowmeanvar, rowzscore and fdr.',
+    examplecodelists=[
+        "stage_score(data, ['c1', 'c2'], ['t1', 't2'], ['c1', 'c2'], k, b)"
+    ]
+)
 
+@AppendHelp(_helpdoc['stage_score'], join='')
+@timedstage('score')
+def stage_score(data, controlids, treatids, conlabels, k, b,
+                hasbarcode=True, normthreshold=10, test='norm',
+                floattype='float64', controlstats=None):
+    '''
+    Scoring stage of analysis: means and variance, guide level
+    variance adjustment, z scores, p values and FDR.
+    '''
+    # calculate mean and var
+    logging.info('Calculating means and variance of data.')
+    rowmeanvar(
+        data, controlids, treatids, conlabels, k, b,
+        normthreshold=normthreshold, floattype=floattype,
+        controlstats=controlstats
+    )
+
+    # calculate adjusted variance
+    adjust_var = None
+    if hasbarcode:
+        logging.info('Adjusting variance of data in guide level.')
+        # mean variance of guides with barcodes in both directions
+        adjust_var = df_adjustvar(data, 'guide', 'controlvar', 'direction')
 
     # normalize treatment mean value
     logging.info('Normalizing treatment values.')
-    theta = (
-        data['treatmean'] - data['controlmean']
-    ).div(np.sqrt(data['adjvar']), axis=0)
+    rowzscore(data, adjust_var, test=test, floattype=floattype)
+    del adjust_var
 
-    data = data.assign(
-        treat_zscore=theta
-    )
+    data['fdr'] = array_fdr(data['p.twoside'].to_numpy())
+    return data
 
-    if test == 'norm':
-        data['p.low'] = data['treat_zscore'].map(norm.cdf)
-        data['p.high'] = data['treat_zscore'].map(norm.sf)
+# ------------------
 
-    data['p.twoside'] = data[['p.low', 'p.high']].apply(
-        lambda x: 2 * x['p.low'] if x['p.low'] < x['p.high'] else 2 * x['p.high'],
-        axis=1
-    )
-    data['fdr'] = array_fdr(data['p.twoside'])
-    data.to_csv(files['firstlevel'], index=False, sep='\t')
+_helpdoc['stage_rank'] = helpstring(
+    describe='',
+    parameterdicts={
+        'data': 'pd.DataFrame, data scored by stage_score.',
+        'files': 'dict, output file names made by outputfiles.',
+        'tworra': 'bool, using two cycles RRA for barcode analysis.',
+        'gene_test_threshold': 'numeric, p value threshold for alpha value of RRA in gene test.',
+        'rrakwargs': 'dict, keyword arguments of rankaggregate: rrapath, backend, cachedir, outformat, threads, betatable.',
+        'workers': 'int, number of processes to run the RRA of both directions concurrently, default is 1.'
+    },
+    returns='pd.DataFrame, merged gene level RRA results of both directions.',
+    examplecodelists=[
+        "mresult = stage_rank(data, files, False, 0.25, {'backend': 'python'})"
+    ]
+)
 
-    # fold change
-    foldchange = data.groupby(['gene'])['lfc'].mean().reset_index()
-    data['symbol'] = data['gene']
-    if tworra:
-        foldchange = data.groupby(['gene', 'guide'])['lfc'].mean().reset_index()
-        data['symbol'] = data['gid']
+@AppendHelp(_helpdoc['stage_rank'], join='')
+@timedstage('rank')
+def stage_rank(data, files, tworra, gene_test_threshold, rrakwargs, workers=1):
+    '''
+    Rank aggregation stage of analysis, Robust Rank Aggregation
+    of both directions, and the second round in two-rra mode.
+    With a prob column in data, the first round is the probability
+    weighted RRA.
+    '''
+    symbol = data['gid'] if tworra else data['gene']
+    prob = data['prob'] if 'prob' in data.columns else None
 
-    # prepare for Robust Rank Aggregation
-    pcolnm = ['sgrna', 'symbol', 'pool', 'p', 'prob', 'chosen']
     # lower direction
-    logging.info('Robust Rank Aggregation of lower direction data.')
-    plowout = pd.DataFrame(
-        {
-            'sgrna': data['bid'],
-            'symbol': data['symbol'],
-            'pool': ['list'] * data['gene'].size,
-            'p': data['treat_zscore'],
-            'prob': [1] * data['gene'].size,
-            'chosen': [1] * data['gene'].size
-        }
-    )
-
-    plowout[pcolnm].sort_values(
-        'p'
-    ).to_csv(files['rra_low_in'], index=False, sep='\t')
+    plowout = rankinput(data['bid'], symbol, data['treat_zscore'], prob)
 
     percentilelow = (
         data['p.low'] < gene_test_threshold
     ).sum() / data['p.low'].size
-    robustrank(
-        rrapath,
-        infile=files['rra_low_in'],
-        outfile=files['rra_low_out'],
-        percentile=percentilelow
-    )
-    rralow = read_rra(files['rra_low_out'])
-    # columns: group_id, items_in_group, beta, p, FDR, goodsgrna
 
     # higher direction
-    logging.info('Robust Rank Aggregation of higher direction data.')
-    phighout = pd.DataFrame(
-        {
-            'sgrna': data['bid'],
-            'symbol': data['symbol'],
-            'pool': ['list'] * data['gene'].size,
-            'p': data['treat_zscore'] * -1,
-            'prob': [1] * data['gene'].size,
-            'chosen': [1] * data['gene'].size
-        }
-    )
-
-    phighout[pcolnm].sort_values(
-        'p'
-    ).to_csv(files['rra_high_in'], index=False, sep='\t')
+    phighout = rankinput(data['bid'], symbol, data['treat_zscore'] * -1, prob)
 
     percentilehigh = (
         data['p.high'] < gene_test_threshold
     ).sum() / data['p.high'].size
 
-    robustrank(
-        rrapath,
-        infile=files['rra_high_in'],
-        outfile=files['rra_high_out'],
-        percentile=percentilehigh
+    logging.info('Robust Rank Aggregation of lower and higher direction data.')
+    rralow, rrahigh = rankaggregate_jobs(
+        [
+            dict(
+                pdata=plowout,
+                infile=files['rra_low_in'],
+                outfile=files['rra_low_out'],
+                percentile=percentilelow,
+                **rrakwargs
+            ),
+            dict(
+                pdata=phighout,
+                infile=files['rra_high_in'],
+                outfile=files['rra_high_out'],
+                percentile=percentilehigh,
+                **rrakwargs
+            )
+        ],
+        workers=workers
     )
-    rrahigh = read_rra(files['rra_high_out'])
     # columns: group_id, items_in_group, beta, p, FDR, goodsgrna
     mresult = pd.merge(
         rralow, rrahigh, how='inner',
@@ -302,59 +612,114 @@ def analysis(inputdata,
     )
 
     if tworra:
-        # low
-        plowout2 = pd.DataFrame(
-            {
-                'sgrna': rralow['group_id'],
-                'symbol': rralow['group_id'].str.split('.').map(lambda x: x[0]),
-                'pool': ['list'] * rralow['group_id'].size,
-                'p': rralow['beta'],
-                'prob': [1] * rralow['group_id'].size,
-                'chosen': [1] * rralow['group_id'].size,
-            }
+        mresult = rankaggregate_second(
+            rralow, rrahigh, files, gene_test_threshold, rrakwargs, workers
         )
-        plowout2[pcolnm].sort_values(
-            'p'
-        ).to_csv(files['rra2_low_in'], index=False, sep='\t')
+    return mresult
 
-        rra2percentilelow = (
-            rralow['FDR'] < gene_test_threshold
-        ).sum() / rralow['FDR'].size
-        robustrank(
-            rrapath,
-            infile=files['rra2_low_in'],
-            outfile=files['rra2_low_out'],
-            percentile=rra2percentilelow
-        )
-        rralow2 = read_rra(files['rra2_low_out'])
-        # high
-        phighout2 = pd.DataFrame(
-            {
-                'sgrna': rrahigh['group_id'],
-                'symbol': rrahigh['group_id'].str.split('.').map(lambda x: x[0]),
-                'pool': ['list'] * rrahigh['group_id'].size,
-                'p': rrahigh['beta'],
-                'prob': [1] * rrahigh['group_id'].size,
-                'chosen': [1] * rrahigh['group_id'].size,
-            }
-        )
-        plowout2[pcolnm].sort_values(
-            'p'
-        ).to_csv(files['rra2_high_in'], index=False, sep='\t')
-        rra2percentilehigh = (
-            rrahigh['FDR'] < gene_test_threshold
-        ).sum() / rrahigh['FDR'].size
-        robustrank(
-            rrapath,
-            infile=files['rra2_high_in'],
-            outfile=files['rra2_high_out'],
-            percentile=rra2percentilehigh
-        )
-        rrahigh2 = read_rra(files['rra2_high_out'])
-        mresult = pd.merge(
-            rralow2, rrahigh2, how='inner',
-            on=['group_id'], suffixes=['.low', '.high']
+# ------------------
+
+_helpdoc['analysis'] = helpstring(
+    describe='',
+    parameterdicts={
+        'inputdata': 'pd.DataFrame, data to process.',
+        'outprefix': 'string, output data name prefix.',
+        'controlids': 'list, column names of control data',
+        'treatids': 'list, column names of treatment data',
+        'hasbarcode': 'bool, whether the screening using barcode',
+        'normthreshold': 'numeric, threshold used in scoring, the normalized data less than the score will be punished.',
+        'test': 'string, test method, "norm" for normal test.',
+        'rrapath': 'string, path of RobustRankAggregation program.',
+        'rrabackend': 'string, "python" for the in process RRA, "binary" for the RRA program, "extension" for the RRA program core in process.',
+        'rracache': 'string, directory to cache the RRA permutation null, default is None.',
+        'rrathreads': 'int, number of threads of the RRA program permutation, default is 1.',
+        'rrabetatable': 'bool, interpolate the beta cdf in a cached table in the "python" RRA backend, see rra_betacdf, default is False.',
+        'workers': 'int, number of processes to run the RRA of both directions concurrently, default is 1.',
+        'outformat': 'string, format of the output tables, tsv, parquet or feather, default is tsv.',
+        'floattype': 'string, float64 or float32 for the calculated columns, float32 halves the memory, default is float64.',
+        'normmethod': 'string, median ratio normalization by "median", "median-partition" or "median-sketch", see df_normalization, default is "median".'
+    },
+    returns='No specific returns.',
+    examplecodelists=[
+        "analysis(",
+        "    inputdata,",
+        "    outprefix=outprefix,",
+        "    controlids=['control1', 'control2'],",
+        "    treatids=['treat1', 'treat2'],",
+        "    hasbarcode=True,",
+        "    normthreshold=10,",
+        "    test='norm',",
+        "    rrapath='RRA',",
+        "    rrabackend='python'",
+        ")"
+    ]
+)
+
+@AppendHelp(_helpdoc['analysis'], join='')
+def analysis(inputdata,
+             outprefix,
+             controlids,
+             treatids,
+             hasbarcode=True,
+             normthreshold=10,
+             gene_test_threshold=0.25,
+             test='norm',
+             tworra=False,
+             rrapath='RRA',
+             rrabackend='python',
+             rracache=None,
+             rrathreads=1,
+             rrabetatable=False,
+             workers=1,
+             outformat='tsv',
+             floattype='float64',
+             normmethod='median'):
+    '''
+    Pipeline function in testing of the CRISPR/Cas9 screening data.
+    '''
+    # output file names
+    files = outputfiles(outprefix, hasbarcode, tworra, outformat)
+
+    # make the labels for all consider counts columns in calculation
+    conlabels = controlids + treatids
+    if (len(controlids) > 1):
+        conlabels = controlids
+
+    # normalization
+    data = stage_normalize(inputdata, controlids + treatids, normmethod, floattype)
+
+    # linear regression
+    k, b = stage_model(data, conlabels)
+
+    if tworra:
+        hasbarcode = False
+
+    # z scores and p values
+    stage_score(
+        data, controlids, treatids, conlabels, k, b,
+        hasbarcode=hasbarcode, normthreshold=normthreshold,
+        test=test, floattype=floattype
+    )
+    write_table(data, files['firstlevel'], outformat)
+
+    # prepare for Robust Rank Aggregation
+    rrakwargs = {
+        'rrapath': rrapath,
+        'backend': rrabackend,
+        'cachedir': rracache,
+        'outformat': outformat,
+        'threads': rrathreads,
+        'betatable': rrabetatable
+    }
+    mresult = stage_rank(
+        data, files, tworra, gene_test_threshold, rrakwargs, workers
+    )
+    memory, childmemory = peak_rss()
+    logging.info(
+        'Peak memory: {0:.1f} MB, child processes: {1:.1f} MB.'.format(
+            memory, childmemory
         )
+    )
     return mresult
 
 
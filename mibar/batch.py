@@ -0,0 +1,194 @@
+#! /bin/env python3
+# ------------------
+# Library
+# ------------------
+
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from .decorator import helpstring
+from .decorator import AppendHelp
+from . import kernels
+from .programio import write_table
+from .analysis import outputfiles
+from .analysis import rowcontrolstats
+from .analysis import stage_normalize
+from .analysis import stage_model
+from .analysis import stage_score
+from .analysis import stage_rank
+from .sysrun import peak_rss
+from .report import stagetimer
+
+# ------------------
+# Function
+# ------------------
+
+def comparisonjob(data, name, controlids, treatids, conlabels, k, b,
+                  controlstats, outprefix, hasbarcode, normthreshold,
+                  gene_test_threshold, test, tworra, rrakwargs, floattype):
+    # scoring and rank aggregation stages of one comparison
+    logging.info('Comparison {0:s}.'.format(name))
+    files = outputfiles(
+        outprefix + '.' + name, hasbarcode, tworra, rrakwargs['outformat']
+    )
+    stage_score(
+        data, controlids, treatids, conlabels, k, b,
+        hasbarcode=hasbarcode and not tworra, normthreshold=normthreshold,
+        test=test, floattype=floattype, controlstats=controlstats
+    )
+    write_table(data, files['firstlevel'], rrakwargs['outformat'])
+    return stage_rank(data, files, tworra, gene_test_threshold, rrakwargs)
+
+# ------------------
+
+_helpdoc = dict()
+
+_helpdoc['batchanalysis'] = helpstring(
+    describe='',
+    parameterdicts={
+        'inputdata': 'pd.DataFrame, data read by readdata with all the columns in comparisons.',
+        'comparisons': 'list, (name, controlids, treatids) of each comparison, see read_manifest.',
+        'outprefix': 'string, output data name prefix, the outputs of each comparison are prefixed by outprefix.name.',
+        'hasbarcode': 'bool, whether the screening using barcode.',
+        'normthreshold': 'numeric, threshold used in scoring, the normalized data less than the score will be punished.',
+        'gene_test_threshold': 'numeric, p value threshold for alpha value of RRA in gene test.',
+        'test': 'string, test method, "norm" for normal test.',
+        'tworra': 'bool, using two cycles RRA for barcode analysis.',
+        'rrapath': 'string, path of RobustRankAggregation program.',
+        'rrabackend': 'string, "python" for the in process RRA, "binary" for the RRA program, "extension" for the RRA program core in process.',
+        'rracache': 'string, directory to cache the RRA permutation null, default is None.',
+        'rrathreads': 'int, number of threads of the RRA program permutation, default is 1.',
+        'rrabetatable': 'bool, interpolate the beta cdf in a cached table in the "python" RRA backend, see rra_betacdf, default is False.',
+        'workers': 'int, number of processes to run the comparisons concurrently, default is 1.',
+        'outformat': 'string, format of the output tables, tsv, parquet or feather, default is tsv.',
+        'floattype': 'string, float64 or float32 for the calculated columns, default is float64.',
+        'normmethod': 'string, median ratio normalization method, see df_normalization, default is "median".'
+    },
+    returns='dict, merged gene level RRA results of both directions of each comparison name.',
+    examplecodelists=[
+        "results = batchanalysis(",
+        "    inputdata,",
+        "    read_manifest('comparisons.txt'),",
+        "    outprefix,",
+        "    hasbarcode=True,",
+        "    workers=4",
+        ")"
+    ]
+)
+
+@AppendHelp(_helpdoc['batchanalysis'], join='')
+def batchanalysis(inputdata,
+                  comparisons,
+                  outprefix,
+                  hasbarcode=True,
+                  normthreshold=10,
+                  gene_test_threshold=0.25,
+                  test='norm',
+                  tworra=False,
+                  rrapath='RRA',
+                  rrabackend='python',
+                  rracache=None,
+                  rrathreads=1,
+                  rrabetatable=False,
+                  workers=1,
+                  outformat='tsv',
+                  floattype='float64',
+                  normmethod='median'):
+    '''
+    Analysis of several comparisons of the same count table.
+    All the columns of the comparisons are normalized together once,
+    the mean variance model and control statistics are calculated once
+    for each set of controls, then the scoring and rank aggregation
+    of the comparisons are run in a process pool.
+    The model is fitted on the controls when there are more than one
+    control, otherwise on the control and treatments of each comparison
+    as analysis does.
+    Because of the normalization of all columns together, results can
+    differ slightly from the analysis of each comparison alone.
+    '''
+    countids = list()
+    for name, controlids, treatids in comparisons:
+        for x in controlids + treatids:
+            if x not in countids:
+                countids.append(x)
+    infocolnm = ['gene', 'guide', 'gid', 'barcode', 'bid']
+    if 'prob' in inputdata.columns:
+        infocolnm.append('prob')
+
+    # normalization
+    data = stage_normalize(inputdata, countids, normmethod, floattype)
+    logging.info(
+        'Data with {0:d} comparisons, {1:d} columns, {2:d} guide RNAs'.format(
+            len(comparisons), len(countids), data.shape[0]
+        )
+    )
+
+    rrakwargs = {
+        'rrapath': rrapath,
+        'backend': rrabackend,
+        'cachedir': rracache,
+        'outformat': outformat,
+        'threads': rrathreads,
+        'betatable': rrabetatable
+    }
+    models = dict()
+    controlstats = dict()
+    jobs = list()
+    for name, controlids, treatids in comparisons:
+        conlabels = controlids + treatids
+        if (len(controlids) > 1):
+            conlabels = controlids
+        # mean variance model and control statistics of each set of controls
+        modelkey = tuple(conlabels)
+        if modelkey not in models:
+            models[modelkey] = stage_model(data, conlabels)
+        k, b = models[modelkey]
+        statkey = (tuple(controlids), modelkey)
+        if statkey not in controlstats:
+            controlstats[statkey] = rowcontrolstats(
+                data, controlids, conlabels, k, b, floattype=floattype
+            )
+        jobs.append(
+            dict(
+                data=data[infocolnm + controlids + treatids],
+                name=name,
+                controlids=controlids,
+                treatids=treatids,
+                conlabels=conlabels,
+                k=k,
+                b=b,
+                controlstats=controlstats[statkey],
+                outprefix=outprefix,
+                hasbarcode=hasbarcode,
+                normthreshold=normthreshold,
+                gene_test_threshold=gene_test_threshold,
+                test=test,
+                tworra=tworra,
+                rrakwargs=rrakwargs,
+                floattype=floattype
+            )
+        )
+
+    # the stages run in the process pool are recorded as a whole
+    with stagetimer('comparisons', rows=data.shape[0]) as record:
+        record['comparisons'] = len(jobs)
+        if workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(
+                    max_workers=min(workers, len(jobs)),
+                    initializer=kernels.init_worker,
+                    initargs=(kernels.get_backend(),)) as executor:
+                futures = [executor.submit(comparisonjob, **job) for job in jobs]
+                results = [future.result() for future in futures]
+        else:
+            results = [comparisonjob(**job) for job in jobs]
+    memory, childmemory = peak_rss()
+    logging.info(
+        'Peak memory: {0:.1f} MB, child processes: {1:.1f} MB.'.format(
+            memory, childmemory
+        )
+    )
+    return dict(zip([x[0] for x in comparisons], results))
+
+# ------------------
+# EOF
+# ------------------
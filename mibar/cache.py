@@ -0,0 +1,230 @@
+#! /bin/env python3
+# ------------------
+# Library
+# ------------------
+
+import pandas as pd
+import numpy as np
+import logging
+import hashlib
+import json
+import zipfile
+import os
+import shutil
+
+from .decorator import helpstring
+from .decorator import AppendHelp
+
+# ------------------
+# Function
+# ------------------
+
+# version of the cache file layout, part of every key
+_CACHEVERSION = 2
+
+def filehash(filepath, blocksize=1 << 20):
+    # sha256 of the content of the file
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# ------------------
+
+def programkey(programpath):
+    # sha256 of the program found by programpath, or the path itself
+    # when it is not found
+    found = programpath
+    if not os.path.isfile(found):
+        found = shutil.which(programpath)
+    if found is None:
+        return programpath
+    return filehash(found)
+
+# ------------------
+
+def stagekey(parent, stage, params):
+    # key of a stage artifact, chained to the key of the stage it depends on
+    content = json.dumps(
+        {
+            'version': _CACHEVERSION,
+            'parent': parent,
+            'stage': stage,
+            'params': params
+        },
+        sort_keys=True
+    )
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+# ------------------
+
+def inputkey(filepath, selection):
+    # key of an input file content and the column selection
+    return stagekey(filehash(filepath), 'input', selection)
+
+# ------------------
+
+def utf8array(values):
+    # strings joined into one utf-8 buffer
+    return np.frombuffer('\n'.join(values).encode('utf-8'), dtype=np.uint8)
+
+# ------------------
+
+def frame_to_arrays(data, prefix):
+    # numpy arrays of the columns of data, categorical and string columns
+    # as codes and the categories joined into one utf-8 buffer
+    arrays = dict()
+    arrays[prefix + 'columns'] = np.array(list(data.columns), dtype=str)
+    for i, x in enumerate(data.columns):
+        name = '{0:s}{1:d}'.format(prefix, i)
+        column = data[x]
+        if not isinstance(column.dtype, pd.CategoricalDtype) and (
+                column.dtype == object or pd.api.types.is_string_dtype(column.dtype)):
+            column = column.astype(str).astype('category')
+            arrays[name + '.strings'] = np.array(True)
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            categories = column.cat.categories.astype(str)
+            arrays[name + '.codes'] = column.cat.codes.to_numpy()
+            arrays[name + '.categories'] = utf8array(categories)
+            arrays[name + '.ncategories'] = np.array(len(categories))
+        else:
+            arrays[name] = column.to_numpy()
+    return arrays
+
+# ------------------
+
+def arrays_to_frame(arrays, prefix):
+    # pd.DataFrame made by frame_to_arrays
+    data = dict()
+    for i, x in enumerate(arrays[prefix + 'columns']):
+        name = '{0:s}{1:d}'.format(prefix, i)
+        if name + '.codes' in arrays:
+            categories = list()
+            if int(arrays[name + '.ncategories']) > 0:
+                categories = arrays[name + '.categories'].tobytes().decode('utf-8').split('\n')
+            data[str(x)] = pd.Categorical.from_codes(
+                arrays[name + '.codes'], categories=categories
+            )
+            if name + '.strings' in arrays:
+                data[str(x)] = np.asarray(data[str(x)], dtype=object)
+        else:
+            data[str(x)] = arrays[name]
+    return pd.DataFrame(data)
+
+# ------------------
+
+_helpdoc = dict()
+
+_helpdoc['AnalysisCache'] = helpstring(
+    describe='',
+    parameterdicts={
+        'cachedir': 'string, directory of the cache files.',
+        'maxsize': 'numeric, maximum total size of the cache files in MB, default is 1024.'
+    },
+    returns='AnalysisCache, the on disk cache.',
+    examplecodelists=[
+        "cache = AnalysisCache('mibar_cache', maxsize=4096)",
+        "key = stagekey(inputkey('count.csv', selection), 'normalize', params)",
+        "artifact = cache.load(key)",
+        "if artifact is None:",
+        "    artifact = {'data': stage_normalize(...)}",
+        "    cache.save(key, artifact)"
+    ]
+)
+
+@AppendHelp(_helpdoc['AnalysisCache'], join='')
+class AnalysisCache:
+    '''
+    On disk cache of the artifacts of analysis stages.
+    An artifact is a dict of pd.DataFrame, numeric or bytes values,
+    keyed by stagekey, and saved as an uncompressed npz file
+    without pickled objects.
+    Entries are touched when loaded, and the least recently used entries
+    are removed when the total size is larger than maxsize.
+    An artifact larger than maxsize is not saved, with a warning.
+    '''
+    def __init__(self, cachedir, maxsize=1024):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+
+    def filename(self, key):
+        return os.path.join(self.cachedir, 'mibar.{0:s}.npz'.format(key))
+
+    def exists(self, key):
+        return os.path.isfile(self.filename(key))
+
+    def load(self, key):
+        filename = self.filename(key)
+        if not os.path.isfile(filename):
+            return None
+        try:
+            with np.load(filename, allow_pickle=False) as f:
+                arrays = {x: f[x] for x in f.files}
+            artifact = dict()
+            for x in arrays['frames']:
+                artifact[str(x)] = arrays_to_frame(arrays, 'frame.{0:s}.'.format(x))
+            for x in arrays['scalars']:
+                artifact[str(x)] = arrays['scalar.' + x].item()
+            for x in arrays['bytes']:
+                artifact[str(x)] = arrays['bytes.' + x].tobytes()
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            logging.warning('Broken cache file removed: {0:s}'.format(filename))
+            os.remove(filename)
+            return None
+        os.utime(filename)
+        return artifact
+
+    def save(self, key, artifact, label=None):
+        # save the artifact, return False if it is larger than maxsize,
+        # label names the artifact in the warning
+        os.makedirs(self.cachedir, exist_ok=True)
+        arrays = dict()
+        names = {'frames': list(), 'scalars': list(), 'bytes': list()}
+        for x, value in artifact.items():
+            if isinstance(value, pd.DataFrame):
+                names['frames'].append(x)
+                arrays.update(frame_to_arrays(value, 'frame.{0:s}.'.format(x)))
+            elif isinstance(value, bytes):
+                names['bytes'].append(x)
+                arrays['bytes.' + x] = np.frombuffer(value, dtype=np.uint8)
+            else:
+                names['scalars'].append(x)
+                arrays['scalar.' + x] = np.array(value)
+        for x in names:
+            arrays[x] = np.array(names[x], dtype=str)
+        filename = self.filename(key)
+        tmpfile = '{0}.{1:d}.tmp.npz'.format(filename[:-4], os.getpid())
+        np.savez(tmpfile, **arrays)
+        size = os.path.getsize(tmpfile)
+        if size > self.maxsize * 1024 * 1024:
+            os.remove(tmpfile)
+            logging.warning(
+                'Cache entry {0:s} of {1:.1f} MB is larger than the cache size {2:g} MB, not cached.'.format(
+                    key if label is None else label, size / 1024 / 1024, self.maxsize
+                )
+            )
+            return False
+        os.replace(tmpfile, filename)
+        self.evict()
+        return True
+
+    def evict(self):
+        # remove least recently used entries until the cache fits maxsize
+        entries = list()
+        for x in os.listdir(self.cachedir):
+            if x.startswith('mibar.') and x.endswith('.npz') and '.tmp.' not in x:
+                stat = os.stat(os.path.join(self.cachedir, x))
+                entries.append((stat.st_mtime, stat.st_size, x))
+        entries.sort()
+        total = sum(x[1] for x in entries)
+        for mtime, size, x in entries:
+            if total <= self.maxsize * 1024 * 1024:
+                break
+            os.remove(os.path.join(self.cachedir, x))
+            total -= size
+            logging.info('Cache entry evicted: {0:s}'.format(x))
+
+# ------------------
+# EOF
+# ------------------
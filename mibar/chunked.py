@@ -0,0 +1,419 @@
+#! /bin/env python3
+# ------------------
+# Library
+# ------------------
+
+import pandas as pd
+import numpy as np
+import logging
+
+from .decorator import helpstring
+from .decorator import AppendHelp
+from .dfcalculate import df_geomean
+from .dfcalculate import df_rowvar
+from .dfcalculate import array_fdr
+from .dfcalculate import QuantileSketch
+from . import kernels
+from .programio import readchunks
+from .programio import TableWriter
+from .analysis import outputfiles
+from .analysis import rowmeanvar
+from .analysis import rowzscore
+from .analysis import saverra
+from .analysis import rankaggregate_second
+from .rra import rra
+from .sysrun import peak_rss
+from .report import stagetimer
+
+# ------------------
+# Function
+# ------------------
+
+class Codebook:
+    '''
+    Integer codes of labels met chunk by chunk,
+    labels not met before get the next codes.
+    '''
+    def __init__(self):
+        self.codes = dict()
+
+    def __len__(self):
+        return len(self.codes)
+
+    def encode(self, values):
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        mapping = np.fromiter(
+            (self.codes.setdefault(x, len(self.codes)) for x in uniques),
+            dtype=np.int64, count=len(uniques)
+        )
+        return mapping[codes]
+
+    def labels(self):
+        return np.asarray(list(self.codes), dtype=object)
+
+# ------------------
+
+def grow(array, size):
+    # pad array with zeros to size
+    if array.size >= size:
+        return array
+    return np.concatenate([array, np.zeros(size - array.size, dtype=array.dtype)])
+
+# ------------------
+
+def preparechunk(chunk, genelab, guidelab, barcodelab, controlids, treatids, hasbarcode):
+    # columns and ids of a chunk as readdata
+    if hasbarcode:
+        colnm1 = [genelab, guidelab, barcodelab] + controlids + treatids
+    else:
+        colnm1 = [genelab, guidelab, guidelab] + controlids + treatids
+    data = chunk[colnm1]
+    data.columns = ['gene', 'guide', 'barcode'] + controlids + treatids
+    data = data.reset_index(drop=True)
+    data.insert(2, 'gid', data['gene'].str.cat(data['guide'], sep='.'))
+    if hasbarcode:
+        data.insert(4, 'bid', data['gid'].str.cat(data['barcode'], sep='.'))
+    else:
+        data.insert(4, 'bid', data['gid'])
+    for x in controlids:
+        data.loc[data[x] == 0, x] = 1
+    return data
+
+# ------------------
+
+class NormalizationStats:
+    '''
+    Statistics of median ratio and total count normalization
+    accumulated chunk by chunk, see df_normalization.
+    The ratios to the row geometric mean are counted in a QuantileSketch
+    of each column, so that the memory does not grow with the rows.
+    '''
+    def __init__(self, label):
+        self.label = label
+        self.rows = 0
+        self.colsum = pd.Series(0.0, index=label)
+        self.zeros = pd.Series(0, index=label)
+        self.ratios = {x: QuantileSketch() for x in label}
+
+    def add(self, dat):
+        self.rows += dat.shape[0]
+        self.colsum += dat[self.label].sum(axis=0)
+        self.zeros += (dat[self.label] == 0).sum(axis=0)
+        meanfactor = kernels.medianratio(dat[self.label].to_numpy())
+        for i, x in enumerate(self.label):
+            self.ratios[x].add(meanfactor[:, i])
+
+    def median(self):
+        median = [self.ratios[x].median() for x in self.label]
+        return pd.Series(median, index=self.label, dtype=np.float64)
+
+    def normfactor(self):
+        normfactor = self.colsum.sum() / len(self.label) / self.colsum
+        medianfactor = 1 / self.median()
+        if (medianfactor == 0).any():
+            logging.warning('Median factor is zero, using total count normalization')
+        elif (self.zeros / self.rows > 0.45).any():
+            logging.warning('Too many zeros in counts, using total count normalization')
+        else:
+            normfactor = medianfactor
+        return normfactor
+
+# ------------------
+
+class ModelStats:
+    '''
+    Sums of the weighted least square in df_modelmeanvar
+    accumulated chunk by chunk.
+    '''
+    def __init__(self, label):
+        self.label = label
+        self.rows = 0
+        self.sums = np.zeros(5)
+
+    def add(self, dat):
+        self.rows += dat.shape[0]
+        datgm = df_geomean(dat, self.label)
+        datvar = df_rowvar(dat, self.label)
+        goodidx = (datgm < datvar).to_numpy()
+        gm = datgm.to_numpy()[goodidx]
+        lgm = np.log2(gm + 1)
+        lvar = np.log2(datvar.to_numpy()[goodidx] - gm + 1)
+        nw, sx, sy, sx2, sxy = kernels.leastsquare(lgm, lvar, gm)
+        self.sums += [nw, sy, sx, sx2, sxy]
+
+    def model(self):
+        # same as df_leastsquare with weight and df_modelmeanvar
+        nw, sy, sx, sx2, sxy = self.sums
+        a = (sy * sx2 - sx * sxy) / (nw * sx2 - sx * sx)
+        b = (nw * sxy - sx * sy) / (nw * sx2 - sx * sx)
+        return (max(b, 1), max(a, 0))
+
+# ------------------
+
+class GuideStats:
+    '''
+    Mean control variance and directions of barcodes of each guide
+    accumulated chunk by chunk, see df_adjustvar.
+    '''
+    def __init__(self):
+        self.guides = Codebook()
+        self.varsum = np.zeros(0)
+        self.count = np.zeros(0)
+        self.down = np.zeros(0)
+        self.up = np.zeros(0)
+        self.adjust = None
+
+    def add(self, dat):
+        codes = self.guides.encode(dat['guide'])
+        n = len(self.guides)
+        direction = dat['direction'].to_numpy()
+        self.varsum = grow(self.varsum, n) + np.bincount(
+            codes, weights=dat['controlvar'].to_numpy(), minlength=n
+        )
+        self.count = grow(self.count, n) + np.bincount(codes, minlength=n)
+        self.down = grow(self.down, n) + np.bincount(
+            codes, weights=direction == -1, minlength=n
+        )
+        self.up = grow(self.up, n) + np.bincount(
+            codes, weights=direction == 1, minlength=n
+        )
+
+    def adjustment(self):
+        samedirection = ~((self.down > 0) & (self.up > 0))
+        self.adjust = self.varsum / self.count * (1 - samedirection)
+
+    def lookup(self, dat):
+        return self.adjust[self.guides.encode(dat['guide'])]
+
+# ------------------
+
+_helpdoc = dict()
+
+_helpdoc['chunkanalysis'] = helpstring(
+    describe='',
+    parameterdicts={
+        'filepath': 'string, the input count table, csv, tsv (txt) or parquet, csv and tsv can be compressed.',
+        'outprefix': 'string, output data name prefix.',
+        'controlids': 'list, column names of control data.',
+        'treatids': 'list, column names of treatment data.',
+        'genelab': 'string, the column name of gene.',
+        'guidelab': 'string, the column name of guide.',
+        'barcodelab': 'string, the column name of barcode.',
+        'hasbarcode': 'bool, whether the screening using barcode.',
+        'normthreshold': 'numeric, threshold used in scoring, the normalized data less than the score will be punished.',
+        'gene_test_threshold': 'numeric, p value threshold for alpha value of RRA in gene test.',
+        'test': 'string, test method, "norm" for normal test.',
+        'tworra': 'bool, using two cycles RRA for barcode analysis.',
+        'rracache': 'string, directory to cache the RRA permutation null, default is None.',
+        'rrabetatable': 'bool, interpolate the beta cdf of RRA in a cached table, see rra_betacdf, default is False.',
+        'workers': 'int, number of processes to run the second round RRA of both directions concurrently, default is 1.',
+        'outformat': 'string, format of the output tables, tsv or parquet, default is tsv.',
+        'normmethod': 'string, median ratio normalization method, only "median-sketch" which keeps a fixed size of memory instead of the ratios of all rows, default is "median-sketch".',
+        'chunksize': 'int, number of rows read at once, default is 1000000.'
+    },
+    returns='pd.DataFrame, merged gene level RRA results of both directions.',
+    examplecodelists=[
+        "chunkanalysis(",
+        "    'count.csv.gz',",
+        "    outprefix,",
+        "    controlids=['control1', 'control2'],",
+        "    treatids=['treat1', 'treat2'],",
+        "    hasbarcode=True,",
+        "    chunksize=1000000",
+        ")"
+    ]
+)
+
+@AppendHelp(_helpdoc['chunkanalysis'], join='')
+def chunkanalysis(filepath,
+                  outprefix,
+                  controlids,
+                  treatids,
+                  genelab='gene',
+                  guidelab='guide',
+                  barcodelab='barcode',
+                  hasbarcode=True,
+                  normthreshold=10,
+                  gene_test_threshold=0.25,
+                  test='norm',
+                  tworra=False,
+                  rracache=None,
+                  rrabetatable=False,
+                  workers=1,
+                  outformat='tsv',
+                  normmethod='median-sketch',
+                  chunksize=1000000):
+    '''
+    Out of core version of analysis for count tables larger than memory.
+    The input file is read by chunks in four passes:
+        1. statistics of normalization factors;
+        2. weighted least square sums of the mean variance model and
+           guide level variance and directions;
+        3. z scores, two sided p values and RRA groups of each row,
+           kept as compact arrays;
+        4. rows with FDR, written chunk by chunk.
+    Only one chunk of rows and a few arrays of one value per row are kept
+    in memory. RRA is run in process, the RRA input tables are not written.
+    Results are the same as analysis with the same normmethod
+    up to floating point rounding.
+    '''
+    if outformat not in ['tsv', 'parquet']:
+        logging.error('Output format should be tsv or parquet in chunked analysis.')
+        raise ValueError('Wrong output format.')
+    if normmethod != 'median-sketch':
+        logging.error('Median method should be median-sketch in chunked analysis.')
+        raise ValueError('Wrong median method.')
+    files = outputfiles(outprefix, hasbarcode, tworra, outformat)
+    readbarcode = hasbarcode or tworra
+    if tworra:
+        hasbarcode = False
+
+    conlabels = controlids + treatids
+    if (len(controlids) > 1):
+        conlabels = controlids
+
+    def chunks():
+        idcolumns = [genelab, guidelab]
+        if readbarcode:
+            idcolumns.append(barcodelab)
+        for chunk in readchunks(filepath, idcolumns, controlids + treatids, chunksize):
+            yield preparechunk(
+                chunk, genelab, guidelab, barcodelab,
+                controlids, treatids, readbarcode
+            )
+
+    def normalized(data):
+        data[controlids + treatids] = data[controlids + treatids].mul(
+            normfactor, axis=1
+        )
+        return data
+
+    # pass 1: normalization
+    logging.info('Normalizing data by chunks: {0:s}.'.format(filepath))
+    with stagetimer('chunk.normalize') as record:
+        normstats = NormalizationStats(controlids + treatids)
+        for data in chunks():
+            normstats.add(data)
+        record['rows'] = normstats.rows
+    normfactor = normstats.normfactor()
+    logging.info(
+        'Data with {0:d} Controls, {1:d} Treatments,'.format(
+            len(controlids), len(treatids)
+        ) + ' {0:d} guide RNAs'.format(normstats.rows)
+    )
+    del normstats
+
+    # pass 2: mean variance model and guide level statistics
+    logging.info('Estimating parameters of mean and var of controls.')
+    with stagetimer('chunk.model') as record:
+        modelstats = ModelStats(conlabels)
+        guidestats = GuideStats()
+        for data in chunks():
+            data = normalized(data)
+            modelstats.add(data)
+            if hasbarcode:
+                rowmeanvar(
+                    data, controlids, treatids, conlabels, None, None,
+                    normthreshold=normthreshold
+                )
+                guidestats.add(data)
+        record['rows'] = modelstats.rows
+    k, b = modelstats.model()
+    logging.info(
+        'Estimated: Var = Mean + {0:.2f} * Mean ^ {1:.2f}.'.format(
+            2 ** b, k
+        )
+    )
+    if hasbarcode:
+        guidestats.adjustment()
+
+    def scored(data):
+        data = normalized(data)
+        rowmeanvar(
+            data, controlids, treatids, conlabels, k, b,
+            normthreshold=normthreshold
+        )
+        adjust_var = guidestats.lookup(data) if hasbarcode else None
+        return rowzscore(data, adjust_var, test=test)
+
+    # pass 3: z scores and p values
+    logging.info('Calculating z scores by chunks.')
+    with stagetimer('chunk.score') as record:
+        groups = Codebook()
+        groupcodes = list()
+        zscores = list()
+        ptwosides = list()
+        lowcount = 0
+        highcount = 0
+        for data in chunks():
+            data = scored(data)
+            groupcodes.append(groups.encode(data['gid' if tworra else 'gene']))
+            zscores.append(data['treat_zscore'].to_numpy())
+            ptwosides.append(data['p.twoside'].to_numpy())
+            lowcount += (data['p.low'] < gene_test_threshold).sum()
+            highcount += (data['p.high'] < gene_test_threshold).sum()
+        record['rows'] = sum(x.size for x in groupcodes)
+    groupcodes = np.concatenate(groupcodes)
+    zscores = np.concatenate(zscores)
+    fdr = array_fdr(np.concatenate(ptwosides))
+    del ptwosides
+
+    # pass 4: write rows with fdr
+    logging.info('Writing results by chunks: {0:s}.'.format(files['firstlevel']))
+    with stagetimer('chunk.write') as record:
+        writer = TableWriter(files['firstlevel'], outformat)
+        start = 0
+        for data in chunks():
+            data = scored(data)
+            data['fdr'] = fdr[start:(start + data.shape[0])]
+            start += data.shape[0]
+            writer.write(data)
+        writer.close()
+        record['rows'] = start
+    del fdr
+
+    # Robust Rank Aggregation of lower and higher direction
+    logging.info('Robust Rank Aggregation of lower and higher direction data.')
+    labels = groups.labels()
+    with stagetimer('chunk.rank', rows=zscores.size):
+        rraresults = list()
+        for values, count, outfile in [
+                (zscores, lowcount, files['rra_low_out']),
+                (zscores * -1, highcount, files['rra_high_out'])]:
+            result = rra(
+                groupcodes, values,
+                percentile=count / zscores.size,
+                cachedir=rracache,
+                betatable=rrabetatable
+            )
+            result['group_id'] = labels[result['group_id'].to_numpy()]
+            saverra(result, outfile, outformat)
+            rraresults.append(result)
+    rralow, rrahigh = rraresults
+    del groupcodes, zscores
+
+    mresult = pd.merge(
+        rralow, rrahigh, how='inner',
+        on=['group_id'], suffixes=['.low', '.high']
+    )
+    if tworra:
+        rrakwargs = {
+            'backend': 'python',
+            'cachedir': rracache,
+            'outformat': outformat,
+            'betatable': rrabetatable
+        }
+        mresult = rankaggregate_second(
+            rralow, rrahigh, files, gene_test_threshold, rrakwargs, workers
+        )
+    memory, childmemory = peak_rss()
+    logging.info(
+        'Peak memory: {0:.1f} MB, child processes: {1:.1f} MB.'.format(
+            memory, childmemory
+        )
+    )
+    return mresult
+
+# ------------------
+# EOF
+# ------------------
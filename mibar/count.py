@@ -0,0 +1,479 @@
+#! /bin/env python3
+# ------------------
+# Library
+# ------------------
+
+import pandas as pd
+import numpy as np
+import gzip
+import logging
+import os
+from itertools import islice
+from multiprocessing import Pool
+
+from .decorator import helpstring
+from .decorator import AppendHelp
+from .library import LibraryIndex
+
+# ------------------
+# Function
+# ------------------
+
+_COMPLEMENT = bytes.maketrans(b'ATGCN', b'TACGN')
+
+# ------------------
+
+def reverse_complement(seq):
+    # reverse complement of a bytes sequence
+    return seq.translate(_COMPLEMENT)[::-1]
+
+# ------------------
+
+def isbase(seq):
+    # whether the bytes sequence only contains A, T, G, C
+    return not seq.translate(None, b'ATGC')
+
+# ------------------
+
+def open_fastq(filepath):
+    # open plain or gzip compressed fastq file in binary mode
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, 'rb')
+    else:
+        return open(filepath, 'rb')
+
+# ------------------
+
+def fastq_pairs(fq1, fq2):
+    # generator of the paired sequences of two fastq files
+    with open_fastq(fq1) as f1, open_fastq(fq2) as f2:
+        for seq1, seq2 in zip(islice(f1, 1, None, 4), islice(f2, 1, None, 4)):
+            yield (seq1.rstrip(), seq2.rstrip())
+
+# ------------------
+
+def fastq_chunks(fq1, fq2, chunksize):
+    # generator of record aligned chunks of paired sequences
+    pairs = fastq_pairs(fq1, fq2)
+    chunk = list(islice(pairs, chunksize))
+    while chunk:
+        yield chunk
+        chunk = list(islice(pairs, chunksize))
+
+# ------------------
+
+_helpdoc = dict()
+
+_helpdoc['make_anchors'] = helpstring(
+    describe='',
+    parameterdicts={
+        'guide_left': 'string, sequence before sgRNA.',
+        'guide_right': 'string, sequence after sgRNA.',
+        'guide_length': 'int, length of sgRNA.',
+        'barcode_left': 'string, sequence before barcode.',
+        'barcode_right': 'string, sequence after barcode.',
+        'barcode_length': 'int, length of barcode.',
+        'spacer_min': 'int, minimum length between guide_right and barcode_left.',
+        'spacer_max': 'int, maximum length between guide_right and barcode_left.',
+        'barcode_min': 'int, minimum length of barcode, default is None means barcode_length.',
+        'barcode_max': 'int, maximum length of barcode, default is None means barcode_length.',
+        'mate_barcode_length': 'int, length of barcode in mate, default is None means barcode_length, 6 by default.'
+    },
+    returns='tuple, anchors used by extract_guide_barcode.',
+    examplecodelists=[
+        "anchors = make_anchors(guide_length=19)",
+        "anchors = make_anchors(barcode_min=4, barcode_max=6, mate_barcode_length=6)"
+    ]
+)
+
+@AppendHelp(_helpdoc['make_anchors'], join='')
+def make_anchors(guide_left='ACCG',
+                 guide_right='GTTT',
+                 guide_length=20,
+                 barcode_left='TGGA',
+                 barcode_right='AACA',
+                 barcode_length=6,
+                 spacer_min=1,
+                 spacer_max=35,
+                 barcode_min=None,
+                 barcode_max=None,
+                 mate_barcode_length=None):
+    '''
+    Fixed anchors to locate sgRNA and barcode in reads.
+    The defaults match the patterns:
+        read: ACCG([ATGC]{20})GTTT[ATGC]{1,35}TGGA([ATCG]{6})AACA
+        mate: TGGA([ATCG]{6})AACA
+    The default read pattern of count_sgrna_with_barcode takes barcodes
+    of 4 to 6 bases, TGGA([ATCG]{4,6})AACA, which is
+    barcode_min=4, barcode_max=6, and barcodes of exactly 6 bases in mate,
+    which is mate_barcode_length=6.
+    '''
+    if barcode_min is None:
+        barcode_min = barcode_length
+    if barcode_max is None:
+        barcode_max = barcode_length
+    if mate_barcode_length is None:
+        mate_barcode_length = barcode_length
+    if barcode_min < 1 or barcode_min > barcode_max:
+        logging.error('Barcode length range should be positive and increasing.')
+        raise ValueError('Wrong barcode length range.')
+    if mate_barcode_length < 1:
+        logging.error('Barcode length in mate should be positive.')
+        raise ValueError('Wrong barcode length in mate.')
+    return (
+        guide_left.encode(), guide_right.encode(), int(guide_length),
+        barcode_left.encode(), barcode_right.encode(),
+        int(barcode_min), int(barcode_max),
+        int(spacer_min), int(spacer_max),
+        int(mate_barcode_length)
+    )
+
+# ------------------
+
+def find_barcode(seq, anchors, start=0, end=None, last=False, mate=False):
+    # find the first (or last) barcode between start and end, the longest
+    # in the length range after the same left anchor, the length of barcode
+    # in mate for mate, return b'' if not found
+    bl, br = anchors[3], anchors[4]
+    bmin, bmax = anchors[5], anchors[6]
+    if mate:
+        bmin, bmax = anchors[9], anchors[9]
+    if end is None:
+        end = len(seq)
+    if last:
+        j = seq.rfind(bl, start, end)
+    else:
+        j = seq.find(bl, start, end)
+    while j != -1:
+        b0 = j + len(bl)
+        for b1 in range(b0 + bmax, b0 + bmin - 1, -1):
+            if seq[b1:(b1 + len(br))] == br and isbase(seq[b0:b1]):
+                return seq[b0:b1]
+        if last:
+            j = seq.rfind(bl, start, j + len(bl) - 1)
+        else:
+            j = seq.find(bl, j + 1, end)
+    return b''
+
+# ------------------
+
+_helpdoc['extract_guide_barcode'] = helpstring(
+    describe='',
+    parameterdicts={
+        'read': 'bytes, sequence containing sgRNA and barcode.',
+        'mate': 'bytes, sequence of the paired read, not reverse complemented.',
+        'anchors': 'tuple, anchors made by make_anchors.'
+    },
+    returns='bytes, "<guide> <barcode in read> <barcode in mate>" or None if sgRNA with barcode is not found in read.',
+    examplecodelists=[
+        "key = extract_guide_barcode(seq1, seq2, make_anchors())"
+    ]
+)
+
+@AppendHelp(_helpdoc['extract_guide_barcode'], join='')
+def extract_guide_barcode(read, mate, anchors):
+    '''
+    Extract sgRNA and barcode by fixed anchor search.
+    As the greedy spacer in the regular expression, the barcode in read
+    is the last one in the spacer range.
+    The mate is reverse complemented only when the read matches.
+    '''
+    gl, gr, glen = anchors[0], anchors[1], anchors[2]
+    spacer_min, spacer_max = anchors[7], anchors[8]
+    i = read.find(gl)
+    while i != -1:
+        g0 = i + len(gl)
+        g1 = g0 + glen
+        if read[g1:(g1 + len(gr))] == gr and isbase(read[g0:g1]):
+            s0 = g1 + len(gr)
+            bar1 = find_barcode(
+                read, anchors,
+                s0 + spacer_min, s0 + spacer_max + len(anchors[3]),
+                last=True
+            )
+            if bar1:
+                bar2 = find_barcode(
+                    reverse_complement(mate), anchors, mate=True
+                )
+                return b' '.join([read[g0:g1], bar1, bar2])
+        i = read.find(gl, i + 1)
+    return None
+
+# ------------------
+
+def count_pairs(pairs, anchors, counts=None):
+    # count guide barcode of sequence pairs in both orientations
+    if counts is None:
+        counts = dict()
+    for seq1, seq2 in pairs:
+        key = extract_guide_barcode(seq1, seq2, anchors)
+        if key is not None:
+            counts[key] = counts.get(key, 0) + 1
+        key = extract_guide_barcode(seq2, seq1, anchors)
+        if key is not None:
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+# ------------------
+
+def merge_counts(counts, other):
+    # add the counts in other to counts
+    for key, value in other.items():
+        counts[key] = counts.get(key, 0) + value
+    return counts
+
+# ------------------
+
+# anchors of the worker processes, set by the pool initializer
+_worker_anchors = None
+
+
+def init_worker(anchors):
+    global _worker_anchors
+    _worker_anchors = anchors
+
+
+def count_chunk(chunk):
+    return count_pairs(chunk, _worker_anchors)
+
+# ------------------
+
+def count_pool(processes, anchors):
+    # process pool for counting chunks of paired sequences
+    return Pool(processes, initializer=init_worker, initargs=(anchors,))
+
+# ------------------
+
+_helpdoc['count_fastq'] = helpstring(
+    describe='',
+    parameterdicts={
+        'fq1': 'string, the forward fastq file, plain or gzip compressed.',
+        'fq2': 'string, the reverse fastq file, plain or gzip compressed.',
+        'anchors': 'tuple, anchors made by make_anchors, default is None means the default anchors.',
+        'pool': 'multiprocessing.Pool, made by count_pool with the same anchors, default is None means counting in this process.',
+        'chunksize': 'int, number of read pairs in each chunk sent to the pool.'
+    },
+    returns='dict, count of each b"<guide> <barcode in read> <barcode in mate>".',
+    examplecodelists=[
+        "counts = count_fastq('sample_R1.fq.gz', 'sample_R2.fq.gz')"
+    ]
+)
+
+@AppendHelp(_helpdoc['count_fastq'], join='')
+def count_fastq(fq1, fq2, anchors=None, pool=None, chunksize=100000):
+    '''
+    Count sgRNA with barcode from paired-end fastq files in one pass.
+    Both orientations of each read pair are searched,
+    the same as count_sgrna_with_barcode.
+    With a pool, the read pairs are split into record aligned chunks,
+    counted by the worker processes and the partial counts are merged.
+    '''
+    if anchors is None:
+        anchors = make_anchors()
+    logging.info('Counting: {0:s} {1:s}.'.format(fq1, fq2))
+    if pool is None:
+        counts = count_pairs(fastq_pairs(fq1, fq2), anchors)
+    else:
+        counts = dict()
+        for chunkcounts in pool.imap_unordered(
+                count_chunk, fastq_chunks(fq1, fq2, chunksize)
+        ):
+            merge_counts(counts, chunkcounts)
+    logging.info('Counted {0:d} guide barcodes.'.format(len(counts)))
+    return counts
+
+# ------------------
+
+_helpdoc['count_samples'] = helpstring(
+    describe='',
+    parameterdicts={
+        'samples': 'list, (label, fq1, fq2) of each sample.',
+        'anchors': 'tuple, anchors made by make_anchors, default is None means the default anchors.',
+        'processes': 'int, number of worker processes shared by all the samples.',
+        'chunksize': 'int, number of read pairs in each chunk sent to the workers.'
+    },
+    returns='dict, label: counts of each sample.',
+    examplecodelists=[
+        "counts = count_samples(",
+        "    [('Ctrl_1', 'Ctrl_1_R1.fq.gz', 'Ctrl_1_R2.fq.gz'),",
+        "     ('Exp_1', 'Exp_1_R1.fq.gz', 'Exp_1_R2.fq.gz')],",
+        "    processes=16",
+        ")"
+    ]
+)
+
+@AppendHelp(_helpdoc['count_samples'], join='')
+def count_samples(samples, anchors=None, processes=1, chunksize=100000):
+    '''
+    Count several samples with one pool of worker processes.
+    '''
+    if anchors is None:
+        anchors = make_anchors()
+    result = dict()
+    if processes > 1:
+        with count_pool(processes, anchors) as pool:
+            for label, fq1, fq2 in samples:
+                result[label] = count_fastq(
+                    fq1, fq2, anchors, pool=pool, chunksize=chunksize
+                )
+    else:
+        for label, fq1, fq2 in samples:
+            result[label] = count_fastq(fq1, fq2, anchors)
+    return result
+
+# ------------------
+
+def write_count(counts, f):
+    # write counts as "<guide> <barcode in read> <barcode in mate> <count>"
+    for key in sorted(counts):
+        f.write(key.decode() + ' ' + str(counts[key]) + '\n')
+
+# ------------------
+
+def read_library(filepath, mismatch=False):
+    # library index from library file or saved index directory
+    if os.path.isdir(filepath):
+        return LibraryIndex.load(filepath)
+    else:
+        return LibraryIndex.build(filepath, mismatch=mismatch)
+
+# ------------------
+
+_helpdoc['map_library'] = helpstring(
+    describe='',
+    parameterdicts={
+        'counts': 'dict, counts made by count_fastq.',
+        'library': 'LibraryIndex, index of the library.',
+        'mismatch': 'bool, whether to recover guide and barcode with one mismatch.'
+    },
+    returns='np.ndarray, count of each library item, in the order of library file.',
+    examplecodelists=[
+        "library = read_library('library.txt')",
+        "libcounts = map_library(counts, library)"
+    ]
+)
+
+def lookup_pair(library, guide, bar1, bar2, mismatch=False):
+    # library rows of guide with the barcode in read or in mate, exact
+    # matches of both barcodes are tried before any mismatch correction
+    rows = library.lookup(guide, bar1)
+    miss = rows < 0
+    rows[miss] = library.lookup(guide[miss], bar2[miss])
+    if mismatch:
+        for bar in [bar1, bar2]:
+            miss = rows < 0
+            rows[miss] = library.lookup(guide[miss], bar[miss], mismatch=True)
+    return rows
+
+# ------------------
+
+@AppendHelp(_helpdoc['map_library'], join='')
+def map_library(counts, library, mismatch=False):
+    '''
+    Map guide barcode counts to the library.
+    The barcode in read is tried first, then the barcode in mate,
+    the same as library_count_sgrna_with_barcode. With mismatch, the
+    guide and barcode with one mismatch are only tried when neither
+    barcode matches exactly.
+    '''
+    keys = np.array(list(counts.keys()), dtype=bytes)
+    values = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+    words = np.char.partition(keys, b' ')
+    guide = words[:, 0]
+    words = np.char.partition(words[:, 2], b' ')
+    bar1 = words[:, 0]
+    bar2 = words[:, 2]
+    rows = lookup_pair(library, guide, bar1, bar2, mismatch)
+    found = rows >= 0
+    return np.bincount(rows[found], weights=values[found], minlength=len(library)).astype(np.int64)
+
+# ------------------
+
+def write_library_count(libcounts, library, f):
+    # write library counts as "<gene> <tab> <guide> <tab> <barcode> <tab> <count>"
+    f.write('gene\tguide\tbarcode\tcount\n')
+    for row in zip(library.gene, library.guide, library.barcode, libcounts):
+        f.write('\t'.join(map(str, row)) + '\n')
+
+# ------------------
+
+def read_rawcount(filepath):
+    # read raw counts: <guide> <barcode in read> <barcode in mate> <count>
+    data = pd.read_csv(
+        filepath, sep=' ', header=None,
+        names=['guide', 'bar1', 'bar2', 'count'],
+        dtype={'guide': str, 'bar1': str, 'bar2': str, 'count': np.int64},
+        keep_default_na=False
+    )
+    # the counts of count_sgrna_with_barcode end barcode in mate with tabs
+    data['bar2'] = data['bar2'].str.strip()
+    return data
+
+# ------------------
+
+_helpdoc['count_matrix'] = helpstring(
+    describe='',
+    parameterdicts={
+        'library': 'LibraryIndex, index of the library.',
+        'labels': 'list, label of each sample.',
+        'files': 'list, raw count file of each sample, made by mageck-ibar-count or count_sgrna_with_barcode.',
+        'mismatch': 'bool, whether to recover guide and barcode with one mismatch.'
+    },
+    returns='pd.DataFrame, columns: gene, guide, barcode, <label1>, [<label2>, ...].',
+    examplecodelists=[
+        "matrix = count_matrix(",
+        "    read_library('library.txt'),",
+        "    ['Ctrl_1', 'Exp_1'],",
+        "    ['Ctrl_1.rawcount', 'Exp_1.rawcount']",
+        ")"
+    ]
+)
+
+@AppendHelp(_helpdoc['count_matrix'], join='')
+def count_matrix(library, labels, files, mismatch=False):
+    '''
+    Map raw counts of all the samples to the library in one pass.
+    Each sample is looked up as integer library rows and added into one
+    preallocated count matrix, the barcode in read is tried first,
+    then the barcode in mate, and the mismatch correction only when
+    neither matches exactly.
+    Library items counted in at least one sample are kept,
+    sorted by gene, guide and barcode.
+    '''
+    matrix = np.zeros((len(library), len(labels)), dtype=np.int64)
+    for j, (label, filepath) in enumerate(zip(labels, files)):
+        logging.info('Mapping {0:s}: {1:s}.'.format(label, filepath))
+        data = read_rawcount(filepath)
+        rows = lookup_pair(
+            library, data['guide'].to_numpy(), data['bar1'].to_numpy(),
+            data['bar2'].to_numpy(), mismatch
+        )
+        found = rows >= 0
+        matrix[:, j] = np.bincount(
+            rows[found],
+            weights=data['count'].to_numpy()[found],
+            minlength=len(library)
+        )
+        logging.info(
+            'Mapped {0:d} of {1:d} reads.'.format(
+                int(matrix[:, j].sum()), int(data['count'].sum())
+            )
+        )
+    counted = np.flatnonzero(matrix.sum(axis=1) > 0)
+    result = pd.DataFrame(
+        {
+            'gene': np.asarray(library.gene)[counted],
+            'guide': np.asarray(library.guide)[counted],
+            'barcode': np.asarray(library.barcode)[counted]
+        }
+    )
+    for j, label in enumerate(labels):
+        result[label] = matrix[counted, j]
+    result.sort_values(
+        ['gene', 'guide', 'barcode'], kind='mergesort', inplace=True
+    )
+    return result
+
+# ------------------
+# EOF
+# ------------------
@@ -6,9 +6,12 @@
 import pandas as pd
 import numpy as np
 import logging
+from scipy.stats import norm
 
 from .decorator import helpstring
 from .decorator import AppendHelp
+from .fdr import fdr_adjust
+from . import kernels
 
 # ------------------
 # Function
@@ -32,7 +35,7 @@ _helpdoc['df_geomean'] = helpstring(
 def df_geomean(dat, label):
     '''
     Function used to calculate geometric mean.
-    The geometric mean of each row is calculated.
+    The geometric mean of each row is calculated by kernels.geomean.
     '''
     if (len(label) == 0):
         logging.error('Length of label should be at least 1.')
@@ -40,10 +43,127 @@ def df_geomean(dat, label):
     elif (len(label) == 1):
         return dat[label]
     else:
-        datlog = np.log(dat[label] + 1)
-        datlogsum = datlog.sum(axis=1)
-        gm = np.exp(datlogsum / len(label)) - 1
-        return gm
+        return pd.Series(kernels.geomean(dat[label].to_numpy()), index=dat.index)
+
+# ------------------
+
+def array_median(values, overwrite_input=False):
+    # exact median of each column by selection instead of sorting,
+    # columns with NaN use np.nanmedian as pd.DataFrame.median,
+    # a float64 array is partitioned in place with overwrite_input
+    values = np.array(values, dtype=np.float64, copy=None if overwrite_input else True)
+    n = values.shape[0]
+    if n == 0:
+        return np.full(values.shape[1], np.nan)
+    hasnan = np.isnan(values).any(axis=0)
+    kth = [(n - 1) // 2, n // 2]
+    values.partition(kth, axis=0)
+    median = (values[kth[0]] + values[kth[1]]) / 2
+    if hasnan.any():
+        median[hasnan] = np.nanmedian(values[:, hasnan], axis=0)
+    return median
+
+# ------------------
+
+_helpdoc['QuantileSketch'] = helpstring(
+    describe='',
+    parameterdicts={
+        'accuracy': 'numeric, relative accuracy of the quantiles, default is 0.001.'
+    },
+    returns='QuantileSketch, mergeable sketch of non negative values.',
+    examplecodelists=[
+        "sketch = QuantileSketch()",
+        "sketch.add(chunk1['ratio'])",
+        "sketch.merge(other)",
+        "median = sketch.quantile(0.5)"
+    ]
+)
+
+@AppendHelp(_helpdoc['QuantileSketch'], join='')
+class QuantileSketch:
+    '''
+    Mergeable quantile sketch of non negative values.
+    Positive values are counted in logarithmic bins
+    (gamma ^ (i - 1), gamma ^ i] with gamma = (1 + accuracy) / (1 - accuracy),
+    zeros are counted apart, so the memory only depends on the range of values
+    and a quantile is within the relative accuracy of the exact one.
+    Sketches of chunks or processes with the same accuracy are merged
+    by adding the bin counts.
+    '''
+    def __init__(self, accuracy=0.001):
+        if not 0 < accuracy < 1:
+            logging.error('Accuracy of the quantile sketch should be in (0, 1).')
+            raise ValueError('Wrong accuracy.')
+        self.accuracy = accuracy
+        self.loggamma = np.log((1 + accuracy) / (1 - accuracy))
+        self.offset = 0
+        self.bins = np.zeros(0, dtype=np.int64)
+        self.zeros = 0
+        self.count = 0
+
+    def _extend(self, low, high):
+        # make bins cover the bin indices from low to high
+        if self.bins.size == 0:
+            self.offset = low
+            self.bins = np.zeros(high - low + 1, dtype=np.int64)
+            return
+        start = min(low, self.offset)
+        stop = max(high, self.offset + self.bins.size - 1)
+        if start < self.offset or stop >= self.offset + self.bins.size:
+            bins = np.zeros(stop - start + 1, dtype=np.int64)
+            bins[(self.offset - start):(self.offset - start + self.bins.size)] = self.bins
+            self.offset = start
+            self.bins = bins
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        values = values[~np.isnan(values)]
+        if (values < 0).any():
+            logging.error('Values of the quantile sketch should be non negative.')
+            raise ValueError('Negative values.')
+        positive = values[values > 0]
+        self.zeros += values.size - positive.size
+        self.count += values.size
+        if positive.size == 0:
+            return self
+        index = np.ceil(np.log(positive) / self.loggamma).astype(np.int64)
+        low = index.min()
+        self._extend(low, index.max())
+        counts = np.bincount(index - low)
+        start = low - self.offset
+        self.bins[start:(start + counts.size)] += counts
+        return self
+
+    def merge(self, other):
+        if other.accuracy != self.accuracy:
+            logging.error('Only sketches of the same accuracy can be merged.')
+            raise ValueError('Different accuracy.')
+        self.zeros += other.zeros
+        self.count += other.count
+        if other.bins.size > 0:
+            self._extend(other.offset, other.offset + other.bins.size - 1)
+            start = other.offset - self.offset
+            self.bins[start:(start + other.bins.size)] += other.bins
+        return self
+
+    def _value(self, rank):
+        # value of the rank th smallest value, starting from 0
+        if rank < self.zeros:
+            return 0.0
+        i = np.searchsorted(np.cumsum(self.bins), rank - self.zeros, side='right')
+        gamma = np.exp(self.loggamma)
+        return 2 * gamma ** (self.offset + i) / (gamma + 1)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return np.nan
+        rank = q * (self.count - 1)
+        low = int(np.floor(rank))
+        high = int(np.ceil(rank))
+        return (self._value(low) + self._value(high)) / 2
+
+    def median(self):
+        return self.quantile(0.5)
 
 # ------------------
 
@@ -51,24 +171,42 @@ _helpdoc['df_median_ratio_normfactor'] = helpstring(
     describe='',
     parameterdicts={
         'dat': 'pd.DataFrame, data to process.',
-        'label': 'list, column names of data to calculate normalize.'
+        'label': 'list, column names of data to calculate normalize.',
+        'method': 'string, how the median ratio of each column is got, "median" by sorting, "median-partition" by exact selection, "median-sketch" by QuantileSketch, default is "median".'
     },
-    returns='pd.DataFrame, the corresponding normalized data.',
+    returns='pd.Series, the normalization factor of each column.',
     examplecodelists=[
-        "datnorm = df_normalization(dataframe, ['one', 'two'])"
+        "normfactor = df_median_ratio_normfactor(dataframe, ['one', 'two'], 'median-partition')"
     ]
 )
 
 @AppendHelp(_helpdoc['df_median_ratio_normfactor'], join='')
-def df_median_ratio_normfactor(dat, label):
+def df_median_ratio_normfactor(dat, label, method='median'):
     '''
-    Normalize input data indicated by the label.
-    Now only median ratio normalization is available.
+    Median ratio normalization factors of input data indicated by the label,
+    the ratios are to the geometric mean of each row, see kernels.medianratio.
     '''
-    datgm = np.exp(np.log(dat[label] + 1.0).sum(axis=1) / len(label)) - 1.0
-    datgm[datgm <= 0] = 1
-    meanfactor = dat[label].div(datgm, axis=0)
-    normfactor = 1 / meanfactor.median(axis=0)
+    meanfactor = kernels.medianratio(dat[label].to_numpy())
+    if method == 'median':
+        median = pd.Series(np.nanmedian(meanfactor, axis=0), index=label)
+    elif method == 'median-partition':
+        median = pd.Series(
+            array_median(meanfactor, overwrite_input=True), index=label
+        )
+    elif method == 'median-sketch':
+        median = pd.Series(
+            [
+                QuantileSketch().add(meanfactor[:, i]).median()
+                for i in range(len(label))
+            ],
+            index=label
+        )
+    else:
+        logging.error(
+            'Median method should be median, median-partition or median-sketch.'
+        )
+        raise ValueError('Wrong median method.')
+    normfactor = 1 / median
     return normfactor
 
 # ------------------
@@ -81,12 +219,31 @@ def df_total_count_normfactor(dat, label):
 
 # ------------------
 
+_helpdoc['df_normalization'] = helpstring(
+    describe='',
+    parameterdicts={
+        'dat': 'pd.DataFrame, data to process.',
+        'label': 'list, column names of data to normalize.',
+        'method': 'string, "none", median ratio normalization by "median", "median-partition" or "median-sketch" (see df_median_ratio_normfactor), other methods use total count normalization.'
+    },
+    returns='pd.DataFrame, the corresponding normalized data.',
+    examplecodelists=[
+        "datnorm = df_normalization(dataframe, ['one', 'two'], 'median')"
+    ]
+)
+
+@AppendHelp(_helpdoc['df_normalization'], join='')
 def df_normalization(dat, label, method):
+    '''
+    Normalize input data indicated by the label.
+    Median ratio normalization falls back to total count normalization
+    when a median ratio is zero or a column has too many zeros.
+    '''
     normfactor = df_total_count_normfactor(dat, label)
     if method == 'none':
         normfactor = np.array([1]*len(normfactor))
-    elif method == 'median':
-        medianfactor = df_median_ratio_normfactor(dat, label)
+    elif method in ['median', 'median-partition', 'median-sketch']:
+        medianfactor = df_median_ratio_normfactor(dat, label, method)
         if (medianfactor == 0).any():
             logging.warning('Median factor is zero, using total count normalization')
         elif ((dat[label] == 0).sum(axis=0) / dat.shape[0] > 0.45).any():
@@ -119,33 +276,23 @@ def df_leastsquare(dat, xlabel, ylabel, weightlabel=None):
     coefficients from y = a + bx
     reference: http://mathworld.wolfram.com/LeastSquaresFitting.html
     For weighted least square: http://goo.gl/pGpTZ6
+    The sums are calculated by kernels.leastsquare.
     '''
-    n = dat.shape[0]
-    if weightlabel is None:
-        sy = dat[ylabel].sum()
-        sx = dat[xlabel].sum()
-        sx2 = dat[xlabel].mul(dat[xlabel], axis=0).sum()
-        sxy = dat[xlabel].mul(dat[ylabel], axis=0).sum()
-        a = (sy*sx2-sx*sxy) / (n*sx2-sx*sx)
-        b = (n*sxy-sx*sy) / (n*sx2-sx*sx)
-        return (b,a)
-    else:
-        nw = dat[weightlabel].sum()
-        sy = dat[ylabel].mul(dat[weightlabel], axis=0).sum()
-        sx = dat[xlabel].mul(dat[weightlabel], axis=0).sum()
-        sx2 = dat[xlabel].mul(
-            dat[xlabel], axis=0
-        ).mul(
-            dat[weightlabel], axis=0
-        ).sum()
-        sxy = dat[xlabel].mul(
-            dat[ylabel], axis=0
-        ).mul(
-            dat[weightlabel], axis=0
-        ).sum()
-        a = (sy * sx2 - sx * sxy) / (nw * sx2 - sx * sx)
-        b = (nw * sxy - sx * sy) / (nw * sx2 - sx * sx)
-        return (b,a)
+    nw, sx, sy, sx2, sxy = kernels.leastsquare(
+        dat[xlabel].to_numpy(),
+        dat[ylabel].to_numpy(),
+        None if weightlabel is None else dat[weightlabel].to_numpy()
+    )
+    a = (sy * sx2 - sx * sxy) / (nw * sx2 - sx * sx)
+    b = (nw * sxy - sx * sy) / (nw * sx2 - sx * sx)
+    return (b,a)
+
+# ------------------
+
+def df_rowvar(dat, label):
+    # sample variance of each row of columns indicated by label,
+    # as dat[label].var(axis=1), see kernels.rowvar
+    return pd.Series(kernels.rowvar(dat[label].to_numpy()), index=dat.index)
 
 # ------------------
 
@@ -171,7 +318,7 @@ def df_modelmeanvar(dat, label):
           alpha = 2 ^ b, beta = k
     '''
     datgm = df_geomean(dat, label)
-    datvar = dat[label].var(axis=1)
+    datvar = df_rowvar(dat, label)
     goodidx = datgm < datvar
     lgm = np.log2(datgm[goodidx] + 1)
     lvar = np.log2(datvar[goodidx] - datgm[goodidx] + 1)
@@ -212,48 +359,111 @@ def df_estvar(dat, meanlabel, k, b):
           Var = Mean + 2 ^ b * Mean ^ k
           alpha = 2 ^ b, beta = k
     '''
-    var = dat[meanlabel].map(
-        lambda x: x ** k
-    ) * 2 ** b + dat[meanlabel]
+    var = pd.Series(
+        kernels.estvar(dat[meanlabel].to_numpy(), k, b), index=dat.index
+    )
     return var
 
 # ------------------
 
+_helpdoc['df_adjustvar'] = helpstring(
+    describe='',
+    parameterdicts={
+        'dat': 'pd.DataFrame, data to process.',
+        'grouplabel': 'string, column name of group (guide) in dat.',
+        'varlabel': 'string, column name of variance in dat.',
+        'directionlabel': 'string, column name of direction (1, 0, -1) in dat.'
+    },
+    returns='pd.Series, variance to add to each row.',
+    examplecodelists=[
+        "adjust_var = df_adjustvar(data, 'guide', 'controlvar', 'direction')"
+    ]
+)
+
+@AppendHelp(_helpdoc['df_adjustvar'], join='')
+def df_adjustvar(dat, grouplabel, varlabel, directionlabel):
+    '''
+    Calculate the variance added to items in groups with inconsistent direction.
+    For groups containing both direction 1 and -1, the mean variance
+    of the group is added, otherwise 0.
+    Groups are coded as integers, reduced by one grouped aggregation
+    and scattered back to the rows by code.
+    '''
+    codes, _ = pd.factorize(dat[grouplabel])
+    agg = pd.DataFrame(
+        {
+            'var': dat[varlabel].to_numpy(),
+            'direction': dat[directionlabel].to_numpy()
+        }
+    ).groupby(codes).agg(
+        var=('var', 'mean'),
+        low=('direction', 'min'),
+        high=('direction', 'max')
+    )
+    samedirection = (agg['low'] * agg['high']).to_numpy() != -1
+    adjust = agg['var'].to_numpy() * (1 - samedirection)
+    return pd.Series(adjust[codes], index=dat.index)
+
+# ------------------
+
 def df_lfc(dat, gene_colname, lfc_colname):
     data = dat.copy()
-    return data.groupby(gene_colname)[lfc_colname].mean()
+    return data.groupby(gene_colname, observed=True)[lfc_colname].mean()
+
+# ------------------
+
+_helpdoc['array_direction'] = helpstring(
+    describe='',
+    parameterdicts={
+        'lfc': 'array like, log2 fold change.',
+        'threshold': 'numeric, fold change within (-threshold, threshold) has no direction, default is 0.1.'
+    },
+    returns='np.ndarray, direction of each fold change, 1 for up, -1 for down and 0 for none.',
+    examplecodelists=[
+        "data['lfc_bin'] = array_direction(data['lfc'])"
+    ]
+)
+
+@AppendHelp(_helpdoc['array_direction'], join='')
+def array_direction(lfc, threshold=0.1):
+    '''
+    Direction of log2 fold change, calculated on the whole array.
+    NaN fold change has no direction.
+    '''
+    lfc = np.asarray(lfc, dtype=np.float64)
+    return (lfc > -threshold).astype(np.int64) - (lfc < threshold).astype(np.int64)
+
+# ------------------
+
+_helpdoc['array_normtest'] = helpstring(
+    describe='',
+    parameterdicts={
+        'zscore': 'array like, z score of each item.'
+    },
+    returns='tuple, (plow, phigh, ptwoside) arrays of lower tail, higher tail and two sided p values.',
+    examplecodelists=[
+        "plow, phigh, ptwoside = array_normtest(data['treat_zscore'])"
+    ]
+)
+
+@AppendHelp(_helpdoc['array_normtest'], join='')
+def array_normtest(zscore):
+    '''
+    Normal test of z scores, calculated on the whole array.
+    The two sided p value is twice the smaller tail.
+    '''
+    zscore = np.asarray(zscore, dtype=np.float64)
+    plow = norm.cdf(zscore)
+    phigh = norm.sf(zscore)
+    ptwoside = np.where(plow < phigh, plow, phigh) * 2
+    return (plow, phigh, ptwoside)
 
 # ------------------
 
 def array_fdr(pvalues, method='Benjamini-Hochberg'):
-    # https://stackoverflow.com/questions/7450957/how-to-implement-rs-p-adjust-in-python
-    pvalues = np.array(pvalues)
-    n = float(pvalues.shape[0])
-    new_pvalues = np.zeros(int(n))
-    if method == "Bonferroni":
-        new_pvalues = n * pvalues
-    elif method == "Bonferroni-Holm":
-        values = [ (pvalue, i) for i, pvalue in enumerate(pvalues) ]
-        values.sort()
-        for rank, vals in enumerate(values):
-            pvalue, i = vals
-            new_pvalues[i] = (n-rank) * pvalue
-    elif method == "Benjamini-Hochberg":
-        values = [ (pvalue, i) for i, pvalue in enumerate(pvalues) ]
-        values.sort()
-        values.reverse()
-        new_values = []
-        for i, vals in enumerate(values):
-            rank = n - i
-            pvalue, index = vals
-            new_values.append((n/rank) * pvalue)
-        for i in range(0, int(n)-1):
-            if new_values[i] < new_values[i+1]:
-                new_values[i+1] = new_values[i]
-        for i, vals in enumerate(values):
-            pvalue, index = vals
-            new_pvalues[index] = new_values[i]
-    return new_pvalues
+    # multiple testing adjustment: Benjamini-Hochberg, Bonferroni,
+    # Bonferroni-Holm or Storey, see fdr.fdr_adjust
+    return fdr_adjust(pvalues, method)
 
 
 # ------------------
@@ -0,0 +1,184 @@
+#! /bin/env python3
+# ------------------
+# Library
+# ------------------
+
+import numpy as np
+import logging
+
+from .decorator import helpstring
+from .decorator import AppendHelp
+from .kernels import floatarray
+from . import kernels
+
+# ------------------
+# Function
+# ------------------
+
+def validorder(pvalues, order=None, kind='mergesort'):
+    # increasing order of p values, NaN p values are dropped
+    if order is None:
+        order = np.argsort(pvalues, kind=kind)
+    else:
+        order = np.asarray(order)
+    return order[~np.isnan(pvalues[order])]
+
+# ------------------
+
+_helpdoc = dict()
+
+_helpdoc['fdr_bh'] = helpstring(
+    describe='',
+    parameterdicts={
+        'pvalues': 'array like, p values, NaN p values get NaN.',
+        'order': 'np.ndarray, order of the tests used for ranking, default is None means the increasing order of p values.'
+    },
+    returns='np.ndarray, Benjamini-Hochberg adjusted p values, in the dtype of pvalues if it is float32 or float64.',
+    examplecodelists=[
+        "fdr = fdr_bh(data['p'])"
+    ]
+)
+
+@AppendHelp(_helpdoc['fdr_bh'], join='')
+def fdr_bh(pvalues, order=None):
+    '''
+    Benjamini-Hochberg adjusted p values.
+    p * n / rank along the order, followed by the cumulative minimum
+    from the last rank, the last one is capped at 1.
+    '''
+    pvalues = floatarray(pvalues)
+    result = np.full(pvalues.shape, np.nan, dtype=pvalues.dtype)
+    # tied p values get the same adjusted value in any order of the ties,
+    # so the order needs not be stable
+    order = validorder(pvalues, order, kind='quicksort')
+    n = order.size
+    if n == 0:
+        return result
+    rank = np.arange(1, n + 1, dtype=pvalues.dtype)
+    values = n / rank * pvalues[order]
+    values[-1] = min(values[-1], 1)
+    return kernels.cummin(values, order, result)
+
+# ------------------
+
+_helpdoc['fdr_bonferroni'] = helpstring(
+    describe='',
+    parameterdicts={
+        'pvalues': 'array like, p values, NaN p values get NaN.'
+    },
+    returns='np.ndarray, Bonferroni adjusted p values, not capped at 1.',
+    examplecodelists=[
+        "fdr = fdr_bonferroni(data['p'])"
+    ]
+)
+
+@AppendHelp(_helpdoc['fdr_bonferroni'], join='')
+def fdr_bonferroni(pvalues):
+    '''
+    Bonferroni adjusted p values, p * n.
+    '''
+    pvalues = floatarray(pvalues)
+    n = np.count_nonzero(~np.isnan(pvalues))
+    return pvalues * pvalues.dtype.type(n)
+
+# ------------------
+
+_helpdoc['fdr_holm'] = helpstring(
+    describe='',
+    parameterdicts={
+        'pvalues': 'array like, p values, NaN p values get NaN.'
+    },
+    returns='np.ndarray, Bonferroni-Holm adjusted p values, not capped at 1.',
+    examplecodelists=[
+        "fdr = fdr_holm(data['p'])"
+    ]
+)
+
+@AppendHelp(_helpdoc['fdr_holm'], join='')
+def fdr_holm(pvalues):
+    '''
+    Bonferroni-Holm adjusted p values, p * (n - rank + 1)
+    in the increasing order of p values.
+    As the former array_fdr, the values are neither made monotone
+    nor capped at 1.
+    '''
+    pvalues = floatarray(pvalues)
+    result = np.full(pvalues.shape, np.nan, dtype=pvalues.dtype)
+    order = validorder(pvalues)
+    n = order.size
+    result[order] = np.arange(n, 0, -1).astype(pvalues.dtype) * pvalues[order]
+    return result
+
+# ------------------
+
+_helpdoc['fdr_storey'] = helpstring(
+    describe='',
+    parameterdicts={
+        'pvalues': 'array like, p values, NaN p values get NaN.',
+        'pi0lambda': 'numeric, p values larger than pi0lambda are used to estimate the proportion of null tests, default is 0.5.'
+    },
+    returns='np.ndarray, Storey q values.',
+    examplecodelists=[
+        "qvalue = fdr_storey(data['p'])"
+    ]
+)
+
+@AppendHelp(_helpdoc['fdr_storey'], join='')
+def fdr_storey(pvalues, pi0lambda=0.5):
+    '''
+    Storey q values, Benjamini-Hochberg adjusted p values
+    scaled by the estimated proportion of null tests:
+    pi0 = #{p > lambda} / (n * (1 - lambda)), capped at 1.
+    When no p value is larger than lambda the estimate is 0, and pi0 = 1
+    is used instead as the qvalue package does, which gives the
+    Benjamini-Hochberg adjusted p values.
+    '''
+    pvalues = floatarray(pvalues)
+    valid = pvalues[~np.isnan(pvalues)]
+    if valid.size == 0:
+        return np.full(pvalues.shape, np.nan, dtype=pvalues.dtype)
+    pi0 = min(
+        np.count_nonzero(valid > pi0lambda) / (valid.size * (1.0 - pi0lambda)),
+        1.0
+    )
+    if pi0 == 0:
+        pi0 = 1.0
+    return fdr_bh(pvalues) * pvalues.dtype.type(pi0)
+
+# ------------------
+
+# methods of fdr_adjust
+_METHODS = {
+    'Benjamini-Hochberg': fdr_bh,
+    'Bonferroni': fdr_bonferroni,
+    'Bonferroni-Holm': fdr_holm,
+    'Storey': fdr_storey
+}
+
+_helpdoc['fdr_adjust'] = helpstring(
+    describe='',
+    parameterdicts={
+        'pvalues': 'array like, p values, NaN p values get NaN.',
+        'method': 'string, Benjamini-Hochberg, Bonferroni, Bonferroni-Holm or Storey, default is Benjamini-Hochberg.'
+    },
+    returns='np.ndarray, adjusted p values.',
+    examplecodelists=[
+        "fdr = fdr_adjust(data['p'], 'Benjamini-Hochberg')"
+    ]
+)
+
+@AppendHelp(_helpdoc['fdr_adjust'], join='')
+def fdr_adjust(pvalues, method='Benjamini-Hochberg'):
+    '''
+    Multiple testing adjustment of p values by method.
+    '''
+    if method not in _METHODS:
+        logging.error(
+            'FDR method should be one of {0:s}.'.format(', '.join(_METHODS))
+        )
+        raise ValueError('Wrong FDR method.')
+    return _METHODS[method](pvalues)
+
+# ------------------
+# EOF
+# ------------------
@@ -0,0 +1,352 @@
+#! /bin/env python3
+# ------------------
+# Library
+# ------------------
+
+import numpy as np
+import logging
+
+from .decorator import helpstring
+from .decorator import AppendHelp
+
+# numba compiled kernels, optional
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# ------------------
+# Function
+# ------------------
+
+def floatarray(values):
+    # values as float32 or float64 array, other types as float64
+    values = np.asarray(values)
+    if values.dtype != np.float32 and values.dtype != np.float64:
+        values = values.astype(np.float64)
+    return values
+
+# ------------------
+
+# numpy kernels, the same operations in the same order as the
+# pandas calculations they replace, so the results are identical
+
+def numpy_geomean(values):
+    # geometric mean of each row, exp(mean(log(x + 1))) - 1
+    result = np.log(values + 1).sum(axis=1)
+    result /= values.shape[1]
+    np.exp(result, out=result)
+    result -= 1
+    return result
+
+
+def numpy_medianratio(values):
+    # ratio of each value to the geometric mean of its row,
+    # a geometric mean not larger than 0 is taken as 1
+    gm = numpy_geomean(values)
+    gm[gm <= 0] = 1
+    return values / gm[:, np.newaxis]
+
+
+def numpy_rowvar(values):
+    # sample variance of each row by the two pass algorithm, in float64
+    # and returned in the dtype of values
+    avg = values.sum(axis=1, dtype=np.float64) / values.shape[1]
+    sqr = avg[:, np.newaxis] - values
+    sqr **= 2
+    result = sqr.sum(axis=1, dtype=np.float64) / (values.shape[1] - 1)
+    return result.astype(values.dtype, copy=False)
+
+
+def numpy_estvar(mean, k, b):
+    # Var = Mean + 2 ^ b * Mean ^ k in float64
+    mean = mean.astype(np.float64)
+    result = np.power(mean, k)
+    result *= 2 ** b
+    result += mean
+    return result
+
+
+def numpy_leastsquare(x, y, w):
+    # sums of the least square fitting: n, sx, sy, sx2, sxy,
+    # each term weighted by w
+    return (
+        w.sum(),
+        (x * w).sum(),
+        (y * w).sum(),
+        (x * x * w).sum(),
+        (x * y * w).sum()
+    )
+
+
+def numpy_cummin(values, order, result):
+    # cumulative minimum of values from the last one,
+    # scattered to result by order
+    result[order] = np.minimum.accumulate(values[::-1])[::-1]
+    return result
+
+# ------------------
+
+# loop kernels compiled by numba, one pass over the data without
+# intermediate arrays. Sums are accumulated in float64 in the order
+# of the items, so the results can differ from the numpy kernels
+# in the last digits.
+
+def loop_geomean(values):
+    n, m = values.shape
+    result = np.empty(n, dtype=values.dtype)
+    for i in range(n):
+        s = 0.0
+        for j in range(m):
+            s += np.log(values[i, j] + 1.0)
+        result[i] = np.exp(s / m) - 1.0
+    return result
+
+
+def loop_medianratio(values):
+    n, m = values.shape
+    result = np.empty((n, m), dtype=values.dtype)
+    for i in range(n):
+        s = 0.0
+        for j in range(m):
+            s += np.log(values[i, j] + 1.0)
+        gm = np.exp(s / m) - 1.0
+        if gm <= 0:
+            gm = 1.0
+        for j in range(m):
+            result[i, j] = values[i, j] / gm
+    return result
+
+
+def loop_rowvar(values):
+    n, m = values.shape
+    result = np.empty(n, dtype=values.dtype)
+    for i in range(n):
+        s = 0.0
+        for j in range(m):
+            s += np.float64(values[i, j])
+        avg = s / m
+        s = 0.0
+        for j in range(m):
+            s += (avg - np.float64(values[i, j])) ** 2
+        result[i] = s / (m - 1)
+    return result
+
+
+def loop_estvar(mean, k, b):
+    result = np.empty(mean.size)
+    alpha = 2.0 ** b
+    for i in range(mean.size):
+        x = np.float64(mean[i])
+        result[i] = x ** k * alpha + x
+    return result
+
+
+def loop_leastsquare(x, y, w):
+    n = sx = sy = sx2 = sxy = 0.0
+    for i in range(x.size):
+        n += w[i]
+        sx += x[i] * w[i]
+        sy += y[i] * w[i]
+        sx2 += x[i] * x[i] * w[i]
+        sxy += x[i] * y[i] * w[i]
+    return (n, sx, sy, sx2, sxy)
+
+
+def loop_cummin(values, order, result):
+    current = np.inf
+    for i in range(values.size - 1, -1, -1):
+        if values[i] < current:
+            current = values[i]
+        result[order[i]] = current
+    return result
+
+# ------------------
+
+# kernels of each backend, the numba kernels are compiled at the first call
+_KERNELS = {
+    'numpy': {
+        'geomean': numpy_geomean,
+        'medianratio': numpy_medianratio,
+        'rowvar': numpy_rowvar,
+        'estvar': numpy_estvar,
+        'leastsquare': numpy_leastsquare,
+        'cummin': numpy_cummin
+    }
+}
+if numba is not None:
+    _KERNELS['numba'] = {
+        'geomean': numba.njit(cache=True)(loop_geomean),
+        'medianratio': numba.njit(cache=True)(loop_medianratio),
+        'rowvar': numba.njit(cache=True)(loop_rowvar),
+        'estvar': numba.njit(cache=True)(loop_estvar),
+        'leastsquare': numba.njit(cache=True)(loop_leastsquare),
+        'cummin': numba.njit(cache=True)(loop_cummin)
+    }
+
+# backend selected by set_backend, worker processes get it by
+# init_worker as the initializer of their pool
+_backend = 'numpy'
+
+_helpdoc = dict()
+
+_helpdoc['set_backend'] = helpstring(
+    describe='',
+    parameterdicts={
+        'backend': 'string, "numpy" for the numpy kernels, "numba" for the numba compiled kernels, "auto" for numba if it is installed, default is "numpy".'
+    },
+    returns='string, the backend used.',
+    examplecodelists=[
+        "set_backend('auto')"
+    ]
+)
+
+@AppendHelp(_helpdoc['set_backend'], join='')
+def set_backend(backend='numpy'):
+    '''
+    Select the kernels of the row wise calculations of dfcalculate.
+    numba falls back to numpy if it is not installed.
+    Process pools pass the backend to their workers by init_worker.
+    '''
+    global _backend
+    if backend == 'auto':
+        backend = 'numba' if numba is not None else 'numpy'
+    if backend not in ['numpy', 'numba']:
+        logging.error('Kernel backend should be numpy, numba or auto.')
+        raise ValueError('Wrong kernel backend.')
+    if backend == 'numba' and numba is None:
+        logging.warning('numba is not installed, the numpy kernels are used.')
+        backend = 'numpy'
+    _backend = backend
+    return backend
+
+
+def get_backend():
+    # backend set by set_backend, numpy by default
+    return _backend
+
+
+def init_worker(backend):
+    # initializer of worker processes, with the backend of the parent
+    global _backend
+    _backend = backend if backend in _KERNELS else 'numpy'
+
+
+def kernel(name):
+    return _KERNELS[get_backend()][name]
+
+# ------------------
+
+_helpdoc['geomean'] = helpstring(
+    describe='',
+    parameterdicts={
+        'values': 'array like, 2 dimensional, one item per row.'
+    },
+    returns='np.ndarray, geometric mean exp(mean(log(x + 1))) - 1 of each row.',
+    examplecodelists=[
+        "gm = geomean(data[['c1', 'c2']].to_numpy())"
+    ]
+)
+
+@AppendHelp(_helpdoc['geomean'], join='')
+def geomean(values):
+    '''
+    Geometric mean of each row, in float32 for float32 values
+    and float64 for other values.
+    '''
+    return kernel('geomean')(floatarray(values))
+
+
+_helpdoc['medianratio'] = helpstring(
+    describe='',
+    parameterdicts={
+        'values': 'array like, 2 dimensional, one item per row.'
+    },
+    returns='np.ndarray, ratio of each value to the geometric mean of its row.',
+    examplecodelists=[
+        "ratio = medianratio(data[['c1', 'c2']].to_numpy())"
+    ]
+)
+
+@AppendHelp(_helpdoc['medianratio'], join='')
+def medianratio(values):
+    '''
+    Ratios of median ratio normalization, the geometric mean of each
+    row not larger than 0 is taken as 1.
+    '''
+    return kernel('medianratio')(floatarray(values))
+
+
+_helpdoc['rowvar'] = helpstring(
+    describe='',
+    parameterdicts={
+        'values': 'array like, 2 dimensional, one item per row.'
+    },
+    returns='np.ndarray, sample variance of each row.',
+    examplecodelists=[
+        "var = rowvar(data[['c1', 'c2']].to_numpy())"
+    ]
+)
+
+@AppendHelp(_helpdoc['rowvar'], join='')
+def rowvar(values):
+    '''
+    Sample variance of each row as pd.DataFrame.var(axis=1),
+    for values without NaN.
+    '''
+    return kernel('rowvar')(floatarray(values))
+
+
+_helpdoc['estvar'] = helpstring(
+    describe='',
+    parameterdicts={
+        'mean': 'array like, mean of each item.',
+        'k': 'numeric, k in Var = Mean + 2 ^ b * Mean ^ k.',
+        'b': 'numeric, b in Var = Mean + 2 ^ b * Mean ^ k.'
+    },
+    returns='np.ndarray, modeled variance of each item in float64.',
+    examplecodelists=[
+        "var = estvar(data['controlmean'], 2.5, 1)"
+    ]
+)
+
+@AppendHelp(_helpdoc['estvar'], join='')
+def estvar(mean, k, b):
+    '''
+    Modeled variance of the mean in Negative Binomial model.
+    '''
+    return kernel('estvar')(floatarray(mean), float(k), float(b))
+
+
+_helpdoc['leastsquare'] = helpstring(
+    describe='',
+    parameterdicts={
+        'x': 'array like, x of each point.',
+        'y': 'array like, y of each point.',
+        'w': 'array like, weight of each point, default is None means weight 1.'
+    },
+    returns='tuple, (n, sx, sy, sx2, sxy) sums of the weights and weighted x, y, x ^ 2 and xy.',
+    examplecodelists=[
+        "n, sx, sy, sx2, sxy = leastsquare(x, y, w)"
+    ]
+)
+
+@AppendHelp(_helpdoc['leastsquare'], join='')
+def leastsquare(x, y, w=None):
+    '''
+    Sums of the weighted least square fitting in one pass.
+    '''
+    x = floatarray(x)
+    y = floatarray(y)
+    if w is None:
+        w = np.ones(x.size, dtype=x.dtype)
+    return kernel('leastsquare')(x, y, floatarray(w))
+
+
+def cummin(values, order, result):
+    # cumulative minimum from the last value, result[order] is set
+    return kernel('cummin')(values, order, result)
+
+# ------------------
+# EOF
+# ------------------
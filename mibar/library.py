@@ -0,0 +1,322 @@
+#! /bin/env python3
+# ------------------
+# Library
+# ------------------
+
+import pandas as pd
+import numpy as np
+import logging
+import json
+import os
+
+from .decorator import helpstring
+from .decorator import AppendHelp
+
+# ------------------
+# Function
+# ------------------
+
+# 2 bit code of bases, other characters are invalid
+_BASECODE = np.full(256, -1, dtype=np.int64)
+for _i, _b in enumerate(b'ACGT'):
+    _BASECODE[_b] = _i
+
+_INVALID = np.uint64(0)
+
+# ------------------
+
+def encode_seq(seqs):
+    '''
+    Pack sequences into uint64 with 2 bits per base.
+    A leading 1 bit is put before the bases so that sequences with
+    different length get different codes. Sequences longer than
+    31 bases or containing bases other than ACGT are coded as 0.
+    '''
+    seqs = np.asarray(seqs)
+    if seqs.dtype.kind == 'U':
+        seqs = np.char.encode(seqs, 'ascii')
+    elif seqs.dtype.kind != 'S':
+        seqs = np.asarray(
+            [x if isinstance(x, bytes) else str(x).encode() for x in seqs],
+            dtype=bytes
+        )
+    codes = np.zeros(seqs.size, dtype=np.uint64)
+    if seqs.size == 0:
+        return codes
+    lengths = np.char.str_len(seqs)
+    for length in np.unique(lengths):
+        idx = np.flatnonzero(lengths == length)
+        if length == 0 or length > 31:
+            continue
+        chars = np.frombuffer(
+            seqs[idx].astype('S{0:d}'.format(length)).tobytes(), dtype=np.uint8
+        ).reshape(idx.size, length)
+        bases = _BASECODE[chars]
+        valid = (bases >= 0).all(axis=1)
+        code = np.ones(idx.size, dtype=np.uint64)
+        for i in range(length):
+            code = (code << np.uint64(2)) | bases[:, i].astype(np.uint64)
+        code[~valid] = _INVALID
+        codes[idx] = code
+    return codes
+
+# ------------------
+
+def code_length(codes):
+    # number of bases of the codes made by encode_seq
+    codes = np.asarray(codes, dtype=np.uint64)
+    length = np.zeros(codes.size, dtype=np.int64)
+    rest = codes.copy()
+    while (rest > 1).any():
+        more = rest > 1
+        length[more] += 1
+        rest[more] >>= np.uint64(2)
+    return length
+
+# ------------------
+
+def join_code(guidecodes, barcodecodes, barcodelength):
+    # combined code of guide and barcode, barcode takes 2 * length + 1 bits,
+    # shorter barcodes keep their leading 1 bit so that lengths differ
+    shift = np.uint64(2 * barcodelength + 1)
+    return (np.asarray(guidecodes, dtype=np.uint64) << shift) | barcodecodes
+
+# ------------------
+
+def neighbour_table(codes, targets, length, offset=0):
+    '''
+    Table of codes with one mismatch in bases offset to offset + length,
+    return (sorted neighbour codes, target of each neighbour code).
+    Neighbours shared by different targets, or equal to one of the codes,
+    are ambiguous and removed.
+    '''
+    codes = np.asarray(codes, dtype=np.uint64)
+    targets = np.asarray(targets)
+    shifts = (2 * (np.arange(length) + offset)).astype(np.uint64)
+    deltas = np.arange(1, 4, dtype=np.uint64)
+    flips = (deltas[np.newaxis, :] << shifts[:, np.newaxis]).ravel()
+    nbcodes = (codes[:, np.newaxis] ^ flips[np.newaxis, :]).ravel()
+    nbtargets = np.repeat(targets, flips.size)
+    unique, first, counts = np.unique(
+        nbcodes, return_index=True, return_counts=True
+    )
+    keep = (counts == 1) & ~np.isin(unique, codes)
+    return (unique[keep], nbtargets[first[keep]])
+
+# ------------------
+
+def table_lookup(keys, values, query, missing=-1):
+    # look up query in sorted keys, return values or missing
+    result = np.full(query.size, missing, dtype=values.dtype)
+    if keys.size == 0 or query.size == 0:
+        return result
+    pos = np.searchsorted(keys, query)
+    pos[pos >= keys.size] = 0
+    found = keys[pos] == query
+    result[found] = values[pos[found]]
+    return result
+
+# ------------------
+
+_helpdoc = dict()
+
+_helpdoc['LibraryIndex'] = helpstring(
+    describe='',
+    parameterdicts={
+        'arrays': 'dict, arrays of the index, made by LibraryIndex.build or LibraryIndex.load.'
+    },
+    returns='LibraryIndex, index of the library for guide and barcode look up.',
+    examplecodelists=[
+        "index = LibraryIndex.build('library.txt', mismatch=True)",
+        "index.save('library.index')",
+        "index = LibraryIndex.load('library.index')",
+        "rows = index.lookup(guides, barcodes, mismatch=True)"
+    ]
+)
+
+@AppendHelp(_helpdoc['LibraryIndex'], join='')
+class LibraryIndex:
+    '''
+    Index of the library reference (gene, guide, barcode).
+    Guides and barcodes are packed into integer keys with 2 bits per base,
+    exact look up is a binary search in the sorted keys.
+    Barcodes of different length are packed in the bits of the longest
+    barcode, the leading 1 bit of each code tells the length, and the
+    mismatch table of barcodes is built for each length.
+    With mismatch tables, guides and barcodes with one mismatch to only one
+    library sequence are also recovered.
+    The index is saved as a directory of .npy files, which are memory mapped
+    when loaded.
+    '''
+    # arrays saved in the index directory
+    arraynames = [
+        'gene', 'guide', 'barcode',
+        'key', 'row',
+        'guidekey', 'guidenbkey', 'guidenbtarget',
+        'barnbkey', 'barnbrow'
+    ]
+
+    def __init__(self, arrays, barcodelength):
+        self.arrays = arrays
+        self.barcodelength = barcodelength
+        self.gene = arrays['gene']
+        self.guide = arrays['guide']
+        self.barcode = arrays['barcode']
+        self.mismatch = arrays['guidenbkey'] is not None
+
+    def __len__(self):
+        return self.gene.shape[0]
+
+    @classmethod
+    def build(cls, filepath, mismatch=False):
+        # build the index from library file: gene <tab> guide <tab> barcode, with header
+        logging.info('Building library index: {0:s}.'.format(filepath))
+        library = pd.read_table(filepath, header=0, sep='\t', dtype=str)
+        library = library.iloc[:, 0:3]
+        library.columns = ['gene', 'guide', 'barcode']
+        gene = library['gene'].to_numpy(dtype=str)
+        guide = library['guide'].to_numpy(dtype=str)
+        barcode = library['barcode'].to_numpy(dtype=str)
+
+        guidecode = encode_seq(guide)
+        barcodecode = encode_seq(barcode)
+        barcodelengths = np.unique(code_length(barcodecode[barcodecode > 0]))
+        # the longest barcode, shorter barcodes fit in its bits
+        barcodelength = int(barcodelengths.max()) if barcodelengths.size else 0
+        valid = (guidecode > 0) & (barcodecode > 0)
+        # the joined key takes 2 * length + 1 bits of guide and of barcode
+        guidelength = int(code_length(guidecode[valid]).max()) if valid.any() else 0
+        if (2 * guidelength + 1) + (2 * barcodelength + 1) > 64:
+            logging.error(
+                'Guide of {0:d} and barcode of {1:d} bases do not fit in 64 bit keys.'.format(
+                    guidelength, barcodelength
+                )
+            )
+            raise ValueError('Guide and barcode too long.')
+        if (~valid).any():
+            logging.warning(
+                '{0:d} library items with invalid sequence are not indexed.'.format(
+                    (~valid).sum()
+                )
+            )
+        rows = np.flatnonzero(valid)
+        keys = join_code(guidecode[rows], barcodecode[rows], barcodelength)
+        # the last item wins when guide and barcode are duplicated
+        keys = keys[::-1]
+        rows = rows[::-1]
+        key, first = np.unique(keys, return_index=True)
+        row = rows[first]
+
+        arrays = {
+            'gene': gene, 'guide': guide, 'barcode': barcode,
+            'key': key, 'row': row,
+            'guidekey': np.unique(guidecode[valid]),
+            'guidenbkey': None, 'guidenbtarget': None,
+            'barnbkey': None, 'barnbrow': None
+        }
+        if mismatch:
+            guidekey = arrays['guidekey']
+            guidelen = code_length(guidekey)
+            nbkeys = list()
+            nbtargets = list()
+            for length in np.unique(guidelen):
+                k, t = neighbour_table(
+                    guidekey[guidelen == length], guidekey[guidelen == length], length
+                )
+                nbkeys.append(k)
+                nbtargets.append(t)
+            nbkey = np.concatenate(nbkeys)
+            nbtarget = np.concatenate(nbtargets)
+            order = np.argsort(nbkey)
+            arrays['guidenbkey'] = nbkey[order]
+            arrays['guidenbtarget'] = nbtarget[order]
+            # barcode neighbours of each barcode length, so that the
+            # leading 1 bit of shorter barcodes is not changed
+            keybarlen = code_length(
+                key & np.uint64((1 << (2 * barcodelength + 1)) - 1)
+            )
+            nbkeys = [np.zeros(0, dtype=np.uint64)]
+            nbrows = [np.zeros(0, dtype=row.dtype)]
+            for length in barcodelengths:
+                k, r = neighbour_table(
+                    key[keybarlen == length], row[keybarlen == length], length
+                )
+                nbkeys.append(k)
+                nbrows.append(r)
+            nbkey = np.concatenate(nbkeys)
+            nbrow = np.concatenate(nbrows)
+            order = np.argsort(nbkey)
+            arrays['barnbkey'] = nbkey[order]
+            arrays['barnbrow'] = nbrow[order]
+        return cls(arrays, barcodelength)
+
+    def save(self, dirpath):
+        # save the index as .npy files in dirpath
+        os.makedirs(dirpath, exist_ok=True)
+        for name in self.arraynames:
+            if self.arrays[name] is not None:
+                np.save(os.path.join(dirpath, name + '.npy'), self.arrays[name])
+        with open(os.path.join(dirpath, 'index.json'), 'w') as f:
+            json.dump(
+                {'barcodelength': self.barcodelength, 'mismatch': self.mismatch},
+                f
+            )
+
+    @classmethod
+    def load(cls, dirpath, mmap=True):
+        # load the index saved by save, arrays are memory mapped by default
+        logging.info('Loading library index: {0:s}.'.format(dirpath))
+        with open(os.path.join(dirpath, 'index.json')) as f:
+            meta = json.load(f)
+        arrays = dict()
+        for name in cls.arraynames:
+            filename = os.path.join(dirpath, name + '.npy')
+            if os.path.isfile(filename):
+                arrays[name] = np.load(
+                    filename, mmap_mode='r' if mmap else None
+                )
+            else:
+                arrays[name] = None
+        return cls(arrays, meta['barcodelength'])
+
+    def lookup(self, guides, barcodes, mismatch=False):
+        '''
+        Row index in library of each guide and barcode, -1 if not found.
+        With mismatch, the guide is corrected first and then the barcode.
+        '''
+        guidecode = encode_seq(guides)
+        barcodecode = encode_seq(barcodes)
+        # barcodes longer than the library barcodes would overlap the guide
+        valid = (guidecode > 0) & (barcodecode > 0) & (
+            barcodecode < np.uint64(1 << (2 * self.barcodelength + 1))
+        )
+        key = join_code(guidecode, barcodecode, self.barcodelength)
+        key[~valid] = _INVALID
+        rows = table_lookup(self.arrays['key'], self.arrays['row'], key)
+        if mismatch and self.mismatch:
+            miss = (rows < 0) & valid
+            if miss.any():
+                # correct guide
+                gcode = guidecode[miss]
+                notguide = table_lookup(
+                    self.arrays['guidekey'], self.arrays['guidekey'], gcode,
+                    missing=_INVALID
+                ) == _INVALID
+                gcode[notguide] = table_lookup(
+                    self.arrays['guidenbkey'], self.arrays['guidenbtarget'],
+                    gcode[notguide], missing=_INVALID
+                )
+                mkey = join_code(gcode, barcodecode[miss], self.barcodelength)
+                mkey[gcode == _INVALID] = _INVALID
+                mrows = table_lookup(self.arrays['key'], self.arrays['row'], mkey)
+                # correct barcode
+                barmiss = mrows < 0
+                mrows[barmiss] = table_lookup(
+                    self.arrays['barnbkey'], self.arrays['barnbrow'], mkey[barmiss]
+                )
+                rows[miss] = mrows
+        return rows
+
+# ------------------
+# EOF
+# ------------------
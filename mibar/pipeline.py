@@ -0,0 +1,293 @@
+#! /bin/env python3
+# ------------------
+# Library
+# ------------------
+
+import logging
+
+from .decorator import helpstring
+from .decorator import AppendHelp
+from .programio import readdata
+from .programio import write_table
+from .analysis import outputfiles
+from .analysis import rowcontrolstats
+from .analysis import stage_normalize
+from .analysis import stage_model
+from .analysis import stage_score
+from .analysis import stage_rank
+from .cache import AnalysisCache
+from .cache import inputkey
+from .cache import stagekey
+from .cache import programkey
+from .sysrun import has_rra_extension
+from . import kernels
+from .sysrun import peak_rss
+from .report import stagetimer
+
+# ------------------
+# Function
+# ------------------
+
+def rankroles(files, tworra):
+    # output files written by the rank aggregation stage, the roles of
+    # the same file are kept once, in the order they are written
+    roles = ['rra_low_in', 'rra_low_out', 'rra_high_in', 'rra_high_out']
+    if tworra:
+        roles += ['rra2_low_in', 'rra2_low_out', 'rra2_high_in', 'rra2_high_out']
+    result = dict()
+    for x in roles:
+        result.setdefault(files[x], x)
+    return list(result.values())
+
+# ------------------
+
+def rraprogramkey(rrapath, rrabackend):
+    # key of the RRA program or extension module used by the backend
+    if rrabackend == 'extension' and has_rra_extension():
+        from . import _rra
+        return programkey(_rra.__file__)
+    if rrabackend in ['binary', 'extension']:
+        return programkey(rrapath)
+    return None
+
+# ------------------
+
+_helpdoc = dict()
+
+_helpdoc['stagedanalysis'] = helpstring(
+    describe='',
+    parameterdicts={
+        'filepath': 'string, the input count table.',
+        'outprefix': 'string, output data name prefix.',
+        'controlids': 'list, column names of control data.',
+        'treatids': 'list, column names of treatment data.',
+        'genelab': 'string, the column name of gene.',
+        'guidelab': 'string, the column name of guide.',
+        'barcodelab': 'string, the column name of barcode.',
+        'problab': 'string, the column name of the probability of each row used in the weighted RRA, default is None.',
+        'hasbarcode': 'bool, whether the screening using barcode.',
+        'normthreshold': 'numeric, threshold used in scoring, the normalized data less than the score will be punished.',
+        'gene_test_threshold': 'numeric, p value threshold for alpha value of RRA in gene test.',
+        'test': 'string, test method, "norm" for normal test.',
+        'tworra': 'bool, using two cycles RRA for barcode analysis.',
+        'rrapath': 'string, path of RobustRankAggregation program.',
+        'rrabackend': 'string, "python" for the in process RRA, "binary" for the RRA program, "extension" for the RRA program core in process.',
+        'rracache': 'string, directory to cache the RRA permutation null, default is None.',
+        'rrathreads': 'int, number of threads of the RRA program permutation, default is 1.',
+        'rrabetatable': 'bool, interpolate the beta cdf in a cached table in the "python" RRA backend, see rra_betacdf, default is False.',
+        'workers': 'int, number of processes to run the RRA of both directions concurrently, default is 1.',
+        'outformat': 'string, format of the output tables, tsv, parquet or feather, default is tsv.',
+        'floattype': 'string, float64 or float32 for the calculated columns, default is float64.',
+        'normmethod': 'string, median ratio normalization method, see df_normalization, default is "median".',
+        'engine': 'string, csv parser engine of readdata, default is auto.',
+        'cachedir': 'string, directory of the stage artifacts, default is mibar_cache.',
+        'cachesize': 'numeric, maximum total size of the stage artifacts in MB, default is 1024.'
+    },
+    returns='pd.DataFrame, merged gene level RRA results of both directions.',
+    examplecodelists=[
+        "stagedanalysis(",
+        "    'count.csv',",
+        "    outprefix,",
+        "    controlids=['control1', 'control2'],",
+        "    treatids=['treat1', 'treat2'],",
+        "    gene_test_threshold=0.1,",
+        "    cachedir='mibar_cache'",
+        ")"
+    ]
+)
+
+@AppendHelp(_helpdoc['stagedanalysis'], join='')
+def stagedanalysis(filepath,
+                   outprefix,
+                   controlids,
+                   treatids,
+                   genelab='gene',
+                   guidelab='guide',
+                   barcodelab='barcode',
+                   problab=None,
+                   hasbarcode=True,
+                   normthreshold=10,
+                   gene_test_threshold=0.25,
+                   test='norm',
+                   tworra=False,
+                   rrapath='RRA',
+                   rrabackend='python',
+                   rracache=None,
+                   rrathreads=1,
+                   rrabetatable=False,
+                   workers=1,
+                   outformat='tsv',
+                   floattype='float64',
+                   normmethod='median',
+                   engine='auto',
+                   cachedir='mibar_cache',
+                   cachesize=1024):
+    '''
+    Incremental version of analysis reading the input file.
+    The stages normalize -> model -> score -> rank are persisted in
+    cachedir, each keyed by the key of the stage it depends on and its
+    own parameters:
+        normalize: input file content, columns, normmethod, floattype,
+                   kernel backend;
+        model: columns used to fit the model;
+        score: normthreshold, guide level adjustment, test;
+        rank: gene_test_threshold, tworra, RRA backend, threads and beta
+              table, outformat, and the content of the RRA program or
+              extension module used by the backend.
+    Only the stages whose inputs or parameters changed are run,
+    and a stage is loaded only when a later stage needs it.
+    The rank stage keeps the files it writes, which are restored under
+    the outprefix of the rerun.
+    '''
+    cache = AnalysisCache(cachedir, cachesize)
+    files = outputfiles(outprefix, hasbarcode, tworra, outformat)
+    readbarcode = hasbarcode or tworra
+    conlabels = controlids + treatids
+    if (len(controlids) > 1):
+        conlabels = controlids
+    rrakwargs = {
+        'rrapath': rrapath,
+        'backend': rrabackend,
+        'cachedir': rracache,
+        'outformat': outformat,
+        'threads': rrathreads,
+        'betatable': rrabetatable
+    }
+
+    # chained keys of the stages
+    keys = dict()
+    keys['normalize'] = stagekey(
+        inputkey(
+            filepath,
+            {
+                'genelab': genelab,
+                'guidelab': guidelab,
+                'barcodelab': barcodelab,
+                'problab': problab,
+                'controlids': list(controlids),
+                'treatids': list(treatids),
+                'hasbarcode': bool(readbarcode)
+            }
+        ),
+        'normalize',
+        {
+            'normmethod': normmethod,
+            'floattype': floattype,
+            'kernels': kernels.get_backend()
+        }
+    )
+    keys['model'] = stagekey(
+        keys['normalize'], 'model', {'conlabels': list(conlabels)}
+    )
+    keys['score'] = stagekey(
+        keys['model'], 'score',
+        {
+            'normthreshold': float(normthreshold),
+            'hasbarcode': bool(hasbarcode and not tworra),
+            'test': test
+        }
+    )
+    keys['rank'] = stagekey(
+        keys['score'], 'rank',
+        {
+            'gene_test_threshold': float(gene_test_threshold),
+            'tworra': bool(tworra),
+            'rrabackend': rrabackend,
+            'rrathreads': int(rrathreads),
+            'rrabetatable': bool(rrabetatable),
+            'outformat': outformat,
+            'rraprogram': rraprogramkey(rrapath, rrabackend)
+        }
+    )
+
+    def normalize():
+        inputdata = readdata(
+            filepath,
+            genelab=genelab,
+            guidelab=guidelab,
+            barcodelab=barcodelab,
+            controlids=controlids,
+            treatids=treatids,
+            hasbarcode=readbarcode,
+            engine=engine,
+            problab=problab
+        )
+        return {
+            'data': stage_normalize(
+                inputdata, controlids + treatids, normmethod, floattype
+            )
+        }
+
+    def model():
+        data = artifact('normalize')['data']
+        k, b = stage_model(data, conlabels)
+        return {
+            'k': k,
+            'b': b,
+            'controlstats': rowcontrolstats(
+                data, controlids, conlabels, k, b, floattype=floattype
+            )
+        }
+
+    def score():
+        data = artifact('normalize')['data']
+        fitted = artifact('model')
+        stage_score(
+            data, controlids, treatids, conlabels,
+            fitted['k'], fitted['b'],
+            hasbarcode=hasbarcode and not tworra,
+            normthreshold=normthreshold, test=test,
+            floattype=floattype, controlstats=fitted['controlstats']
+        )
+        return {'data': data}
+
+    def rank():
+        data = artifact('score')['data']
+        result = {
+            'merged': stage_rank(
+                data, files, tworra, gene_test_threshold, rrakwargs, workers
+            )
+        }
+        for x in rankroles(files, tworra):
+            with open(files[x], 'rb') as f:
+                result['file.' + x] = f.read()
+        return result
+
+    stages = {'normalize': normalize, 'model': model, 'score': score, 'rank': rank}
+    artifacts = dict()
+
+    def artifact(stage):
+        # artifact of the stage, loaded from cache or run and saved
+        if stage not in artifacts:
+            with stagetimer('cache.' + stage) as record:
+                result = cache.load(keys[stage])
+                record['hit'] = result is not None
+            if result is None:
+                logging.info('Running stage {0:s}.'.format(stage))
+                result = stages[stage]()
+                cache.save(keys[stage], result, 'stage ' + stage)
+            else:
+                logging.info('Stage {0:s} loaded from cache.'.format(stage))
+            artifacts[stage] = result
+        return artifacts[stage]
+
+    scored = artifact('score')
+    write_table(scored['data'], files['firstlevel'], outformat)
+    if cache.exists(keys['rank']):
+        ranked = artifact('rank')
+        for x in rankroles(files, tworra):
+            with open(files[x], 'wb') as f:
+                f.write(ranked['file.' + x])
+    else:
+        ranked = artifact('rank')
+    memory, childmemory = peak_rss()
+    logging.info(
+        'Peak memory: {0:.1f} MB, child processes: {1:.1f} MB.'.format(
+            memory, childmemory
+        )
+    )
+    return ranked['merged']
+
+# ------------------
+# EOF
+# ------------------
@@ -4,46 +4,214 @@
 # ------------------
 
 import pandas as pd
+import numpy as np
 import logging
 
 from .decorator import helpstring
 from .decorator import AppendHelp
+from .report import timedstage
+
+try:
+    import pyarrow
+    _HAS_PYARROW = True
+except ImportError:
+    _HAS_PYARROW = False
 
 # ------------------
 # Function
 # ------------------
 
+# compression extensions read directly by pandas
+_COMPRESSION = ['gz', 'bz2', 'xz', 'zip', 'zst']
+
 # checking functions
 
+def filetype(filepath):
+    # file extension, ignoring the compression extension
+    parts = filepath.lower().split('.')
+    if len(parts) > 2 and parts[-1] in _COMPRESSION:
+        parts = parts[:-1]
+    return parts[-1]
+
+# ------------------
+
+
 def iscsv(filepath):
-    return filepath.split('.')[-1] == 'csv'
+    return filetype(filepath) == 'csv'
 
 # ------------------
 
 
 def istsv(filepath):
-    return filepath.split('.')[-1] == 'tsv'
+    return filetype(filepath) == 'tsv'
 
 # ------------------
 
 
 def istxt(filepath):
-    return filepath.split('.')[-1] == 'txt'
+    return filetype(filepath) == 'txt'
+
+# ------------------
+
+
+def isparquet(filepath):
+    return filetype(filepath) in ['parquet', 'pq']
+
+# ------------------
+
+
+def isfeather(filepath):
+    return filetype(filepath) in ['feather', 'arrow']
+
+# ------------------
+
+
+def joinid(columns, sep='.'):
+    '''
+    Join categorical columns into one categorical id, e.g. gene.guide.
+    Codes of the columns are combined into integer keys, and the strings
+    are only built for the unique combinations.
+    '''
+    codes = np.zeros(len(columns[0]), dtype=np.int64)
+    for column in columns:
+        key = codes * len(column.cat.categories) + column.cat.codes.to_numpy()
+        _, first, codes = np.unique(key, return_index=True, return_inverse=True)
+        codes = codes.ravel()
+    parts = [
+        column.cat.categories.to_numpy(dtype=object)[
+            column.cat.codes.to_numpy()[first]
+        ]
+        for column in columns
+    ]
+    ids = pd.Index([sep.join(map(str, x)) for x in zip(*parts)], dtype=object)
+    del parts
+    return pd.Categorical.from_codes(codes, categories=ids)
+
+# ------------------
+
+
+def castcount(column, dtype):
+    # cast counts to dtype if all the values are integers that fit in it,
+    # otherwise they are kept as float64
+    values = column.to_numpy()
+    if values.dtype.kind not in 'iuf':
+        return column
+    if values.size == 0:
+        return column.astype(dtype)
+    if values.dtype.kind == 'f':
+        if not (np.isfinite(values) & (values == np.floor(values))).all():
+            return column.astype('float64')
+    info = np.iinfo(dtype)
+    if values.min() >= info.min and values.max() <= info.max:
+        return column.astype(dtype)
+    return column.astype('float64')
+
+# ------------------
+
+
+def castcounts(data, countcolumns, countdtype):
+    # cast the count columns of data by castcount, warning about the
+    # columns kept as float64
+    kept = list()
+    for x in countcolumns:
+        data[x] = castcount(data[x], countdtype)
+        if data[x].dtype != np.dtype(countdtype):
+            kept.append(x)
+    if len(kept) > 0:
+        logging.warning(
+            'Counts of {0:s} can not be read as {1:s}, reading as float64.'.format(
+                ', '.join(kept), countdtype
+            )
+        )
+    return data
 
 # ------------------
 
 
 _helpdoc = dict()
 
+_helpdoc['readtable'] = helpstring(
+    describe='',
+    parameterdicts={
+        'filepath': 'string, the table file, csv, tsv (txt), parquet or feather, csv and tsv can be compressed (.gz, .bz2, .xz, .zip, .zst).',
+        'idcolumns': 'list, column names read as categorical.',
+        'countcolumns': 'list, column names of counts.',
+        'countdtype': 'string, dtype of count columns, default is uint32, float64 is used if the counts are not integers.',
+        'floatcolumns': 'list, column names read as float64, default is None.',
+        'engine': 'string, engine of csv parser, c, pyarrow or auto, default is auto means pyarrow if installed.'
+    },
+    returns='pd.DataFrame, the table with only idcolumns and countcolumns.',
+    examplecodelists=[
+        "data = readtable(",
+        "    'count.csv.gz',",
+        "    ['gene', 'guide', 'barcode'],",
+        "    ['ctrl', 'treat']",
+        ")"
+    ]
+)
+
+@AppendHelp(_helpdoc['readtable'], join='')
+def readtable(filepath, idcolumns, countcolumns, countdtype='uint32',
+              floatcolumns=None, engine='auto'):
+    '''
+    Reading only the needed columns of a table with declared dtypes.
+    The id columns are categorical, the counts are countdtype and
+    the float columns are float64.
+    Counts are read as float64 and cast to countdtype only when all the
+    values are integers in its range, as the pyarrow engine truncates
+    fractional values read as integers instead of raising.
+    '''
+    if engine == 'auto':
+        engine = 'pyarrow' if _HAS_PYARROW else 'c'
+    if floatcolumns is None:
+        floatcolumns = list()
+    columns = list(dict.fromkeys(idcolumns + countcolumns + floatcolumns))
+
+    if isparquet(filepath) or isfeather(filepath):
+        if isparquet(filepath):
+            data = pd.read_parquet(filepath, columns=columns)
+        else:
+            data = pd.read_feather(filepath, columns=columns)
+        for x in idcolumns:
+            if not isinstance(data[x].dtype, pd.CategoricalDtype):
+                data[x] = data[x].astype(str).astype('category')
+        for x in floatcolumns:
+            data[x] = data[x].astype('float64')
+        return castcounts(data, countcolumns, countdtype)
+
+    if iscsv(filepath):
+        sep = ','
+    elif istsv(filepath) or istxt(filepath):
+        sep = '\t'
+    else:
+        logging.error('Input file should be csv, tsv, txt, parquet or feather, column should be separate by , or tab.')
+        raise ValueError('Wrong input file type.')
+
+    dtype = dict()
+    for x in idcolumns:
+        dtype[x] = 'category'
+    for x in countcolumns + floatcolumns:
+        dtype[x] = 'float64'
+    data = pd.read_csv(
+        filepath, header=0, sep=sep,
+        usecols=columns, dtype=dtype, engine=engine
+    )
+    return castcounts(data, countcolumns, countdtype)
+
+# ------------------
+
 _helpdoc['readdata'] = helpstring(
     describe='',
     parameterdicts={
-        'filepath': 'string, indicate the inputdata file, should be csv or tsv (txt)',
+        'filepath': 'string, indicate the inputdata file, should be csv, tsv (txt), parquet or feather, csv and tsv can be compressed.',
         'genelab': 'string, the column name of gene.',
         'guidelab': 'string, the column name of guide.',
         'barcodelab': 'string, the column name of barcode.',
         'controlids': 'list, list contains the column names of control data.',
         'treatids': 'list, list contains the column names of treatment data.',
+        'hasbarcode': 'bool, whether the data contain barcode.',
+        'engine': 'string, engine of csv parser, c, pyarrow or auto.',
+        'problab': 'string, the column name of the probability of each row used in the weighted RRA, default is None means no probability.'
     },
     returns='pd.DataFrame, the DataFrame containing the input data.',
     examplecodelists=[
@@ -60,6 +228,7 @@ _helpdoc['readdata'] = helpstring(
 )
 
 @AppendHelp(_helpdoc['readdata'], join='')
+@timedstage('readdata')
 def readdata(
         filepath,
         genelab,
@@ -67,26 +236,34 @@ def readdata(
         barcodelab,
         controlids,
         treatids,
-        hasbarcode=True):
+        hasbarcode=True,
+        engine='auto',
+        problab=None):
     '''
     Reading input data.
-    The input data should be saved as csv or tsv (txt),
+    The input data should be saved as csv or tsv (txt), optionally
+    compressed, or parquet or feather,
     each columns should have a header and separate by "," or tab.
+    Only the needed columns are read, counts are read as uint32 when
+    they are all integers.
     The columns should contain:
         <gene>, <guide>, <barcode>,
         <control1>, [<control2>, ...],
-        <treat1>, [<treat2>, ...]
+        <treat1>, [<treat2>, ...], [<prob>]
+    The gene, guide, barcode and the ids (gid, bid) are returned as
+    categorical columns, so that grouping works on integer codes.
     '''
-    # check whether the input file as csv or tsv
     logging.info('Reading data: {0:s}.'.format(filepath))
 
-    if (iscsv(filepath)):
-        inputdata = pd.read_csv(filepath, header=0)
-    elif (istsv(filepath) or istxt(filepath)):
-        inputdata = pd.read_table(filepath, header=0, sep='\t')
+    if hasbarcode:
+        idcolumns = [genelab, guidelab, barcodelab]
     else:
-        logging.error('Input file should be csv, tsv or txt, column should be separate by , or tab.')
-        raise ValueError('Wrong input file type.')
+        idcolumns = [genelab, guidelab]
+    floatcolumns = [problab] if problab is not None else []
+    inputdata = readtable(
+        filepath, idcolumns, controlids + treatids,
+        floatcolumns=floatcolumns, engine=engine
+    )
 
     logging.info(
         'Data with {0:d} Controls, {1:d} Treatments,'.format(
@@ -110,20 +287,28 @@ def readdata(
         'gene', 'guide', 'gid', 'barcode', 'bid'
     ] + controlids + treatids
 
+    # probability of each row for the weighted RRA
+    if problab is not None:
+        colnm1 += [problab]
+        colnm2 += ['prob']
+        colnm3 += ['prob']
+
     # select columns
-    data = inputdata[colnm1].copy()
+    data = inputdata[colnm1]
     # rename column names
     data.columns = colnm2
 
+    if problab is not None:
+        prob = data['prob'].to_numpy()
+        if not ((prob >= 0) & (prob <= 1)).all():
+            logging.error('Probabilities in column {0:s} should be between 0 and 1.'.format(problab))
+            raise ValueError('Wrong probability.')
+
     # make guide level id
-    data['gid'] = data[['gene', 'guide']].apply(
-        lambda x: '.'.join(x), axis=1
-    )
+    data['gid'] = joinid([data['gene'], data['guide']])
     # make barcode level id if barcode exists
     if hasbarcode:
-        data['bid'] = inputdata[['gene', 'guide', 'barcode']].apply(
-            lambda x: '.'.join(x), axis=1
-        )
+        data['bid'] = joinid([data['gene'], data['guide'], data['barcode']])
     else:
         data['bid'] = data['gid']
 
@@ -135,6 +320,97 @@ def readdata(
 
 # ------------------
 
+_helpdoc['readchunks'] = helpstring(
+    describe='',
+    parameterdicts={
+        'filepath': 'string, the table file, csv, tsv (txt) or parquet, csv and tsv can be compressed.',
+        'idcolumns': 'list, column names read as string.',
+        'countcolumns': 'list, column names of counts, read as float64.',
+        'chunksize': 'int, number of rows in each chunk, parquet is read by record batches of this size.'
+    },
+    returns='generator, pd.DataFrame chunks with only idcolumns and countcolumns.',
+    examplecodelists=[
+        "for chunk in readchunks('count.csv.gz', ['gene', 'guide'], ['ctrl', 'treat'], 1000000):",
+        "    print(chunk.shape)"
+    ]
+)
+
+@AppendHelp(_helpdoc['readchunks'], join='')
+def readchunks(filepath, idcolumns, countcolumns, chunksize):
+    '''
+    Reading the needed columns of a table chunk by chunk,
+    so that only one chunk is kept in memory.
+    '''
+    columns = list(dict.fromkeys(idcolumns + countcolumns))
+    dtype = dict()
+    for x in idcolumns:
+        dtype[x] = str
+    for x in countcolumns:
+        dtype[x] = 'float64'
+
+    if isparquet(filepath):
+        import pyarrow.parquet
+        parquetfile = pyarrow.parquet.ParquetFile(filepath)
+        for batch in parquetfile.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas().astype(dtype)
+        return
+
+    if iscsv(filepath):
+        sep = ','
+    elif istsv(filepath) or istxt(filepath):
+        sep = '\t'
+    else:
+        logging.error('Input file should be csv, tsv, txt or parquet in chunked analysis.')
+        raise ValueError('Wrong input file type.')
+    # the pyarrow engine does not read by chunks
+    reader = pd.read_csv(
+        filepath, header=0, sep=sep, usecols=columns,
+        dtype=dtype, chunksize=chunksize
+    )
+    with reader:
+        for chunk in reader:
+            yield chunk
+
+# ------------------
+
+_helpdoc['read_manifest'] = helpstring(
+    describe='',
+    parameterdicts={
+        'filepath': 'string, tab separated comparison manifest with a header line and columns: name, control, treatment. Control and treatment are comma separated column names of the count table, lines starting with # are ignored.'
+    },
+    returns='list, (name, controlids, treatids) of each comparison.',
+    examplecodelists=[
+        "comparisons = read_manifest('comparisons.txt')"
+    ]
+)
+
+@AppendHelp(_helpdoc['read_manifest'], join='')
+def read_manifest(filepath):
+    '''
+    Read the comparisons of batch analysis.
+    '''
+    manifest = pd.read_table(filepath, header=0, dtype=str, comment='#')
+    if not set(['name', 'control', 'treatment']).issubset(manifest.columns):
+        logging.error('Manifest should have columns: name, control, treatment.')
+        raise ValueError('Wrong manifest columns.')
+    if manifest['name'].duplicated().any():
+        logging.error('Comparison names in manifest should be unique.')
+        raise ValueError('Duplicated comparison names.')
+    comparisons = list()
+    for name, control, treatment in zip(
+            manifest['name'], manifest['control'], manifest['treatment']):
+        controlids = [x.strip() for x in control.split(',') if x.strip()]
+        treatids = [x.strip() for x in treatment.split(',') if x.strip()]
+        if len(controlids) == 0 or len(treatids) == 0:
+            logging.error(
+                'Comparison {0:s} should have control and treatment.'.format(name)
+            )
+            raise ValueError('Empty control or treatment.')
+        comparisons.append((name, controlids, treatids))
+    return comparisons
+
+# ------------------
+
 def read_rra(filename):
     # read the result file generated by RRA, return dataframe
     data = pd.read_table(filename, header=0)
@@ -143,6 +419,122 @@ def read_rra(filename):
 
 # ------------------
 
+def round_rra(data):
+    # lo-value, p and FDR rounded as written in the RRA output file,
+    # so that results computed in process equal the ones read back
+    data = data.copy()
+    data['beta'] = [float('{0:10.4e}'.format(x)) for x in data['beta']]
+    data['p'] = [float('{0:10.4e}'.format(x)) for x in data['p']]
+    data['FDR'] = [float('{0:f}'.format(x)) for x in data['FDR']]
+    return data
+
+# ------------------
+
+def write_rra(data, filename):
+    # write the RRA result dataframe in the format of RRA output file
+    fmt = '{0}\t{1:d}\t{2:10.4e}\t{3:10.4e}\t{4:f}\t{5:d}\n'
+    with open(filename, 'w') as f:
+        f.write('group_id\titems_in_group\tlo_value\tp\tFDR\tgoodsgrna\n')
+        for row in zip(data['group_id'], data['items_in_group'], data['beta'],
+                       data['p'], data['FDR'], data['goodsgrna']):
+            f.write(fmt.format(*row))
+
+# ------------------
+
+# file extension of each output format
+_TABLEEXT = {'tsv': '.txt', 'parquet': '.parquet', 'feather': '.feather'}
+
+def tableext(outformat):
+    # file extension of the output format
+    if outformat not in _TABLEEXT:
+        logging.error('Output format should be tsv, parquet or feather.')
+        raise ValueError('Wrong output format.')
+    return _TABLEEXT[outformat]
+
+# ------------------
+
+def compacttable(data):
+    # strings as categorical and integers downcast, for columnar output
+    result = data.reset_index(drop=True)
+    for x in result.columns:
+        if result[x].dtype == object or pd.api.types.is_string_dtype(result[x].dtype):
+            result[x] = result[x].astype('category')
+        elif result[x].dtype.kind == 'i':
+            result[x] = pd.to_numeric(result[x], downcast='integer')
+        elif result[x].dtype.kind == 'u':
+            result[x] = pd.to_numeric(result[x], downcast='unsigned')
+    return result
+
+# ------------------
+
+_helpdoc['write_table'] = helpstring(
+    describe='',
+    parameterdicts={
+        'data': 'pd.DataFrame, the table to write.',
+        'filename': 'string, the output file path.',
+        'outformat': 'string, tsv, parquet or feather, default is tsv.'
+    },
+    returns='No specific returns.',
+    examplecodelists=[
+        "write_table(data, 'out.barcode.parquet', 'parquet')"
+    ]
+)
+
+@AppendHelp(_helpdoc['write_table'], join='')
+@timedstage('write_table')
+def write_table(data, filename, outformat='tsv'):
+    '''
+    Write the table as tab separated text, or as parquet or feather
+    with compact dtypes.
+    '''
+    if outformat == 'tsv':
+        data.to_csv(filename, index=False, sep='\t')
+    elif outformat == 'parquet':
+        compacttable(data).to_parquet(filename, index=False)
+    elif outformat == 'feather':
+        compacttable(data).to_feather(filename)
+    else:
+        logging.error('Output format should be tsv, parquet or feather.')
+        raise ValueError('Wrong output format.')
+
+# ------------------
+
+class TableWriter:
+    '''
+    Write a table chunk by chunk, as tab separated text or parquet.
+    '''
+    def __init__(self, filename, outformat='tsv'):
+        if outformat not in ['tsv', 'parquet']:
+            logging.error('Output format should be tsv or parquet when writing by chunks.')
+            raise ValueError('Wrong output format.')
+        self.filename = filename
+        self.outformat = outformat
+        self.writer = None
+
+    def write(self, data):
+        if self.outformat == 'tsv':
+            if self.writer is None:
+                self.writer = open(self.filename, 'w')
+                data.to_csv(self.writer, index=False, sep='\t')
+            else:
+                data.to_csv(self.writer, index=False, sep='\t', header=False)
+        else:
+            import pyarrow
+            import pyarrow.parquet
+            table = pyarrow.Table.from_pandas(data, preserve_index=False)
+            if self.writer is None:
+                self.writer = pyarrow.parquet.ParquetWriter(
+                    self.filename, table.schema
+                )
+            self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+# ------------------
+
 def merge_rra(geneinfo, rralow, rrahigh):
     pass
 
@@ -0,0 +1,192 @@
+#! /bin/env python3
+# ------------------
+# Library
+# ------------------
+
+import json
+import logging
+import platform
+import resource
+import sys
+import time
+import functools
+from contextlib import contextmanager
+
+from .decorator import helpstring
+from .decorator import AppendHelp
+
+# ------------------
+# Function
+# ------------------
+
+# the report stages are recorded to, None means no recording
+_active = None
+
+def usage():
+    # cpu time in seconds and peak resident set size in MB of this
+    # process and of the terminated child processes, ru_maxrss is in
+    # bytes on macOS and in kilobytes elsewhere
+    scale = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'wall': time.perf_counter(),
+        'cpu': own.ru_utime + own.ru_stime,
+        'child_cpu': children.ru_utime + children.ru_stime,
+        'rss': own.ru_maxrss / scale,
+        'child_rss': children.ru_maxrss / scale
+    }
+
+# ------------------
+
+def usagerecord(start, end):
+    # wall and cpu time, peak memory between two usage
+    return {
+        'wall_s': round(end['wall'] - start['wall'], 6),
+        'cpu_s': round(end['cpu'] - start['cpu'], 6),
+        'child_cpu_s': round(end['child_cpu'] - start['child_cpu'], 6),
+        'peak_rss_mb': round(end['rss'], 3),
+        'peak_rss_increase_mb': round(end['rss'] - start['rss'], 3),
+        'child_peak_rss_mb': round(end['child_rss'], 3)
+    }
+
+# ------------------
+
+class RunReport:
+    '''
+    Wall time, cpu time, peak memory and rows of the stages of a run.
+    The peak resident set size is the peak of the process up to the end
+    of a stage, the increase is how much the stage raised the peak.
+    Child processes are counted after they terminated, such as the RRA
+    program and the process pools, the peak of a forked child includes
+    the pages it shared with this process.
+    '''
+    def __init__(self):
+        self.start = usage()
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.stages = list()
+        self.depth = 0
+
+    def to_dict(self, **info):
+        result = {
+            'started': self.started,
+            'command': sys.argv,
+            'python': platform.python_version(),
+            'platform': platform.platform()
+        }
+        result.update(info)
+        result['total'] = usagerecord(self.start, usage())
+        result['stages'] = self.stages
+        return result
+
+    def save(self, filename, **info):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(**info), f, indent=2)
+        logging.info('Run report saved: {0:s}'.format(filename))
+
+# ------------------
+
+def start_report():
+    # start recording stages to a new report
+    global _active
+    _active = RunReport()
+    return _active
+
+# ------------------
+
+def stop_report():
+    # stop recording stages, return the report
+    global _active
+    report = _active
+    _active = None
+    return report
+
+# ------------------
+
+_helpdoc = dict()
+
+_helpdoc['stagetimer'] = helpstring(
+    describe='',
+    parameterdicts={
+        'name': 'string, name of the stage.',
+        'rows': 'int, number of rows processed by the stage, can also be set in the yielded record, default is None.'
+    },
+    returns='dict, the record of the stage, more fields such as rows can be added.',
+    examplecodelists=[
+        "with stagetimer('normalize') as record:",
+        "    data = stage_normalize(inputdata, labels)",
+        "    record['rows'] = data.shape[0]"
+    ]
+)
+
+@AppendHelp(_helpdoc['stagetimer'], join='')
+@contextmanager
+def stagetimer(name, rows=None):
+    '''
+    Record the wall time, cpu time, peak memory and rows of a stage
+    to the report started by start_report, nothing is recorded without it.
+    Nested stages are recorded with their depth, before the outer stage.
+    '''
+    record = {'stage': name, 'rows': rows}
+    report = _active
+    if report is None:
+        yield record
+        return
+    record['depth'] = report.depth
+    report.depth += 1
+    start = usage()
+    try:
+        yield record
+    finally:
+        report.depth -= 1
+        record.update(usagerecord(start, usage()))
+        if record['rows'] is not None:
+            record['rows'] = int(record['rows'])
+        report.stages.append(record)
+
+# ------------------
+
+def tablerows(value):
+    # number of rows of a table, None for other values
+    shape = getattr(value, 'shape', None)
+    if shape is None or len(shape) == 0:
+        return None
+    return shape[0]
+
+# ------------------
+
+_helpdoc['timedstage'] = helpstring(
+    describe='',
+    parameterdicts={
+        'name': 'string, name of the stage.'
+    },
+    returns='function, decorator recording each call of the function by stagetimer.',
+    examplecodelists=[
+        "@timedstage('normalize')",
+        "def stage_normalize(inputdata, countids):",
+        "    ..."
+    ]
+)
+
+@AppendHelp(_helpdoc['timedstage'], join='')
+def timedstage(name):
+    '''
+    Decorator recording each call of the function as a stage.
+    The rows are the rows of the first argument, positional or keyword,
+    if it is a table, otherwise the rows of the returned table.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stagetimer(name) as record:
+                result = func(*args, **kwargs)
+                first = args[0] if len(args) > 0 else next(iter(kwargs.values()), None)
+                rows = tablerows(first)
+                record['rows'] = rows if rows is not None else tablerows(result)
+            return result
+        return wrapper
+    return decorator
+
+# ------------------
+# EOF
+# ------------------
@@ -0,0 +1,592 @@
+#! /bin/env python3
+# ------------------
+# Library
+# ------------------
+
+import pandas as pd
+import numpy as np
+import logging
+import os
+from scipy.special import betainc
+from scipy.special import betaln
+
+from .decorator import helpstring
+from .decorator import AppendHelp
+from .fdr import fdr_bh
+
+# ------------------
+# Function
+# ------------------
+
+# number of matrix cells generated at once in permutation
+_NULL_CHUNK_CELLS = 1 << 20
+
+# number of matrix cells of each block of null lo-values in rra_sizenull
+_NULL_BLOCK_CELLS = 1 << 16
+
+# null lo-values already generated in this process, in the order of use,
+# and the maximum number of lo-values kept
+_null_memory = dict()
+_NULL_MEMORY_VALUES = 1 << 24
+
+# grid of the beta cdf table, log x from the minimum to the maximum,
+# and the largest group size in the table. The relative error is below
+# 3e-8 on this grid, and grows quickly for larger x where the log x grid
+# is coarse. Cdf smaller than the minimum are computed exactly, as the
+# grid points where the cdf underflows are approximated
+_BETA_TABLE_POINTS = 512
+_BETA_TABLE_XMIN = 1e-8
+_BETA_TABLE_XMAX = 0.1
+_BETA_TABLE_MAXSIZE = 64
+_BETA_TABLE_CDFMIN = 1e-250
+
+# beta cdf table built in this process, the 4 cubic coefficients of each
+# interval of the grid, intervals of each group size and rank in a row
+_beta_memory = dict(size=0, table=np.empty((4, 0)))
+
+_helpdoc = dict()
+
+_helpdoc['rra_percentile'] = helpstring(
+    describe='',
+    parameterdicts={
+        'values': 'array like, values of all the items in the ranked list.'
+    },
+    returns='np.ndarray, percentile of each item in the ranked list.',
+    examplecodelists=[
+        "percentiles = rra_percentile(data['p'])"
+    ]
+)
+
+@AppendHelp(_helpdoc['rra_percentile'], join='')
+def rra_percentile(values):
+    '''
+    Percentile of each item in the list ranked by value.
+    Tied items get the middle percentile of the tie, as RRA does.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    n = values.size
+    sortvalues = np.sort(values)
+    index1 = np.searchsorted(sortvalues, values, side='left')
+    index2 = np.searchsorted(sortvalues, values, side='right') - 1
+    return (index1 + index2 + 1.0) / (2.0 * n)
+
+# ------------------
+
+def rra_betatable(size):
+    # table of the log beta cdf of the order statistics of group sizes up
+    # to size, the intervals of size n and rank k start at
+    # (n * (n - 1) / 2 + k - 1) * (points - 1).
+    # It is extended when a larger size is needed, and kept for the process
+    if size <= _beta_memory['size']:
+        return _beta_memory['table']
+    logx = np.linspace(
+        np.log(_BETA_TABLE_XMIN), np.log(_BETA_TABLE_XMAX), _BETA_TABLE_POINTS
+    )
+    step = logx[1] - logx[0]
+    x = np.exp(logx)
+    tables = [_beta_memory['table']]
+    for n in range(_beta_memory['size'] + 1, size + 1):
+        rank = np.arange(1, n + 1, dtype=np.float64)[:, np.newaxis]
+        logpdf = (rank - 1.0) * logx + (n - rank) * np.log1p(-x) \
+            - betaln(rank, n - rank + 1.0)
+        cdf = betainc(rank, n - rank + 1.0, x)
+        # cdf = x * pdf / k for small x, used where the cdf underflows
+        small = cdf < 1e-280
+        logcdf = np.where(
+            small, logx + logpdf - np.log(rank), np.log(np.where(small, 1.0, cdf))
+        )
+        slope = np.where(small, rank, np.exp(logx + logpdf - logcdf))
+        y0, y1 = logcdf[:, :-1], logcdf[:, 1:]
+        d0, d1 = step * slope[:, :-1], step * slope[:, 1:]
+        tables.append(
+            np.stack(
+                [y0, d0, 3.0 * (y1 - y0) - 2.0 * d0 - d1, 2.0 * (y0 - y1) + d0 + d1]
+            ).reshape(4, -1)
+        )
+    _beta_memory['table'] = np.concatenate(tables, axis=1)
+    _beta_memory['size'] = size
+    return _beta_memory['table']
+
+# ------------------
+
+_helpdoc['rra_betacdf'] = helpstring(
+    describe='',
+    parameterdicts={
+        'rank': 'array like, rank k of the order statistic, from 1 to size.',
+        'size': 'array like, number of items n in the group.',
+        'x': 'array like, percentiles.',
+        'betatable': 'bool, interpolate in the cached table instead of computing the incomplete beta function, default is False.'
+    },
+    returns='np.ndarray, BetaCdf(x; k, n - k + 1) of each element.',
+    examplecodelists=[
+        "score = rra_betacdf(rank, 10, x, betatable=True)"
+    ]
+)
+
+@AppendHelp(_helpdoc['rra_betacdf'], join='')
+def rra_betacdf(rank, size, x, betatable=False):
+    '''
+    Cdf of the k-th smallest of n uniform percentiles, the regularized
+    incomplete beta function I_x(k, n - k + 1).
+    With betatable, log cdf is interpolated by cubic Hermite splines in
+    log x, on a table built once for each n and kept for the process,
+    so that the lo-values and the permutation of all screens reuse it.
+    The relative error is below 3e-8, x out of 1e-8 to 0.1, n larger
+    than 64 and cdf smaller than 1e-250 are computed exactly.
+    '''
+    rank, size, x = np.broadcast_arrays(
+        np.asarray(rank, dtype=np.float64),
+        np.asarray(size, dtype=np.float64),
+        np.asarray(x, dtype=np.float64)
+    )
+    if not betatable:
+        return betainc(rank, size - rank + 1.0, x)
+    result = np.zeros(x.shape)
+    intable = (size <= _BETA_TABLE_MAXSIZE) & (x >= _BETA_TABLE_XMIN) \
+        & (x <= _BETA_TABLE_XMAX)
+    exact = ~intable
+    if exact.any():
+        result[exact] = betainc(
+            rank[exact], size[exact] - rank[exact] + 1.0, x[exact]
+        )
+    if not intable.any():
+        return result
+    n = size[intable].astype(np.intp)
+    table = rra_betatable(int(n.max()))
+    step = (np.log(_BETA_TABLE_XMAX) - np.log(_BETA_TABLE_XMIN)) \
+        / (_BETA_TABLE_POINTS - 1)
+    t = (np.log(x[intable]) - np.log(_BETA_TABLE_XMIN)) / step
+    i = np.clip(t.astype(np.intp), 0, _BETA_TABLE_POINTS - 2)
+    index = (n * (n - 1) // 2 + rank[intable].astype(np.intp) - 1) \
+        * (_BETA_TABLE_POINTS - 1) + i
+    f = t - i
+    value = table[3].take(index) * f + table[2].take(index)
+    value *= f * f
+    value += table[1].take(index) * f + table[0].take(index)
+    result[intable] = np.exp(value)
+    # tiny cdf, where the table is not accurate
+    tiny = np.flatnonzero(intable)[value < np.log(_BETA_TABLE_CDFMIN)]
+    if tiny.size > 0:
+        result.flat[tiny] = betainc(
+            rank.flat[tiny], size.flat[tiny] - rank.flat[tiny] + 1.0, x.flat[tiny]
+        )
+    return result
+
+# ------------------
+
+_helpdoc['rra_lovalue'] = helpstring(
+    describe='',
+    parameterdicts={
+        'codes': 'np.ndarray, integer group code of each item, from 0 to groupnum - 1.',
+        'percentiles': 'np.ndarray, percentile of each item.',
+        'groupnum': 'int, number of groups.',
+        'percentile': 'numeric, maximum percentile, items with larger percentile are not considered.',
+        'betatable': 'bool, use the cached beta cdf table, see rra_betacdf, default is False.'
+    },
+    returns='tuple, (lovalue, goodsgrna) arrays indexed by group code.',
+    examplecodelists=[
+        "lovalue, goodsgrna = rra_lovalue(codes, percentiles, 100, 0.1)"
+    ]
+)
+
+@AppendHelp(_helpdoc['rra_lovalue'], join='')
+def rra_lovalue(codes, percentiles, groupnum, percentile, betatable=False):
+    '''
+    Compute lo-values of all the groups at once.
+    For a group with n items and sorted percentiles x1 <= x2 <= ... <= xn,
+    lo-value = min(BetaCdf(xk; k, n - k + 1)), with k runs over the items
+    smaller than the maximum percentile (at least the first item).
+    '''
+    codes = np.asarray(codes, dtype=np.int64)
+    percentiles = np.asarray(percentiles, dtype=np.float64)
+    lovalue = np.ones(groupnum)
+    goodsgrna = np.zeros(groupnum, dtype=np.int64)
+    if codes.size == 0:
+        return (lovalue, goodsgrna)
+    order = np.lexsort((percentiles, codes))
+    codes = codes[order]
+    x = percentiles[order]
+    size = np.bincount(codes, minlength=groupnum)
+    start = np.cumsum(size) - size
+    rank = np.arange(codes.size) - start[codes]
+    n = size[codes]
+    goodsgrna = np.bincount(
+        codes, weights=x <= percentile, minlength=groupnum
+    ).astype(np.int64)
+    limit = np.maximum(goodsgrna, 1)
+    used = rank < limit[codes]
+    score = np.ones(codes.size)
+    score[used] = rra_betacdf(rank[used] + 1.0, n[used], x[used], betatable)
+    hasitem = size > 0
+    lovalue[hasitem] = np.minimum.reduceat(score, start[hasitem])
+    lovalue = np.minimum(lovalue, 1.0)
+    return (lovalue, goodsgrna)
+
+# ------------------
+
+_helpdoc['rra_null'] = helpstring(
+    describe='',
+    parameterdicts={
+        'size': 'int, number of items in the group.',
+        'number': 'int, number of random lo-values to generate.',
+        'percentile': 'numeric, maximum percentile used in lo-value calculation.',
+        'rng': 'np.random.Generator, random number generator.',
+        'betatable': 'bool, use the cached beta cdf table, see rra_betacdf, default is False.'
+    },
+    returns='np.ndarray, lo-values of groups with uniformly distributed percentiles.',
+    examplecodelists=[
+        "null = rra_null(4, 10000, 0.1, np.random.default_rng(123456))"
+    ]
+)
+
+@AppendHelp(_helpdoc['rra_null'], join='')
+def rra_null(size, number, percentile, rng, betatable=False):
+    '''
+    Null distribution of lo-value for groups of the same size.
+    Random percentiles are drawn as a matrix, one group per row.
+    '''
+    result = np.empty(number)
+    if size == 0:
+        result[:] = 1.0
+        return result
+    rank = np.arange(1, size + 1, dtype=np.float64)
+    rows = max(_NULL_CHUNK_CELLS // size, 1)
+    for i in range(0, number, rows):
+        m = min(rows, number - i)
+        x = rng.random((m, size))
+        x.sort(axis=1)
+        limit = np.maximum((x <= percentile).sum(axis=1), 1)
+        used = rank <= limit[:, np.newaxis]
+        score = np.ones(x.shape)
+        score[used] = rra_betacdf(
+            np.broadcast_to(rank, x.shape)[used], size, x[used], betatable
+        )
+        result[i:(i + m)] = np.minimum(score.min(axis=1), 1.0)
+    return result
+
+# ------------------
+
+def rra_probtail(x, p):
+    # distribution of the number of chosen tail items, columns 0 to the
+    # number of tail items, and the expected lo-value when only tail items
+    # are chosen: the first chosen item gets rank 1, BetaCdf(x; 1, n),
+    # and the lo-value is 1 when no item is chosen
+    m, tail = x.shape
+    # suffix[:, j, c], probability of c chosen items from item j to the last
+    suffix = np.zeros((m, tail + 1, tail + 1))
+    suffix[:, tail, 0] = 1.0
+    for j in range(tail - 1, -1, -1):
+        pj = p[:, j, np.newaxis]
+        suffix[:, j] = suffix[:, j + 1] * (1.0 - pj)
+        suffix[:, j, 1:] += suffix[:, j + 1, :-1] * pj
+    none = np.cumprod(1.0 - p, axis=1)
+    before = np.ones((m, tail))
+    before[:, 1:] = none[:, :-1]
+    # BetaCdf(x; 1, 1 + c) = 1 - (1 - x) ^ (1 + c), c chosen items after x
+    first = -np.expm1(
+        np.arange(1, tail + 1)[np.newaxis, np.newaxis, :]
+        * np.log1p(-x)[:, :, np.newaxis]
+    )
+    empty = (before * p * (suffix[:, 1:, :tail] * first).sum(axis=2)).sum(axis=1)
+    if tail > 0:
+        empty += none[:, -1]
+    else:
+        empty += 1.0
+    return (suffix[:, 0], empty)
+
+
+def rra_probexpect(x, p, head):
+    # expected lo-value of groups with the same size and the same number
+    # of head items, the items not larger than the maximum percentile
+    m, size = x.shape
+    count, empty = rra_probtail(x[:, head:], p[:, head:])
+    result = empty * np.prod(1.0 - p[:, :head], axis=1)
+    if head == 0:
+        return result
+    tail = size - head
+    item, rank = np.nonzero(np.tri(head, dtype=bool))
+    rank += 1
+    for n in range(1, size + 1):
+        # the cells of head item and rank, and their beta cdf levels
+        cell = rank <= n
+        ci, cr = item[cell], rank[cell]
+        value = rra_betacdf(cr, n, x[:, ci])
+        levels = np.zeros((m, ci.size + 2))
+        levels[:, 1:-1] = np.sort(value, axis=1)
+        levels[:, -1] = 1.0
+        # P(lo-value > t) is constant between levels, the probability that
+        # h head items are chosen and all their cells are above the level
+        above = value[:, np.newaxis, :] > levels[:, :-1, np.newaxis]
+        dp = np.zeros((m, ci.size + 1, head + 1))
+        dp[:, :, 0] = 1.0
+        for i in range(head):
+            j = np.flatnonzero(ci == i)
+            pi = p[:, i, np.newaxis, np.newaxis]
+            chosen = dp[:, :, cr[j] - 1] * pi * above[:, :, j]
+            dp *= 1.0 - pi
+            dp[:, :, cr[j]] += chosen
+        # with n - h chosen tail items
+        h = np.arange(max(n - tail, 1), min(head, n) + 1)
+        survival = (dp[:, :, h] * count[:, np.newaxis, n - h]).sum(axis=2)
+        result += (survival * np.diff(levels, axis=1)).sum(axis=1)
+    return result
+
+# ------------------
+
+_helpdoc['rra_problovalue'] = helpstring(
+    describe='',
+    parameterdicts={
+        'percentiles': 'np.ndarray, percentiles of groups of the same size, one group per row.',
+        'probs': 'np.ndarray, probability of each item, the same shape as percentiles.',
+        'percentile': 'numeric, maximum percentile used in lo-value calculation.'
+    },
+    returns='np.ndarray, probability weighted lo-value of each group.',
+    examplecodelists=[
+        "lovalue = rra_problovalue(percentiles, probs, 0.1)"
+    ]
+)
+
+@AppendHelp(_helpdoc['rra_problovalue'], join='')
+def rra_problovalue(percentiles, probs, percentile):
+    '''
+    Expected lo-value of groups whose items are each chosen with
+    its probability, as the RRA program with probabilities.
+    The lo-value of a subset is the lo-value of the chosen items,
+    and 1 for the empty subset.
+    Only the chosen items not larger than the maximum percentile, the head
+    items, are ranked, the other items only add to the number of chosen
+    items, or give the first chosen item when no head item is chosen.
+    Given the number of chosen items, the probability that the lo-value
+    is larger than t is a dynamic programme over the head items and their
+    ranks, and it only changes at the beta cdf of the head items, so the
+    expectation is exact without enumerating the 2^n subsets.
+    The cost is O(n k^4) for a group of n items with k head items.
+    '''
+    percentiles = np.asarray(percentiles, dtype=np.float64)
+    probs = np.asarray(probs, dtype=np.float64)
+    groupnum, size = percentiles.shape
+    result = np.ones(groupnum)
+    if groupnum == 0 or size == 0:
+        return result
+    order = np.argsort(percentiles, axis=1)
+    x = np.take_along_axis(percentiles, order, axis=1)
+    p = np.take_along_axis(probs, order, axis=1)
+    heads = (x <= percentile).sum(axis=1)
+    for head in np.unique(heads):
+        index = np.flatnonzero(heads == head)
+        cells = size * size + (head * head + 2) * head * (head + 1)
+        rows = max(_NULL_CHUNK_CELLS // cells, 1)
+        for i in range(0, index.size, rows):
+            group = index[i:(i + rows)]
+            result[group] = rra_probexpect(x[group], p[group], int(head))
+    return result
+
+# ------------------
+
+_helpdoc['rra_sizenull'] = helpstring(
+    describe='',
+    parameterdicts={
+        'size': 'int, number of items in the group.',
+        'number': 'int, number of random lo-values needed.',
+        'percentile': 'numeric, maximum percentile used in lo-value calculation.',
+        'permutation': 'int, the number of rounds of permutation.',
+        'seed': 'int, seed of the random number generator.',
+        'cachedir': 'string, directory to save the null lo-values, default is None means only cached in memory.',
+        'betatable': 'bool, use the cached beta cdf table, see rra_betacdf, default is False.'
+    },
+    returns='np.ndarray, the first number null lo-values, sorted.',
+    examplecodelists=[
+        "null = rra_sizenull(4, 10100, 0.1, 100, cachedir='rra_cache')"
+    ]
+)
+
+@AppendHelp(_helpdoc['rra_sizenull'], join='')
+def rra_sizenull(size, number, percentile, permutation, seed=123456, cachedir=None,
+                 betatable=False):
+    '''
+    Cached null distribution of lo-value for one group size.
+    The null is keyed by group size, maximum percentile, permutation, seed
+    and whether the beta cdf table is used.
+    Null lo-values are drawn in blocks, each block by its own random number
+    generator seeded by the block index, and kept in the order of drawing
+    in memory and in cachedir. Exactly the first number lo-values are used,
+    so the result does not depend on what was cached before.
+    '''
+    key = (int(size), float(percentile), int(permutation), int(seed), bool(betatable))
+    block = max(_NULL_BLOCK_CELLS // max(key[0], 1), 1)
+    null = _null_memory.pop(key, None)
+    filename = None
+    if cachedir is not None:
+        filename = os.path.join(
+            cachedir,
+            'rra_null.size{0:d}.p{1:.12g}.perm{2:d}.seed{3:d}{4:s}.blocks.npy'.format(
+                *key[:4], '.table' if key[4] else ''
+            )
+        )
+        if null is None and os.path.isfile(filename):
+            null = np.load(filename)
+            if null.size % block != 0:
+                logging.warning(
+                    'Ignore RRA null cache {0:s} with incomplete blocks.'.format(filename)
+                )
+                null = None
+    if null is None:
+        null = np.empty(0)
+    if null.size < number:
+        blocks = [null]
+        for i in range(null.size // block, -(-number // block)):
+            rng = np.random.default_rng([key[3], key[0], key[2], i])
+            blocks.append(rra_null(size, block, percentile, rng, betatable))
+        null = np.concatenate(blocks)
+        if filename is not None:
+            os.makedirs(cachedir, exist_ok=True)
+            tmpfile = '{0}.{1:d}.tmp.npy'.format(filename[:-4], os.getpid())
+            np.save(tmpfile, null)
+            os.replace(tmpfile, filename)
+    # least recently used nulls are dropped from memory beyond the limit
+    _null_memory[key] = null
+    total = sum(x.size for x in _null_memory.values())
+    while total > _NULL_MEMORY_VALUES and len(_null_memory) > 1:
+        total -= _null_memory.pop(next(iter(_null_memory))).size
+    return np.sort(null[:number])
+
+# ------------------
+
+def rra_weighted(codes, percentiles, probs, size, weighted,
+                 percentile, scanpass, seed):
+    # probability weighted lo-values of the weighted groups, in group code
+    # order, and the sorted null lo-values of scanpass random groups
+    # with the probabilities of each weighted group
+    rng = np.random.default_rng(seed)
+    index = np.flatnonzero(weighted[codes])
+    index = index[np.argsort(codes[index], kind='mergesort')]
+    lovalue = np.ones(size.size)
+    nulls = list()
+    for s in np.unique(size[weighted]):
+        items = index[size[codes[index]] == s]
+        x = percentiles[items].reshape(-1, s)
+        p = probs[items].reshape(-1, s)
+        lovalue[codes[items[::s]]] = rra_problovalue(x, p, percentile)
+        p = np.repeat(p, scanpass, axis=0)
+        nulls.append(
+            rra_problovalue(rng.random(p.shape), p, percentile)
+        )
+    return (lovalue[weighted], np.sort(np.concatenate(nulls)))
+
+# ------------------
+
+def rra_pvalue(lovalue, nulls, weights):
+    # permutation p value of lo-values against the mixture of sorted nulls,
+    # each null is weighted by the fraction of groups with that size
+    pvalue = np.zeros(lovalue.size)
+    total = 0
+    for null, w in zip(nulls, weights):
+        index1 = np.searchsorted(null, lovalue, side='left')
+        index2 = np.searchsorted(null, lovalue, side='right')
+        pvalue += w * (index1 + index2) / (2.0 * null.size)
+        total += null.size
+    return np.clip(pvalue, 0.5 / total, 1 - 0.5 / total)
+
+# ------------------
+
+_helpdoc['rra'] = helpstring(
+    describe='',
+    parameterdicts={
+        'groups': 'array like, group id (gene) of each item.',
+        'values': 'array like, value of each item, smaller value ranks higher.',
+        'percentile': 'numeric, RRA only consider the items with percentile smaller than this parameter.',
+        'permutation': 'int, the number of rounds of permutation. Default 100.',
+        'seed': 'int, seed of the random number generator.',
+        'cachedir': 'string, directory to cache the null lo-values of each group size, default is None.',
+        'probs': 'array like, probability of each item, default is None means all items have probability 1.',
+        'betatable': 'bool, interpolate the beta cdf in a table cached for the process, see rra_betacdf. Default False.'
+    },
+    returns='pd.DataFrame, columns: group_id, items_in_group, beta, p, FDR, goodsgrna, sorted by lo-value.',
+    examplecodelists=[
+        "rralow = rra(",
+        "    data['gene'],",
+        "    data['treat_zscore'],",
+        "    percentile=0.1",
+        ")"
+    ]
+)
+
+@AppendHelp(_helpdoc['rra'], join='')
+def rra(groups, values, percentile, permutation=100, seed=123456, cachedir=None,
+        probs=None, betatable=False):
+    '''
+    Robust Rank Aggregation computed in process.
+    Same algorithm as the RRA program (lo-value, permutation p value
+    and FDR), but working on arrays directly with NumPy.
+    The null lo-values are generated once for each group size,
+    see rra_sizenull.
+    Groups of more than one item with probabilities not all 1 get the
+    probability weighted lo-value, see rra_problovalue, and their null
+    lo-values are generated with the probabilities of each group.
+    With betatable, the lo-values and the null lo-values of each group size
+    use the interpolated beta cdf, the probability weighted lo-values
+    are always computed exactly.
+    '''
+    logging.info(
+        'RRA start: maximum percentile is {0:.6f}'.format(percentile)
+    )
+    if not isinstance(groups, pd.Series):
+        groups = np.asarray(groups)
+    codes, names = pd.factorize(groups, sort=False)
+    names = np.asarray(names)
+    groupnum = names.size
+    percentiles = rra_percentile(values)
+    lovalue, goodsgrna = rra_lovalue(
+        codes, percentiles, groupnum, percentile, betatable
+    )
+    size = np.bincount(codes, minlength=groupnum)
+    scanpass = permutation + 1
+    weighted = np.zeros(groupnum, dtype=bool)
+    if probs is not None:
+        probs = np.asarray(probs, dtype=np.float64)
+        weighted = np.bincount(
+            codes, weights=probs != 1.0, minlength=groupnum
+        ) > 0
+        weighted &= size > 1
+    nulls = list()
+    weights = list()
+    if weighted.any():
+        lovalue[weighted], weightednull = rra_weighted(
+            codes, percentiles, probs, size, weighted,
+            percentile, scanpass, seed
+        )
+        nulls.append(weightednull)
+        weights.append(weighted.sum() / groupnum)
+
+    # permutation, at least the same number of random groups of each size
+    # as the RRA program
+    sizes, sizecount = np.unique(size[~weighted], return_counts=True)
+    nulls += [
+        rra_sizenull(
+            s, c * scanpass, percentile, permutation, seed, cachedir, betatable
+        )
+        for s, c in zip(sizes, sizecount)
+    ]
+    weights += list(sizecount / groupnum)
+    pvalue = rra_pvalue(lovalue, nulls, weights)
+
+    # fdr of groups ordered by lo-value
+    order = np.argsort(lovalue, kind='mergesort')
+    fdr = fdr_bh(pvalue, order=order)[order]
+
+    result = pd.DataFrame(
+        {
+            'group_id': names[order],
+            'items_in_group': size[order],
+            'beta': lovalue[order],
+            'p': pvalue[order],
+            'FDR': fdr,
+            'goodsgrna': goodsgrna[order]
+        }
+    )
+    logging.info('RRA finished.')
+    return result
+
+# ------------------
+# EOF
+# ------------------
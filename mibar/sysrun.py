@@ -2,11 +2,22 @@
 # Library
 # ------------------
 
+import pandas as pd
+import numpy as np
 import logging
 import os
+import sys
+import resource
 
 from .decorator import helpstring
 from .decorator import AppendHelp
+from .report import timedstage
+
+# the RRA program core built as extension module, optional
+try:
+    from . import _rra
+except ImportError:
+    _rra = None
 
 # ------------------
 # Function
@@ -20,7 +31,8 @@ _helpdoc['robustrank'] = helpstring(
         'rrapath': '',
         'infile': 'string, the file path of input data. Format: <item id> <group id> <list id> <value> [<probability>] [<chosen>]',
         'outfile': 'string, the file path of output data. Format: <group id> <number of items in the group> <lo-value> <false discovery rate>',
-        'percentile': 'numeric, RRA only consider the items with percentile smaller than this parameter. Default=0.1'
+        'percentile': 'numeric, RRA only consider the items with percentile smaller than this parameter. Default=0.1',
+        'threads': 'int, number of threads of the permutation. Default=1'
     },
     returns='output txt files with the RRA results',
     examplecodelists=[
@@ -34,7 +46,8 @@ _helpdoc['robustrank'] = helpstring(
 )
 
 @AppendHelp(_helpdoc['robustrank'], join='')
-def robustrank(rrapath, infile, outfile, percentile):
+@timedstage('robustrank')
+def robustrank(rrapath, infile, outfile, percentile, threads=1):
     '''
     Wrapper function of RRA, which was writen by Wei Li.
 
@@ -45,6 +58,9 @@ def robustrank(rrapath, infile, outfile, percentile):
     Percentile:
         Maximum percentile.
         RRA only consider the items with percentile smaller than this parameter. Default=0.1.
+    Threads:
+        Number of threads of the permutation, the option is only passed
+        when larger than 1, so that RRA programs without it still work.
     '''
     logging.info(
         'RRA start: maximum percentile is {0:.6f}'.format(percentile)
@@ -56,9 +72,92 @@ def robustrank(rrapath, infile, outfile, percentile):
             '--skip-gene NA --skip-gene na'
         ]
     )
+    if threads > 1:
+        cmd += ' --threads {0:d}'.format(threads)
     os.system(cmd)
     logging.info('RRA finished.')
 
+# ------------------
+
+def has_rra_extension():
+    # whether the RRA extension module is built
+    return _rra is not None
+
+# ------------------
+
+_helpdoc['robustrank_extension'] = helpstring(
+    describe='',
+    parameterdicts={
+        'groups': 'array like, group id (gene) of each item, in the order of the RRA input file.',
+        'values': 'array like, value of each item, smaller value ranks higher.',
+        'percentile': 'numeric, RRA only consider the items with percentile smaller than this parameter.',
+        'probs': 'array like, probability of each item, default is None means 1.',
+        'chosen': 'array like, whether each item is considered, default is None means 1.',
+        'permutation': 'int, the number of rounds of permutation. Default 100.',
+        'threads': 'int, number of threads of the permutation. Default 1.'
+    },
+    returns='pd.DataFrame, columns: group_id, items_in_group, beta, p, FDR, goodsgrna, the same as read_rra.',
+    examplecodelists=[
+        "result = robustrank_extension(",
+        "    pdata['symbol'],",
+        "    pdata['p'],",
+        "    percentile=0.1",
+        ")"
+    ]
+)
+
+@AppendHelp(_helpdoc['robustrank_extension'], join='')
+@timedstage('robustrank')
+def robustrank_extension(groups, values, percentile, probs=None, chosen=None,
+                         permutation=100, threads=1):
+    '''
+    RRA by the RRA program core in process, with the arrays passed
+    directly instead of the input and output files.
+    Groups are in the order of their first item as the RRA program
+    reads them, so the results are the same as robustrank with the
+    items written in the same order, but not rounded by the output file.
+    Log messages of the RRA core are sent to logging.
+    '''
+    logging.info(
+        'RRA start: maximum percentile is {0:.6f}'.format(percentile)
+    )
+    codes, names = pd.factorize(
+        np.asarray(groups), sort=False, use_na_sentinel=False
+    )
+    result = _rra.rra(
+        codes,
+        np.asarray(values, dtype=np.float64),
+        percentile,
+        probs=None if probs is None else np.asarray(probs, dtype=np.float64),
+        chosen=None if chosen is None else np.asarray(chosen, dtype=np.int32),
+        permutation=permutation,
+        threads=threads,
+        loglevel=logging.getLogger().getEffectiveLevel()
+    )
+    logging.info('RRA finished.')
+    return pd.DataFrame(
+        {
+            'group_id': np.asarray(names)[result[0]],
+            'items_in_group': result[1],
+            'beta': result[2],
+            'p': result[3],
+            'FDR': result[4],
+            'goodsgrna': result[5]
+        }
+    )
+
+# ------------------
+
+def peak_rss():
+    # peak resident set size in MB of this process and of the
+    # terminated child processes, ru_maxrss is in bytes on macOS
+    # and in kilobytes elsewhere
+    scale = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    )
+
 # ------------------
 # EOF
 # ------------------
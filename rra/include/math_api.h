@@ -42,3 +42,6 @@ void PermuteFloatArrays(double *a, int size);
 
 //Compute CDF of a non-central beta distribution. when lambda is 0.0, it's cpf of beta distribution
 double BetaNoncentralCdf(double a, double b, double lambda, double x, double error_max);
+
+//Compute CDF of the k-th smallest of n uniform values, the central beta CDF I_x(k, n-k+1) in closed form
+double BetaOrderCdf(int k, int n, double x);
@@ -10,6 +10,7 @@
 #define _RNGS_
 
 double Random(void);
+double RandomState(long *state);
 void   PlantSeeds(long x);
 void   GetSeed(long *x);
 void   PutSeed(long x);
@@ -14,6 +14,8 @@
 #include "rngs.h"
 #include "classdef.h"
 #include "fileio.h"
+#include "rracore.h"
+#include <stdarg.h>
 
 //C++ functions
 #include <string>
@@ -21,10 +23,14 @@
 #include <map>
 #include <iostream>
 #include <fstream>
+#include <thread>
+#include <algorithm>
 using namespace std;
 
 int PRINT_DEBUG=0;
 
+RRA_LOG_HANDLER RRALogHandler=NULL;
+
 const char* RRA_VERSION="0.5.5";
 
 //Global variables
@@ -34,41 +40,32 @@ bool UseControlSeq=false;
 map<string,int> ControlSeqMap; //save the control sequence name and their index in ControlSeqPercentile;
 double* ControlSeqPercentile;
 
-// used for calculation of lo-values
-double* tmpLovarray=NULL;
-int nLovarray=-1;
-
-
-//Function declarations
+// used for calculation of lo-values, one buffer per thread
+thread_local double* tmpLovarray=NULL;
+thread_local int nLovarray=-1;
 
-//Process groups by computing percentiles for each item and lo-values for each group
-int ProcessGroups(GROUP_STRUCT *groups, int groupNum, LIST_STRUCT *lists, int listNum, double maxPercentile);
 
-//QuickSort groups by loValue
-void QuickSortGroupByLoValue(GROUP_STRUCT *groups, int start, int end);
+//log a printf formatted message, to the log handler if it is set
+void RRALog(int level, const char *format, ...)
+{
+  va_list args;
+  va_start(args, format);
+  if(RRALogHandler==NULL){
+    vfprintf(level>=RRA_LOG_WARNING ? stderr : stdout, format, args);
+  }else{
+    char message[1024];
+    vsnprintf(message, sizeof(message), format, args);
+    RRALogHandler(level, message);
+  }
+  va_end(args);
+}
 
-//Compute False Discovery Rate based on uniform distribution
-int ComputeFDR(GROUP_STRUCT *groups, int groupNum, double maxPercentile, int numOfRandPass);
+#ifndef RRA_EXTENSION
+//the command line program, not built in the python extension module
 
 //print the usage of Command
 void PrintCommandUsage(const char *command);
 
-
-//Compute lo-value based on an array of percentiles
-int ComputeLoValue(double *percentiles,     //array of percentiles
-				   int num,                 //length of array
-				   double &loValue,         //pointer to the output lo-value
-				   double maxPercentile,   //maximum percentile, computation stops when maximum percentile is reached
-           int &goodsgrna);// # of good sgRNAs
-
-//WL: modification of lo_value computation
-int ComputeLoValue_Prob(double *percentiles,     //array of percentiles
-				   int num,                 //length of array
-				   double &loValue,         //pointer to the output lo-value
-				   double maxPercentile,   //maximum percentile, computation stops when maximum percentile is reached
-				  double *probValue,// probability of each prob, must be equal to the size of percentiles
-           int &goodsgrna);
-
 //read control sequences
 int loadControlSeq(const char* fname){
   ifstream fh;
@@ -100,6 +97,7 @@ int main (int argc, const char * argv[]) {
 	char inputFileName[1000], outputFileName[1000];
 	double maxPercentile;
 	int rand_passnum;
+	int numThreads;
 	
 	//Parse the command line
 	if (argc == 1)
@@ -113,6 +111,7 @@ int main (int argc, const char * argv[]) {
 	outputFileName[0] = 0;
 	maxPercentile = 0.1;
 	rand_passnum=RAND_PASS_NUM;
+	numThreads=1;
 	
 	for (i=2;i<argc;i++)
 	{
@@ -133,6 +132,9 @@ int main (int argc, const char * argv[]) {
 		if (strcmp(argv[i-1], "--permutation")==0){
 			rand_passnum= atoi(argv[i]);
 		}
+		if (strcmp(argv[i-1], "--threads")==0){
+			numThreads= atoi(argv[i]);
+		}
 	}
 	
 	if ((inputFileName[0]==0)||(outputFileName[0]==0))
@@ -142,6 +144,12 @@ int main (int argc, const char * argv[]) {
 		return -1;
 	}
 	
+	if ((numThreads<1)||(numThreads>255))
+	{
+		cerr<<("Error: threads should be within 1 and 255\n");
+		return -1;
+	}
+	
 	if ((maxPercentile>1.0)||(maxPercentile<0.0))
 	{
 		cerr<<("Error: maxPercentile should be within 0.0 and 1.0\n");
@@ -172,7 +180,7 @@ int main (int argc, const char * argv[]) {
 	
 	cerr<<("Computing false discovery rate...\n");
 	
-	if (ComputeFDR(groups, groupNum, maxPercentile, rand_passnum*groupNum)<=0)
+	if (ComputeFDR(groups, groupNum, maxPercentile, rand_passnum*groupNum, numThreads)<=0)
 	{
 		cerr<<("\nError: computing FDR failed.\n");
 		return -1;
@@ -188,13 +196,18 @@ int main (int argc, const char * argv[]) {
 	
 	cerr<<("RRA completed.\n");
 	
-  for(i=0;i<groupNum;i++)
+  for(i=0;i<groupNum;i++){
+    for(int j=0;j<groups[i].itemNum;j++)
+      free(groups[i].items[j].name);
     delete[] groups[i].items;
+    free(groups[i].name);
+  }
 	free(groups);
 	
 	for (i=0;i<listNum;i++)
 	{
 		delete[] lists[i].values;
+		free(lists[i].name);
 	}
 	free(lists);
   if(UseControlSeq){
@@ -219,6 +232,7 @@ void PrintCommandUsage(const char *command)
 	printf("-p <maximum percentile>. RRA only consider the items with percentile smaller than this parameter. Default=0.1\n");
 	printf("--control <control_sgrna list>. A list of control sgRNA names.\n");
 	printf("--permutation <int>. The number of rounds of permutation. Default 100.\n");
+	printf("--threads <int>. The number of threads of permutation, results are reproducible for the same number of threads. Default 1.\n");
 	printf("example:\n");
 	printf("%s -i input.txt -o output.txt -p 0.1 \n", command);
 	
@@ -227,6 +241,8 @@ void PrintCommandUsage(const char *command)
 
 
 
+#endif // RRA_EXTENSION
+
 //Process groups by computing percentiles for each item and lo-values for each group
 //groups: genes
 //lists: a set of different groups. Comparison will be performed on individual list
@@ -240,8 +256,6 @@ int ProcessGroups(GROUP_STRUCT *groups, int groupNum, LIST_STRUCT *lists, int li
   bool isallone; // check if all the probs are 1; if yes, do not use accumulation of prob. scores
   
   maxItemPerGroup = 0;
-
-  PRINT_DEBUG=1;
 	
   for (i=0;i<groupNum;i++){
     if (groups[i].itemNum>maxItemPerGroup){
@@ -304,7 +318,7 @@ int ProcessGroups(GROUP_STRUCT *groups, int groupNum, LIST_STRUCT *lists, int li
   if(UseControlSeq){
     for(map<string,int>::iterator mit = ControlSeqMap.begin(); mit != ControlSeqMap.end(); mit++){
       if(ControlSeqPercentile[mit->second]<0){
-        cerr<<"Warning: sgRNA "<<mit->first<<" not found in the ranked list. \n";
+        RRALog(RRA_LOG_WARNING, "Warning: sgRNA %s not found in the ranked list. \n", mit->first.c_str());
         //ControlSeqPercentile[mit->second]=0.5;
       }
     }
@@ -357,7 +371,7 @@ int ComputeLoValue(double *percentiles,     //array of percentiles
 		}else{
       goodsgrna++;
     }
-		tmpF = BetaNoncentralCdf((double)(i+1),(double)(num-i),0.0,tmpArray[i],CDF_MAX_ERROR);
+		tmpF = BetaOrderCdf(i+1,num,tmpArray[i]);
 		if (tmpF<tmpLoValue){
 			tmpLoValue = tmpF;
 		}
@@ -372,6 +386,12 @@ int ComputeLoValue(double *percentiles,     //array of percentiles
 }
 
 //Compute lo-value based on an array of percentiles, by considering the probability of each sgRNAs. 
+//The lo-value is the expectation over the subsets of chosen sgRNAs. Only the chosen sgRNAs within the
+//maximum percentile (head) are ranked, the others only add to the number of chosen sgRNAs, or give the
+//first chosen sgRNA if no head sgRNA is chosen. Given the number of chosen sgRNAs, the probability that
+//the lo-value is larger than t is computed by dynamic programming over the head sgRNAs and their ranks,
+//and it only changes at the beta cdf values of the head sgRNAs, so the expectation is exact in
+//O(num*head^4) instead of enumerating the 2^num subsets.
 //Return 1 if success, 0 if failure
 //Modified by Wei Li
 int ComputeLoValue_Prob(double *percentiles,     //array of percentiles
@@ -381,122 +401,195 @@ int ComputeLoValue_Prob(double *percentiles,     //array of percentiles
 				  double *probValue,
           int &goodsgrna) {// probability of each prob, must be equal to the size of percentiles
 
-	int i, pid;
-	double *tmpArray;
-	double tmpLoValue, tmpF;
-
-	// used to calculate cumulative probability
-	int real_i;
-	int c_num;
-	double c_prob;
-	double accuLoValue;
+	int i, j, c, r, n, b, h;
+	int head, tail, cellNum;
+	double none, tmpF, survival;
 
 	if(num==0){
     loValue=1.00;
     goodsgrna=0;
     return 0;
   }
-		
-  if(num>nLovarray){
-    delete[] tmpLovarray;
-    tmpLovarray=new double[num];
-    nLovarray=num;
+
+  // percentiles sorted together with their probabilities
+  vector< pair<double,double> > items(num);
+  for (i=0;i<num;i++){
+    items[i]=make_pair(percentiles[i], probValue[i]);
   }
-	//tmpArray = (double *)malloc(num*sizeof(double));
-  tmpArray=tmpLovarray;
-	
-	if (!tmpArray){
-		return -1;
-	}
-	
-	memcpy(tmpArray, percentiles, num*sizeof(double));
-	
-	QuicksortF(tmpArray, 0, num-1);
-  
-  goodsgrna=0;
+  sort(items.begin(), items.end());
+  vector<double> x(num), p(num);
   for (i=0;i<num;i++){
-		if ((tmpArray[i]>maxPercentile)){
-      if(i==0){}else{
-			  break;
-      }
-		}else{
-      goodsgrna++;
+    x[i]=items[i].first;
+    p[i]=items[i].second;
+  }
+
+  head=0;
+  while(head<num && x[head]<=maxPercentile) head++;
+  goodsgrna=head;
+  tail=num-head;
+
+  if(PRINT_DEBUG){
+    string probline("probs:");
+    char probstr[32];
+    for(i=0;i<num;i++)
+    {
+      snprintf(probstr, sizeof(probstr), "%f,", p[i]);
+      probline+=probstr;
     }
+    RRALog(RRA_LOG_DEBUG, "%s\n", probline.c_str());
   }
 
-  
-  if(PRINT_DEBUG) printf("probs:");
-  for(i=0;i<num;i++)
-  {
-    if(PRINT_DEBUG) printf("%f,",probValue[i]);
+  // suffix[j*(tail+1)+c]: probability of c chosen sgRNAs from tail sgRNA j to the last
+  vector<double> suffix((tail+1)*(tail+1), 0.0);
+  suffix[tail*(tail+1)]=1.0;
+  for (j=tail-1;j>=0;j--){
+    for (c=0;c<=tail;c++){
+      suffix[j*(tail+1)+c]=suffix[(j+1)*(tail+1)+c]*(1.0-p[head+j]);
+      if(c>0) suffix[j*(tail+1)+c]+=suffix[(j+1)*(tail+1)+c-1]*p[head+j];
+    }
   }
-  if(PRINT_DEBUG) printf("\n");
-	
-	
-	accuLoValue=0.0;
-	for (pid=1;pid<(1<<num);pid++)
-	{
-		// decoding the selection
-		tmpLoValue = 1.0;
-		c_num=0;
-		real_i=0;
-		c_prob=1.0;
-		for(i=0;i<num;i++)
-		{
-			if ( (1<<i)&pid )
-			{
-				c_num = c_num +1;
-				c_prob= c_prob*probValue[i];
-			}
-			else
-			{
-				c_prob=c_prob*(1.0-probValue[i]);
-			}
-		}
-		for (i=0;i<num;i++)
-		{
-			if ( ((1<<i)&pid) ==0)
-			{// if this sgRNA is selected?
-				continue;
-			}
-			if ((tmpArray[i]>maxPercentile)&&(i>0))
-			{
-				break;
-			}
-			// Beta (a,b, 0, frac)
-			tmpF = BetaNoncentralCdf((double)(real_i+1),(double)(c_num-i),0.0,tmpArray[i],CDF_MAX_ERROR);
-			if (tmpF<tmpLoValue)
-			{
-				tmpLoValue = tmpF;
-			}
-			real_i = real_i + 1;
-		}
-    if(PRINT_DEBUG) printf("pid: %d, prob:%e, score: %f\n",pid,c_prob,tmpLoValue);
-		accuLoValue=accuLoValue+tmpLoValue*c_prob;
-	}
-  if(PRINT_DEBUG) printf("total: %f\n",accuLoValue);
-	
-	loValue = accuLoValue;
 
-	//free(tmpArray);
+  // no head sgRNA chosen: the first chosen tail sgRNA has rank 1, and 1 if none is chosen
+  double emptyLoValue=0.0;
+  none=1.0;
+  for (j=0;j<tail;j++){
+    tmpF=0.0;
+    for (c=0;c<tail-j;c++){
+      tmpF+=suffix[(j+1)*(tail+1)+c]*BetaOrderCdf(1,1+c,x[head+j]);
+    }
+    emptyLoValue+=none*p[head+j]*tmpF;
+    none*=1.0-p[head+j];
+  }
+  emptyLoValue+=none;
+  none=1.0;
+  for (i=0;i<head;i++){
+    none*=1.0-p[i];
+  }
+  loValue=emptyLoValue*none;
+
+  // n chosen sgRNAs, of which h head sgRNAs
+  vector<double> cellValue(head*head), levels, dp(head+1);
+  for (n=1;n<=num && head>0;n++){
+    levels.assign(1, 0.0);
+    for (i=0;i<head;i++){
+      for (r=1;r<=i+1 && r<=n;r++){
+        cellValue[i*head+r-1]=BetaOrderCdf(r,n,x[i]);
+        levels.push_back(cellValue[i*head+r-1]);
+      }
+    }
+    cellNum=(int)levels.size()-1;
+    sort(levels.begin(), levels.end());
+    levels.push_back(1.0);
+    for (b=0;b<=cellNum;b++){
+      if(levels[b+1]<=levels[b]) continue;
+      // probability that h head sgRNAs are chosen and all their beta cdf are above levels[b]
+      fill(dp.begin(), dp.end(), 0.0);
+      dp[0]=1.0;
+      for (i=0;i<head;i++){
+        for (r=(i+1<n ? i+1 : n);r>=1;r--){
+          dp[r]*=1.0-p[i];
+          if(cellValue[i*head+r-1]>levels[b]) dp[r]+=dp[r-1]*p[i];
+        }
+        dp[0]*=1.0-p[i];
+      }
+      survival=0.0;
+      for (h=(n-tail>1 ? n-tail : 1);h<=head && h<=n;h++){
+        survival+=dp[h]*suffix[n-h];
+      }
+      loValue+=survival*(levels[b+1]-levels[b]);
+    }
+  }
+  if(PRINT_DEBUG) RRALog(RRA_LOG_DEBUG, "total: %f\n",loValue);
+
 	return 0;
 	
 }
 
 
+//Compute the lo-values of random groups in permutation passes [passStart, passEnd).
+//The uniform values are drawn from the stream state if it is not NULL, otherwise
+//from the current global stream. randLoValue is indexed by pass*groupNum+group.
+void PermutationPasses(GROUP_STRUCT *groups, int groupNum, double maxPercentile, int maxItemNum,
+                       int passStart, int passEnd, long *state,
+                       double *control_prob_array, int n_control, double *randLoValue)
+{
+  int i,j,k;
+  double *tmpPercentile;
+  double *tmpProb;
+  bool isallone;
+  double ufvalue=0.5;
+  int rand_ctl_index=0;
+  int tmp_int;
+
+  tmpPercentile=new double[maxItemNum];
+  tmpProb=new double[maxItemNum];
+
+  for (i=passStart;i<passEnd;i++){
+    for (j=0;j<groupNum;j++){
+      isallone=true;
+      int validsgs=0;
+      for (k=0;k<groups[j].itemNum;k++)
+      {
+        if(groups[j].items[k].isChosen==0) continue;
+        if(state==NULL){
+          ufvalue=Uniform(0.0, 1.0);
+        }else{
+          ufvalue=RandomState(state);
+        }
+        if(UseControlSeq){
+          rand_ctl_index=(int)(n_control*ufvalue);
+          if(rand_ctl_index>=n_control) rand_ctl_index=n_control-1;
+          tmpPercentile[validsgs]=control_prob_array[rand_ctl_index];
+        }else{
+          tmpPercentile[validsgs] = ufvalue;
+        }
+        tmpProb[validsgs]=groups[j].items[k].prob;
+        if(tmpProb[validsgs]!=1.0)
+        {
+          isallone=false;
+        }
+        validsgs++;
+      } //end for k
+      if(validsgs<=1)
+        isallone=true;
+
+      if(isallone){
+        ComputeLoValue(tmpPercentile, validsgs,randLoValue[(long)i*groupNum+j], maxPercentile, tmp_int);
+      }else{
+        ComputeLoValue_Prob(tmpPercentile, validsgs,randLoValue[(long)i*groupNum+j], maxPercentile,tmpProb,tmp_int);
+      }
+    }// end for j
+  }//end for i
+
+  delete []tmpPercentile;
+  delete []tmpProb;
+}
+
+//Run the permutation passes of one thread, and free the lo-value buffer of the thread
+void PermutationThread(GROUP_STRUCT *groups, int groupNum, double maxPercentile, int maxItemNum,
+                       int passStart, int passEnd, long seed,
+                       double *control_prob_array, int n_control, double *randLoValue)
+{
+  long state=seed;
+  PermutationPasses(groups, groupNum, maxPercentile, maxItemNum, passStart, passEnd, &state,
+                    control_prob_array, n_control, randLoValue);
+  if(nLovarray>0){
+    delete []tmpLovarray;
+    tmpLovarray=NULL;
+    nLovarray=-1;
+  }
+}
+
 //Compute False Discovery Rate based on uniform distribution
-int ComputeFDR(GROUP_STRUCT *groups, int groupNum, double maxPercentile, int numOfRandPass)
+//With more than one thread, the permutation passes are split into one block of
+//passes per thread, and each thread draws from its own planted stream.
+int ComputeFDR(GROUP_STRUCT *groups, int groupNum, double maxPercentile, int numOfRandPass, int numThreads)
 {
-	int i,j,k;
-	double *tmpPercentile;
+	int i;
 	int maxItemNum = 0;
 	int scanPass = numOfRandPass/groupNum+1;
 	double *randLoValue;
 	int randLoValueNum;
-
-	//WL
-	double *tmpProb;
-	double isallone;
 	
 	for (i=0;i<groupNum;i++){
 		if (groups[i].itemNum>maxItemNum){
@@ -506,11 +599,6 @@ int ComputeFDR(GROUP_STRUCT *groups, int groupNum, double maxPercentile, int num
 	
 	assert(maxItemNum>0);
 	
-	//tmpPercentile = (double *)malloc(maxItemNum*sizeof(double));
-	//tmpProb= (double *)malloc(maxItemNum*sizeof(double));
-  tmpPercentile=new double[maxItemNum];
-  tmpProb=new double[maxItemNum];	
-
 	randLoValueNum = groupNum*scanPass;
 	
 	assert(randLoValueNum>0);
@@ -518,8 +606,6 @@ int ComputeFDR(GROUP_STRUCT *groups, int groupNum, double maxPercentile, int num
 	//randLoValue = (double *)malloc(randLoValueNum*sizeof(double));
   randLoValue=new double[randLoValueNum];
 	
-	randLoValueNum = 0;
-	
 	PlantSeeds(123456);
   
   PRINT_DEBUG=0;
@@ -527,9 +613,6 @@ int ComputeFDR(GROUP_STRUCT *groups, int groupNum, double maxPercentile, int num
   // set up control sequences
   int n_control=0;
   double* control_prob_array=NULL;
-  double ufvalue=0.5;
-  int rand_ctl_index=0;
-  int tmp_int;
   if(UseControlSeq){
     for(map<string,int>::iterator mit = ControlSeqMap.begin(); mit != ControlSeqMap.end(); mit++){
       if(ControlSeqPercentile[mit->second]>=0){
@@ -544,42 +627,32 @@ int ComputeFDR(GROUP_STRUCT *groups, int groupNum, double maxPercentile, int num
         n_control++;
       }
     }
-    cout<<"Total # control sgRNAs: "<<n_control<<endl;
+    RRALog(RRA_LOG_INFO, "Total # control sgRNAs: %d\n", n_control);
   }
   
-  for (i=0;i<scanPass;i++){
-    for (j=0;j<groupNum;j++){
-      isallone=true;
-      int validsgs=0;
-      for (k=0;k<groups[j].itemNum;k++)
-      {
-        if(groups[j].items[k].isChosen==0) continue;
-        ufvalue=Uniform(0.0, 1.0);
-        if(UseControlSeq){
-          rand_ctl_index=(int)(n_control*ufvalue);
-          if(rand_ctl_index>=n_control) rand_ctl_index=n_control-1;
-          tmpPercentile[validsgs]=control_prob_array[rand_ctl_index];
-        }else{
-          tmpPercentile[validsgs] = ufvalue;
-        }
-        tmpProb[validsgs]=groups[j].items[k].prob;
-        if(tmpProb[validsgs]!=1.0)
-        {
-          isallone=false;
-        }
-        validsgs++;
-      } //end for k
-      if(validsgs<=1)
-        isallone=true;
-			
-      if(isallone){
-        ComputeLoValue(tmpPercentile, validsgs,randLoValue[randLoValueNum], maxPercentile, tmp_int);
-      }else{
-        ComputeLoValue_Prob(tmpPercentile, validsgs,randLoValue[randLoValueNum], maxPercentile,tmpProb,tmp_int);
-      }
-      randLoValueNum++;
-    }// end for j
-  }//end for i
+  if(numThreads>scanPass) numThreads=scanPass;
+  if(numThreads<=1){
+    PermutationPasses(groups, groupNum, maxPercentile, maxItemNum, 0, scanPass, NULL,
+                      control_prob_array, n_control, randLoValue);
+  }else{
+    // stream i+1 for thread i, the random lo-values of all the threads
+    // are merged in randLoValue before sorting
+    vector<thread> workers;
+    long seed;
+    for (i=0;i<numThreads;i++){
+      SelectStream(i+1);
+      GetSeed(&seed);
+      workers.push_back(
+        thread(PermutationThread, groups, groupNum, maxPercentile, maxItemNum,
+               (int)((long)scanPass*i/numThreads), (int)((long)scanPass*(i+1)/numThreads), seed,
+               control_prob_array, n_control, randLoValue)
+      );
+    }
+    SelectStream(0);
+    for (i=0;i<numThreads;i++){
+      workers[i].join();
+    }
+  }
 	
   QuicksortF(randLoValue, 0, randLoValueNum-1);
   QuickSortGroupByLoValue(groups, 0, groupNum-1);
@@ -592,7 +665,7 @@ int ComputeFDR(GROUP_STRUCT *groups, int groupNum, double maxPercentile, int num
   }
   //save the index
   if(goodGroupNum==0) goodGroupNum=1;
-  cout<<"Number of groups under permutation and FDR adjustment: "<<goodGroupNum<<endl;
+  RRALog(RRA_LOG_INFO, "Number of groups under permutation and FDR adjustment: %d\n", goodGroupNum);
   int* indexval=new int[goodGroupNum];
   int goodindex=0;
   for (i=0;i<groupNum;i++){
@@ -628,8 +701,6 @@ int ComputeFDR(GROUP_STRUCT *groups, int groupNum, double maxPercentile, int num
   //free(tmpPercentile);
   //free(tmpProb);
   //free(randLoValue);
-  delete []tmpPercentile;
-  delete []tmpProb;
   delete []randLoValue;
   
   if(UseControlSeq){
@@ -6,8 +6,11 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <memory.h>
+#include <string.h>
 
+#ifndef NDEBUG
 #define NDEBUG
+#endif
 #include <assert.h>
 
 #define MAX_NAME_LEN 10000           //maximum length of item name, group name or list name
@@ -26,7 +29,7 @@
 
 typedef struct // item definition; i.e., sgRNA
 {
-	char name[MAX_NAME_LEN];       //name of the item
+	char *name;                    //name of the item, allocated by strdup
 	int listIndex;                 //index of list storing the item
 	double value;                  //value of measurement
 	double percentile;             //percentile in the list
@@ -36,7 +39,8 @@ typedef struct // item definition; i.e., sgRNA
 
 typedef struct // group definition; i.e., gene
 {
-	char name[MAX_NAME_LEN];       //name of the group
+	char *name;                    //name of the group, allocated by strdup
+	int index;                     //index of the group in input order
 	ITEM_STRUCT *items;            //items in the group
 	int itemNum;                   //number of items in the group
   int maxItemNum;                // max number of items
@@ -50,7 +54,7 @@ typedef struct // group definition; i.e., gene
 
 typedef struct //list definition; i.e., gene groups
 {
-	char name[MAX_NAME_LEN];       //name of the list
+	char *name;                    //name of the list, allocated by strdup
 	double *values;                //values of items in the list, used for sorting
 	int itemNum;                   //number of items in the list
   int maxItemNum;               //max item number
@@ -79,7 +79,8 @@ int getGroupListNum(char* fileName, GROUP_STRUCT* &groups, LIST_STRUCT* lists, i
        //for (i=0;i<tmpGroupNum;i++) if (!strcmp(vsubwords[k].c_str(), groups[i].name))	break;
        string subwstr=vsubwords[k];
        if (groupNames.count(subwstr)==0){
-         strcpy(groups[tmpGroupNum].name, vsubwords[k].c_str());
+         groups[tmpGroupNum].name = strdup(vsubwords[k].c_str());
+         groups[tmpGroupNum].index = tmpGroupNum;
          groups[tmpGroupNum].itemNum = 1;
          groupNames[subwstr]=tmpGroupNum;
          tmpGroupNum ++;
@@ -103,7 +104,7 @@ int getGroupListNum(char* fileName, GROUP_STRUCT* &groups, LIST_STRUCT* lists, i
     //for (i=0;i<tmpListNum;i++)	if (!strcmp(vwords[2].c_str(), lists[i].name))	break;
     string thisliststr=vwords[2];
     if (listNames.count(thisliststr)==0){
-      strcpy(lists[tmpListNum].name, vwords[2].c_str());
+      lists[tmpListNum].name = strdup(vwords[2].c_str());
       lists[tmpListNum].itemNum = 1;
       listNames[thisliststr]=tmpListNum;
       tmpListNum ++;
@@ -238,7 +239,7 @@ int ReadFile(char *fileName, GROUP_STRUCT* &groups, int maxGroupNum, int *groupN
   		
         //save group name(gene name)
   			//strcpy(groups[i].items[groups[i].itemNum].name,tmpItemName);
-  			strcpy(groups[i].items[groups[i].itemNum].name,vwords[0].c_str());
+  			groups[i].items[groups[i].itemNum].name = strdup(vwords[0].c_str());
   			groups[i].items[groups[i].itemNum].value = tmpValue;
   			groups[i].items[groups[i].itemNum].prob= sgrnaProbValue;
   			groups[i].items[groups[i].itemNum].listIndex = j;
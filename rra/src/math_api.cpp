@@ -8,8 +8,10 @@
  */
 
 #include <math.h>
+#include <float.h>
 #include <stdlib.h>
 #include <memory.h>
+#include <vector>
 #include "math_api.h"
 #include "rvgs.h"
 
@@ -606,3 +608,62 @@ double BetaNoncentralCdf ( double a, double b, double lambda, double x, double e
 	return value;
 }
 
+//log(n!) of n = 0, 1, ..., extended when a larger n is needed, one table per thread
+static thread_local std::vector<double> logFactorial(1, 0.0);
+
+//logarithm of the binomial coefficient C(n, k)
+static double LogChoose(int n, int k)
+{
+	while ((int)logFactorial.size() <= n)
+	{
+		logFactorial.push_back(logFactorial.back() + log((double)logFactorial.size()));
+	}
+	return logFactorial[n] - logFactorial[k] - logFactorial[n - k];
+}
+
+//Compute CDF of the k-th smallest of n uniform values, which is the regularized
+//incomplete beta function I_x(k, n-k+1), as the binomial tail P(Bin(n, x) >= k).
+//The terms are summed from the one nearest the binomial mode, until they are too
+//small to change the sum.
+double BetaOrderCdf(int k, int n, double x)
+{
+	int j;
+	double logX, log1X, term, sum, ratio;
+	
+	if (k <= 0 || x >= 1.0)
+	{
+		return 1.0;
+	}
+	if (k > n || x <= 0.0)
+	{
+		return 0.0;
+	}
+	
+	logX = log(x);
+	log1X = log1p(-x);
+	
+	if (x * (n + 1) <= k)
+	{
+		// upper tail, terms decrease from j = k
+		term = exp(LogChoose(n, k) + k * logX + (n - k) * log1X);
+		sum = term;
+		ratio = x / (1.0 - x);
+		for (j = k; j < n && term > sum * DBL_EPSILON; j++)
+		{
+			term = term * ratio * (n - j) / (j + 1);
+			sum = sum + term;
+		}
+		return sum;
+	}
+	
+	// one minus the lower tail, terms decrease from j = k - 1
+	term = exp(LogChoose(n, k - 1) + (k - 1) * logX + (n - k + 1) * log1X);
+	sum = term;
+	ratio = (1.0 - x) / x;
+	for (j = k - 1; j > 0 && term > sum * DBL_EPSILON; j--)
+	{
+		term = term * ratio * j / (n - j + 1);
+		sum = sum + term;
+	}
+	return 1.0 - sum;
+}
@@ -68,6 +68,28 @@ static int  initialized   = 0;          /* test for stream initialization */
 }
 
 
+   double RandomState(long *state)
+/* ----------------------------------------------------------------
+ * RandomState returns a pseudo-random real number uniformly 
+ * distributed between 0.0 and 1.0 from a stream whose state is 
+ * owned by the caller, such as one stream per thread.  The state 
+ * can be taken from a planted stream by SelectStream and GetSeed.
+ * ----------------------------------------------------------------
+ */
+{
+  const long Q = MODULUS / MULTIPLIER;
+  const long R = MODULUS % MULTIPLIER;
+        long t;
+
+  t = MULTIPLIER * (*state % Q) - R * (*state / Q);
+  if (t > 0) 
+    *state = t;
+  else 
+    *state = t + MODULUS;
+  return ((double) *state / MODULUS);
+}
+
+
    void PlantSeeds(long x)
 /* ---------------------------------------------------------------------
  * Use this function to set the state of all the random number generator 
@@ -0,0 +1,45 @@
+#ifndef RRACORE_H
+#define RRACORE_H
+
+#include "classdef.h"
+
+//log levels, the same values as the levels of python logging
+#define RRA_LOG_DEBUG 10
+#define RRA_LOG_INFO 20
+#define RRA_LOG_WARNING 30
+
+//handler of log messages, messages are printed to stdout (stderr for warnings) if it is NULL
+typedef void (*RRA_LOG_HANDLER)(int level, const char *message);
+extern RRA_LOG_HANDLER RRALogHandler;
+
+//print the debug messages of lo-value computation if not 0
+extern int PRINT_DEBUG;
+
+//log a printf formatted message
+void RRALog(int level, const char *format, ...);
+
+//Process groups by computing percentiles for each item and lo-values for each group
+int ProcessGroups(GROUP_STRUCT *groups, int groupNum, LIST_STRUCT *lists, int listNum, double maxPercentile);
+
+//QuickSort groups by loValue
+void QuickSortGroupByLoValue(GROUP_STRUCT *groups, int start, int end);
+
+//Compute False Discovery Rate based on uniform distribution
+int ComputeFDR(GROUP_STRUCT *groups, int groupNum, double maxPercentile, int numOfRandPass, int numThreads);
+
+//Compute lo-value based on an array of percentiles
+int ComputeLoValue(double *percentiles,     //array of percentiles
+				   int num,                 //length of array
+				   double &loValue,         //pointer to the output lo-value
+				   double maxPercentile,   //maximum percentile, computation stops when maximum percentile is reached
+           int &goodsgrna);// # of good sgRNAs
+
+//WL: modification of lo_value computation
+int ComputeLoValue_Prob(double *percentiles,     //array of percentiles
+				   int num,                 //length of array
+				   double &loValue,         //pointer to the output lo-value
+				   double maxPercentile,   //maximum percentile, computation stops when maximum percentile is reached
+				  double *probValue,// probability of each prob, must be equal to the size of percentiles
+           int &goodsgrna);
+
+#endif
@@ -0,0 +1,235 @@
+/*
+ *  rramodule.cpp
+ *  Python extension module mibar._rra of the RRA core.
+ *
+ *  The groups and the list are made from NumPy arrays instead of the
+ *  input file, the results are returned as NumPy arrays instead of the
+ *  output file, and the log messages are sent to python logging.
+ *
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include <numpy/arrayobject.h>
+
+#include "rracore.h"
+
+//python logging module
+static PyObject *logging_module=NULL;
+//minimum level of the messages sent to python logging
+static int log_level=RRA_LOG_WARNING;
+
+//send a log message of the RRA core to python logging
+static void PythonLogHandler(int level, const char *message)
+{
+  PyObject *result;
+  size_t len;
+
+  if(level<log_level || logging_module==NULL) return;
+  len=strlen(message);
+  while(len>0 && (message[len-1]=='\n' || message[len-1]==' ')) len--;
+  result=PyObject_CallMethod(logging_module, "log", "is#", level, message, (Py_ssize_t)len);
+  if(result==NULL){
+    PyErr_Clear();
+  }else{
+    Py_DECREF(result);
+  }
+}
+
+//free the groups made by rra
+static void FreeGroups(GROUP_STRUCT *groups, int groupNum)
+{
+  int i;
+  for (i=0;i<groupNum;i++){
+    delete[] groups[i].items;
+  }
+  delete[] groups;
+}
+
+PyDoc_STRVAR(rra_doc,
+"rra(codes, values, percentile, probs=None, chosen=None, permutation=100, threads=1, loglevel=30)\n"
+"\n"
+"Robust Rank Aggregation of items in one ranked list by the RRA program core.\n"
+"codes are the group codes of the items, from 0 to the number of groups - 1,\n"
+"groups are kept in the order of their codes as the RRA program keeps them in\n"
+"the order of the first item in the input file. values are the values of the\n"
+"items, smaller value ranks higher. probs and chosen are the probability and\n"
+"chosen columns of the RRA input, 1 by default.\n"
+"Log messages not lower than loglevel are sent to python logging.\n"
+"\n"
+"Returns the tuple (code, items_in_group, lo_value, p, FDR, goodsgrna) of\n"
+"arrays, groups sorted by lo-value as in the RRA output file.");
+
+static PyObject *rra(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+  static const char *kwlist[]={"codes", "values", "percentile", "probs", "chosen",
+                               "permutation", "threads", "loglevel", NULL};
+  PyObject *codesobj=NULL, *valuesobj=NULL, *probsobj=Py_None, *chosenobj=Py_None;
+  PyArrayObject *codes=NULL, *values=NULL, *probs=NULL, *chosen=NULL;
+  double maxPercentile;
+  int permutation=100, numThreads=1, level=RRA_LOG_WARNING;
+  npy_intp itemNum, i, dims[1];
+  int groupNum=0, j, k, flag;
+  GROUP_STRUCT *groups=NULL;
+  LIST_STRUCT lists[1];
+  PyArrayObject *outarrays[6];
+  PyObject *result=NULL;
+
+  if(!PyArg_ParseTupleAndKeywords(args, kwargs, "OOd|OOiii", (char **)kwlist,
+        &codesobj, &valuesobj, &maxPercentile, &probsobj, &chosenobj,
+        &permutation, &numThreads, &level)){
+    return NULL;
+  }
+  if((maxPercentile>1.0)||(maxPercentile<0.0)){
+    PyErr_SetString(PyExc_ValueError, "percentile should be within 0.0 and 1.0");
+    return NULL;
+  }
+  if((numThreads<1)||(numThreads>255)){
+    PyErr_SetString(PyExc_ValueError, "threads should be within 1 and 255");
+    return NULL;
+  }
+  if(permutation<1){
+    PyErr_SetString(PyExc_ValueError, "permutation should be positive");
+    return NULL;
+  }
+
+  codes=(PyArrayObject *)PyArray_FROMANY(codesobj, NPY_INT64, 1, 1, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+  values=(PyArrayObject *)PyArray_FROMANY(valuesobj, NPY_FLOAT64, 1, 1, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+  if(probsobj!=Py_None)
+    probs=(PyArrayObject *)PyArray_FROMANY(probsobj, NPY_FLOAT64, 1, 1, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+  if(chosenobj!=Py_None)
+    chosen=(PyArrayObject *)PyArray_FROMANY(chosenobj, NPY_INT32, 1, 1, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+  if(codes==NULL || values==NULL || (probsobj!=Py_None && probs==NULL) || (chosenobj!=Py_None && chosen==NULL))
+    goto done;
+
+  itemNum=PyArray_SIZE(codes);
+  if(PyArray_SIZE(values)!=itemNum || (probs!=NULL && PyArray_SIZE(probs)!=itemNum)
+     || (chosen!=NULL && PyArray_SIZE(chosen)!=itemNum)){
+    PyErr_SetString(PyExc_ValueError, "codes, values, probs and chosen should have the same size");
+    goto done;
+  }
+  if(itemNum==0){
+    PyErr_SetString(PyExc_ValueError, "no items to rank");
+    goto done;
+  }
+
+  {
+    npy_int64 *codedata=(npy_int64 *)PyArray_DATA(codes);
+    double *valuedata=(double *)PyArray_DATA(values);
+    double *probdata=probs==NULL ? NULL : (double *)PyArray_DATA(probs);
+    npy_int32 *chosendata=chosen==NULL ? NULL : (npy_int32 *)PyArray_DATA(chosen);
+
+    for (i=0;i<itemNum;i++){
+      if(codedata[i]<0 || codedata[i]>=INT_MAX){
+        PyErr_SetString(PyExc_ValueError, "codes should be within 0 and the number of groups - 1");
+        goto done;
+      }
+      if(codedata[i]+1>groupNum) groupNum=(int)codedata[i]+1;
+    }
+
+    // groups and the list, in the same layout as ReadFile makes them
+    groups=new GROUP_STRUCT[groupNum];
+    memset(groups, 0, groupNum*sizeof(GROUP_STRUCT));
+    for (i=0;i<itemNum;i++){
+      groups[codedata[i]].maxItemNum++;
+    }
+    for (j=0;j<groupNum;j++){
+      groups[j].index=j;
+      groups[j].items=new ITEM_STRUCT[groups[j].maxItemNum];
+    }
+    lists[0].name=NULL;
+    lists[0].values=new double[itemNum];
+    lists[0].itemNum=0;
+    lists[0].maxItemNum=(int)itemNum;
+    for (i=0;i<itemNum;i++){
+      GROUP_STRUCT *group=groups+codedata[i];
+      ITEM_STRUCT *item=group->items+group->itemNum;
+      item->name=NULL;
+      item->listIndex=0;
+      item->value=valuedata[i];
+      item->percentile=0.0;
+      item->prob=probdata==NULL ? 1.0 : probdata[i];
+      item->isChosen=chosendata==NULL ? 1 : chosendata[i];
+      group->itemNum++;
+      if(item->isChosen){
+        lists[0].values[lists[0].itemNum]=item->value;
+        lists[0].itemNum++;
+      }
+    }
+  }
+
+  PRINT_DEBUG=level<=RRA_LOG_DEBUG;
+  log_level=level;
+  RRALogHandler=PythonLogHandler;
+  flag=ProcessGroups(groups, groupNum, lists, 1, maxPercentile);
+  if(flag>0){
+    flag=ComputeFDR(groups, groupNum, maxPercentile, permutation*groupNum, numThreads);
+  }
+  RRALogHandler=NULL;
+  PRINT_DEBUG=0;
+  delete[] lists[0].values;
+  if(flag<=0){
+    PyErr_SetString(PyExc_RuntimeError, "RRA failed");
+    goto done;
+  }
+
+  // groups of only control items are skipped as in SaveGroupInfo
+  dims[0]=0;
+  for (j=0;j<groupNum;j++){
+    if(groups[j].controlsgs<groups[j].itemNum) dims[0]++;
+  }
+  outarrays[0]=(PyArrayObject *)PyArray_SimpleNew(1, dims, NPY_INT64);
+  outarrays[1]=(PyArrayObject *)PyArray_SimpleNew(1, dims, NPY_INT64);
+  outarrays[2]=(PyArrayObject *)PyArray_SimpleNew(1, dims, NPY_FLOAT64);
+  outarrays[3]=(PyArrayObject *)PyArray_SimpleNew(1, dims, NPY_FLOAT64);
+  outarrays[4]=(PyArrayObject *)PyArray_SimpleNew(1, dims, NPY_FLOAT64);
+  outarrays[5]=(PyArrayObject *)PyArray_SimpleNew(1, dims, NPY_INT64);
+  for (k=0;k<6;k++){
+    if(outarrays[k]==NULL){
+      for (j=0;j<6;j++) Py_XDECREF(outarrays[j]);
+      goto done;
+    }
+  }
+  k=0;
+  for (j=0;j<groupNum;j++){
+    if(groups[j].controlsgs>=groups[j].itemNum) continue;
+    ((npy_int64 *)PyArray_DATA(outarrays[0]))[k]=groups[j].index;
+    ((npy_int64 *)PyArray_DATA(outarrays[1]))[k]=groups[j].itemNum;
+    ((double *)PyArray_DATA(outarrays[2]))[k]=groups[j].loValue;
+    ((double *)PyArray_DATA(outarrays[3]))[k]=groups[j].pvalue;
+    ((double *)PyArray_DATA(outarrays[4]))[k]=groups[j].fdr;
+    ((npy_int64 *)PyArray_DATA(outarrays[5]))[k]=groups[j].goodsgrnas;
+    k++;
+  }
+  result=Py_BuildValue("(NNNNNN)", outarrays[0], outarrays[1], outarrays[2],
+                       outarrays[3], outarrays[4], outarrays[5]);
+
+done:
+  if(groups!=NULL) FreeGroups(groups, groupNum);
+  Py_XDECREF(codes);
+  Py_XDECREF(values);
+  Py_XDECREF(probs);
+  Py_XDECREF(chosen);
+  return result;
+}
+
+static PyMethodDef rra_methods[]={
+  {"rra", (PyCFunction)(void(*)(void))rra, METH_VARARGS | METH_KEYWORDS, rra_doc},
+  {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef rra_module={
+  PyModuleDef_HEAD_INIT,
+  "_rra",
+  "Robust Rank Aggregation core of the RRA program.",
+  -1,
+  rra_methods
+};
+
+PyMODINIT_FUNC PyInit__rra(void)
+{
+  import_array();
+  logging_module=PyImport_ImportModule("logging");
+  if(logging_module==NULL) return NULL;
+  return PyModule_Create(&rra_module);
+}
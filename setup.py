@@ -9,8 +9,10 @@ from distutils.command.install import install as DistutilsInstall
 from distutils.command.build_py import build_py
 try:
     from setuptools import setup
+    from setuptools import Extension
 except ImportError:
     from distutils.core import setup
+    from distutils.core import Extension
 
 def readme():
     with open(
@@ -24,12 +26,36 @@ def readme():
 
 def compile_rra():
     os.chdir('rra')
-    os.system('make')
+    # rebuild all, the tracked objects may be older than the sources
+    os.system('make -B')
     rev=os.system('../bin/RRA')
     os.chdir('../')
     return rev
 
 
+def rra_extension():
+    # the RRA core as the mibar._rra extension module, optional as the
+    # RRA program is used when it is not built
+    try:
+        import numpy
+    except ImportError:
+        return []
+    extension = Extension(
+        'mibar._rra',
+        sources=[
+            'rra/src/rramodule.cpp', 'rra/src/RRA.cpp', 'rra/src/rngs.cpp',
+            'rra/src/rvgs.cpp', 'rra/src/math_api.cpp', 'rra/src/words.cpp'
+        ],
+        include_dirs=['rra/include', 'rra/src', numpy.get_include()],
+        define_macros=[('RRA_EXTENSION', None)],
+        extra_compile_args=['-std=c++11', '-pthread'],
+        extra_link_args=['-pthread'],
+        language='c++'
+    )
+    extension.optional = True
+    return [extension]
+
+
 class RRAInstall(DistutilsInstall):
     def run(self):
         # compile RRA
@@ -57,10 +83,11 @@ setup(
     author_email='zhiheng.liu@pku.edu.cn',
     license='GPL',
     packages=['mibar'],
+    ext_modules=rra_extension(),
     install_requires=[
         'numpy', 'scipy', 'pandas'
     ],
-    scripts=['bin/mageck-ibar'],
+    scripts=['bin/mageck-ibar', 'bin/mageck-ibar-count', 'bin/mageck-ibar-index', 'bin/mageck-ibar-merge', 'bin/mageck-ibar-batch'],
     package_dir={'mibar':'mibar'},
     data_files=[('bin', ['bin/RRA'])],
     cmdclass={'install': RRAInstall, 'build_py': build_py},